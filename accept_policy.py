@@ -0,0 +1,76 @@
+import ipaddress
+import json
+import os
+import threading
+import time
+from fnmatch import fnmatchcase
+
+
+class AcceptRule:
+    """Accepts or rejects the requests from matching peers for matching files, a condition that is left out matches anything"""
+
+    def __init__(self, name, action="accept", directory=None, peers=None, files=None, min_size=None, max_size=None):
+        if action not in ("accept", "reject"):
+            raise ValueError(f"Rule {name} has an unknown action {action}, it must be accept or reject")
+        if action == "accept" and (directory is None or not os.path.isabs(directory) or not os.path.isdir(directory)):
+            raise ValueError(f"Rule {name} accepts transfers, so it needs the absolute path of an existing directory")
+        self.name = name
+        self.action = action
+        self.directory = directory
+        self.peers = [ipaddress.ip_network(peer, strict=False) for peer in peers] if peers is not None else None
+        self.files = files
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def matches(self, ip, file_name, file_size):
+        if self.peers is not None and not any(ipaddress.ip_address(ip) in network for network in self.peers):
+            return False
+        if self.files is not None and not any(fnmatchcase(file_name, pattern) for pattern in self.files):
+            return False
+        # A stream's size is None, it isn't known before it was received
+        if self.min_size is not None and (file_size is None or file_size < self.min_size):
+            return False
+        if self.max_size is not None and (file_size is None or file_size > self.max_size):
+            return False
+        return True
+
+
+class AcceptPolicy:
+    """Decides on incoming requests by the first of its rules that matches them, and logs every decision"""
+
+    def __init__(self, rules=(), log_path=None):
+        self.rules = list(rules)
+        self.log_path = log_path
+        self.__lock = threading.Lock()
+
+    def match(self, ip, file_name, file_size):
+        """Returns the first rule that matches the request, or None"""
+        return next((rule for rule in self.rules if rule.matches(ip, file_name, file_size)), None)
+
+    def log(self, decision, **details):
+        if self.log_path is None:
+            return
+        line = json.dumps({"time": time.time(), "decision": decision, **details})
+        with self.__lock, open(self.log_path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+def load_accept_policy(file_path, log_path=None):
+    """Reads the rules from a JSON file with a list of rules under "rules", a missing file has none"""
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return AcceptPolicy(log_path=log_path)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"The accept policy {file_path} isn't valid JSON: {e}")
+
+    rules = []
+    for index, rule in enumerate(data.get("rules", [])):
+        rule = dict(rule)
+        name = rule.pop("name", f"rule {index + 1}")
+        try:
+            rules.append(AcceptRule(name, **rule))
+        except TypeError as e:
+            raise ValueError(f"Rule {name} of the accept policy {file_path} is malformed: {e}")
+    return AcceptPolicy(rules, log_path)
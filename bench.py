@@ -0,0 +1,380 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from os.path import abspath, dirname, join
+from bluetransfer import HeadlessPresenter
+from hash_cache import HashCache
+from misc import merkle_leaves
+from udp_transport import Impairment
+
+try:
+    import resource
+except ImportError:
+    # Windows, the peak RSS isn't reported there
+    resource = None
+
+# The metrics of a run, compared between results, with whether a higher value is better
+METRICS = {
+    "throughput_mb_s": True,
+    "cpu_seconds_per_gb": False,
+    "peak_rss_mb": False,
+    "ttfb_seconds": False
+}
+
+
+class BenchPresenter(HeadlessPresenter):
+    """Accepts every inbound transfer and times it from the receiving end"""
+
+    def __init__(self, accept_dir, **model_options):
+        super().__init__(accept_dir, lambda transfer: True, quiet=True, **model_options)
+        self.__inbound = []
+        self.__lock = threading.Lock()
+
+    def present_incoming_transfer_request(self, transfer):
+        with self.__lock:
+            self.__inbound.append({"transfer": transfer, "first_byte": None, "end": None})
+        super().present_incoming_transfer_request(transfer)
+
+    def wait_for_transfers(self, count):
+        """Blocks until count inbound transfers ended, returns their first byte and end times"""
+        while True:
+            now = time.perf_counter()
+            with self.__lock:
+                inbound = list(self.__inbound)
+            for record in inbound:
+                transfer = record["transfer"]
+                if record["first_byte"] is None and transfer.transferred > 0:
+                    record["first_byte"] = now
+                if record["end"] is None and (transfer.verified is not None or transfer.status.name in ("TRANSFER_CANCEL", "TRANSFER_BROKEN")):
+                    record["end"] = now
+            if len(inbound) == count and all(record["end"] is not None for record in inbound):
+                return inbound
+            time.sleep(0.001)
+
+
+def run_scenario(scenario):
+    """Sends the scenario's sources between two models on loopback, in this process, and returns the measurements"""
+    work_dir = tempfile.mkdtemp(prefix="bluetransfer-bench-")
+    try:
+        receive_dir = join(work_dir, "received")
+        sender_state_dir = join(work_dir, "sender")
+        os.makedirs(receive_dir)
+        os.makedirs(sender_state_dir)
+
+        hash_started = time.perf_counter()
+        hash_cache = HashCache(join(sender_state_dir, "hash_cache.json"))
+        for path in scenario["sources"]:
+            if os.path.isfile(path):
+                hash_cache.get(path, "merkle", merkle_leaves)
+        hash_seconds = time.perf_counter() - hash_started
+
+        # Ports of their own, so runs don't collide with a running BlueTransfer
+        def datagram_options():
+            impairment = Impairment(**scenario["impairment"]) if scenario["impairment"] else None
+            return {"datagram_size": scenario["datagram_size"], "impairment": impairment}
+
+        receiver = BenchPresenter(receive_dir, local_port=0, state_dir=join(work_dir, "receiver"), chunk_size=scenario["chunk_size"],
+                                  auto_tune=scenario["auto_tune"], **datagram_options())
+        receiver_port = receiver.model.listener_socket.getsockname()[1]
+        sender = HeadlessPresenter(quiet=True, remote_port=receiver_port, local_port=0, state_dir=sender_state_dir, chunk_size=scenario["chunk_size"],
+                                   auto_tune=scenario["auto_tune"], **datagram_options())
+        receiver.launch()
+        sender.launch()
+
+        cpu_started = time.process_time()
+        started = time.perf_counter()
+        for path in scenario["sources"]:
+            sender.model.initiate_transfer("127.0.0.1", path, 0, scenario["streams"], False, scenario["compress"], transport=scenario["transport"])
+        inbound = receiver.wait_for_transfers(len(scenario["sources"]))
+        ended = max(record["end"] for record in inbound)
+        cpu_seconds = time.process_time() - cpu_started
+
+        seconds = ended - started
+        total = sum(record["transfer"].file_size for record in inbound)
+        first_bytes = [record["first_byte"] - started for record in inbound if record["first_byte"] is not None]
+        result = {
+            "bytes": total,
+            "seconds": seconds,
+            "verified": all(record["transfer"].verified for record in inbound),
+            "throughput_mb_s": total / seconds / 1024 ** 2,
+            "cpu_seconds": cpu_seconds,
+            "cpu_seconds_per_gb": cpu_seconds / (total / 1024 ** 3) if total else None,
+            "peak_rss_mb": None,
+            "ttfb_seconds": statistics.median(first_bytes) if first_bytes else None,
+            "hash_seconds": hash_seconds
+        }
+        if resource is not None:
+            # Kilobytes on Linux, bytes on macOS
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result["peak_rss_mb"] = peak_rss / 1024 ** 2 if sys.platform == "darwin" else peak_rss / 1024
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def create_file(path, size):
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return path
+    with open(path, "wb") as file:
+        # Random data doesn't compress, so the scenarios with compression measure its worst case
+        for offset in range(0, size, 16 * 1024 * 1024):
+            file.write(os.urandom(min(16 * 1024 * 1024, size - offset)))
+    return path
+
+
+def create_copies(path, count):
+    """Returns count names for the file, the receiver would overwrite transfers of the same name with each other"""
+    copies = [path]
+    for i in range(1, count):
+        copy = f"{path}.{i}"
+        if not os.path.exists(copy):
+            try:
+                os.link(path, copy)
+            except OSError:
+                shutil.copyfile(path, copy)
+        copies.append(copy)
+    return copies
+
+
+def create_batch(directory, file_count, file_size):
+    if not os.path.isdir(directory):
+        partial_directory = directory + ".partial"
+        shutil.rmtree(partial_directory, ignore_errors=True)
+        for i in range(file_count):
+            # A hundred files per subdirectory, like a source tree
+            subdirectory = join(partial_directory, f"{i // 100:03}")
+            os.makedirs(subdirectory, exist_ok=True)
+            create_file(join(subdirectory, f"{i:05}.bin"), file_size)
+        os.rename(partial_directory, directory)
+    return directory
+
+
+def convert_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024 or size % 1024:
+            return f"{size}{unit}"
+        size //= 1024
+    return f"{size}GiB"
+
+
+def plan_scenarios(args, data_dir):
+    """Sweeps one parameter at a time around the base scenario, over each of the transports and tunings"""
+    base = {"file_size": args.base_size * 1024 ** 2, "chunk_size": args.base_chunk_size * 1024, "transfers": 1}
+    scenarios = {}
+    impairment = {"loss": args.loss / 100, "delay": args.delay / 1000, "rate": args.link_rate * 1024 ** 2 if args.link_rate else None}
+
+    def add_transports(name, scenario):
+        for transport, tuning in ((transport, tuning) for transport in args.transports for tuning in args.tunings):
+            scenario_name = name
+            if tuning == "auto":
+                scenario_name += " auto-tuned"
+            if transport == "udp":
+                # Only the datagrams can be impaired in process
+                scenario_name += f" udp datagram={convert_size(args.datagram_size)}"
+                if args.loss or args.delay or args.link_rate:
+                    scenario_name += f" loss={args.loss:g}% delay={args.delay:g}ms"
+                    if args.link_rate:
+                        scenario_name += f" link={args.link_rate:g}MiB/s"
+            scenarios[scenario_name] = {**scenario, "transport": transport, "auto_tune": tuning == "auto", "datagram_size": args.datagram_size,
+                                        "impairment": impairment if transport == "udp" and (args.loss or args.delay or args.link_rate) else None}
+
+    def add_files(file_size, chunk_size, transfers):
+        name = f"file size={convert_size(file_size)} chunk={convert_size(chunk_size)} transfers={transfers} streams={args.streams}"
+        if args.compress:
+            name += " compressed"
+        path = create_file(join(data_dir, f"{file_size}.bin"), file_size)
+        add_transports(name, {"kind": "file", "file_size": file_size, "chunk_size": chunk_size, "transfers": transfers,
+                              "streams": args.streams, "compress": args.compress, "sources": create_copies(path, transfers)})
+
+    def add_batch(file_count, file_size, chunk_size):
+        name = f"batch files={file_count} file size={convert_size(file_size)} chunk={convert_size(chunk_size)}"
+        if args.compress:
+            name += " compressed"
+        directory = create_batch(join(data_dir, f"batch-{file_count}-{file_size}"), file_count, file_size)
+        add_transports(name, {"kind": "batch", "file_count": file_count, "file_size": file_size, "chunk_size": chunk_size, "transfers": 1,
+                              "streams": 1, "compress": args.compress, "sources": [directory]})
+
+    for size in args.sizes:
+        add_files(size * 1024 ** 2, base["chunk_size"], base["transfers"])
+    for chunk_size in args.chunk_sizes:
+        add_files(base["file_size"], chunk_size * 1024, base["transfers"])
+    for transfers in args.concurrency:
+        # The same amount of data in total, split over the transfers
+        add_files(max(1, base["file_size"] // transfers), base["chunk_size"], transfers)
+    for file_count in args.batches:
+        add_batch(file_count, args.batch_file_size * 1024, base["chunk_size"])
+    return scenarios
+
+
+def run_isolated(scenario, timeout):
+    """Runs the scenario in a fresh interpreter, so that its peak RSS and CPU time are its own"""
+    try:
+        completed = subprocess.run([sys.executable, abspath(__file__), "scenario", json.dumps(scenario)],
+                                   capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {"error": f"timed out after {timeout} seconds"}
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else f"exit status {completed.returncode}"}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def summarize(runs):
+    """Returns the median of every metric over the runs that succeeded"""
+    succeeded = [run for run in runs if "error" not in run]
+    if not succeeded:
+        return None
+    return {metric: statistics.median(run[metric] for run in succeeded if run[metric] is not None)
+            if any(run[metric] is not None for run in succeeded) else None
+            for metric in ("seconds", *METRICS)}
+
+
+def describe_commit():
+    try:
+        completed = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=dirname(abspath(__file__)), capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return completed.stdout.strip() or None
+
+
+def run_benchmarks(args):
+    data_dir = args.data_dir or join(tempfile.gettempdir(), "bluetransfer-bench-data")
+    os.makedirs(data_dir, exist_ok=True)
+    print("Creating the source files...", file=sys.stderr, flush=True)
+    scenarios = plan_scenarios(args, data_dir)
+
+    results = []
+    for name, scenario in scenarios.items():
+        runs = []
+        for i in range(args.repeat):
+            print(f"{name} ({i + 1}/{args.repeat})", file=sys.stderr, flush=True)
+            run = run_isolated(scenario, args.timeout)
+            if "error" in run:
+                print(f"  failed: {run['error']}", file=sys.stderr, flush=True)
+            else:
+                print(f"  {run['throughput_mb_s']:.1f} MB/s, {run['cpu_seconds_per_gb']:.2f} CPU s/GB, first byte after {run['ttfb_seconds'] * 1000:.1f} ms", file=sys.stderr, flush=True)
+            runs.append(run)
+        parameters = {key: value for key, value in scenario.items() if key != "sources"}
+        results.append({"name": name, "parameters": parameters, "median": summarize(runs), "runs": runs})
+
+    report = {
+        "commit": describe_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "repeat": args.repeat,
+        "scenarios": results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    return 0 if all(run.get("verified") for result in results for run in result["runs"]) else 1
+
+
+def compare_results(args):
+    """Prints how the median of every metric changed between two results, scenario by scenario"""
+    with open(args.old) as file:
+        old = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+    print(f"{old['commit']} -> {new['commit']}")
+
+    old_scenarios = {result["name"]: result for result in old["scenarios"]}
+    for result in new["scenarios"]:
+        old_result = old_scenarios.get(result["name"])
+        if old_result is None or old_result["median"] is None or result["median"] is None:
+            continue
+        print(result["name"])
+        for metric, higher_is_better in METRICS.items():
+            old_value, new_value = old_result["median"][metric], result["median"][metric]
+            if old_value is None or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+            is_better = change > 0 if higher_is_better else change < 0
+            verdict = "" if abs(change) < args.threshold else (" better" if is_better else " worse")
+            print(f"  {metric:<20} {old_value:>12.3f} -> {new_value:>12.3f} ({change:+.1f}%){verdict}")
+    return 0
+
+
+def parse_list(text):
+    return [int(value) for value in text.split(",") if value]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="bench", description="Benchmarks transfers between two models on loopback and writes the results as JSON.")
+    commands = parser.add_subparsers(dest="command", metavar="{run,compare}")
+
+    run = commands.add_parser("run", help="run the benchmarks (the default)")
+    run.add_argument("--quick", action="store_true", help="smaller files and fewer repeats, for a quick check")
+    run.add_argument("--sizes", type=parse_list, help="file sizes in MiB, comma separated (default 1,64,512)")
+    run.add_argument("--chunk-sizes", type=parse_list, help="chunk sizes in KiB, comma separated (default 64,256,1024,4096)")
+    run.add_argument("--concurrency", type=parse_list, help="concurrent transfers sharing the base size, comma separated (default 1,4,16)")
+    run.add_argument("--batches", type=parse_list, help="files per small-file batch, comma separated (default 100,1000)")
+    run.add_argument("--batch-file-size", type=int, default=16, help="size of the files in a batch in KiB (default 16)")
+    run.add_argument("--base-size", type=int, help="file size in MiB the other parameters are swept with (default 256)")
+    run.add_argument("--base-chunk-size", type=int, default=1024, help="chunk size in KiB the other parameters are swept with (default 1024)")
+    run.add_argument("--streams", type=int, default=1, help="parallel connections per transfer (default 1)")
+    run.add_argument("--compress", action="store_true", help="compress the data")
+    run.add_argument("--transports", type=lambda text: [value for value in text.split(",") if value], default=["tcp"],
+                     help="transports every scenario is run over, comma separated, tcp and udp (default tcp)")
+    run.add_argument("--tunings", type=lambda text: [value for value in text.split(",") if value], default=["fixed"],
+                     help="how the chunk size and socket buffers are set, comma separated, fixed and auto (default fixed)")
+    run.add_argument("--loss", type=float, default=0, help="percentage of the UDP datagrams that are dropped (default 0)")
+    run.add_argument("--delay", type=float, default=0, help="one way delay of the UDP datagrams in ms (default 0)")
+    run.add_argument("--link-rate", type=float, help="rate of a bottleneck the UDP datagrams queue for in MiB/s (default none)")
+    run.add_argument("--datagram-size", type=int, default=1400, help="bytes of file data per UDP datagram (default 1400)")
+    run.add_argument("--repeat", type=int, help="runs per scenario, the median is reported (default 3)")
+    run.add_argument("--timeout", type=int, default=600, help="seconds a run may take (default 600)")
+    run.add_argument("--data-dir", help="where the source files are kept between runs (default in the temporary directory)")
+    run.add_argument("-o", "--output", help="file to write the results to (default stdout)")
+
+    compare = commands.add_parser("compare", help="compare two results")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=5, help="changes below this percentage aren't called better or worse (default 5)")
+
+    scenario = commands.add_parser("scenario")
+    scenario.add_argument("scenario", type=json.loads)
+
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in ("run", "compare", "scenario", "-h", "--help"):
+        argv = ["run", *argv]
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        if not set(args.transports) <= {"tcp", "udp"}:
+            parser.error("--transports can only list tcp and udp")
+        if not set(args.tunings) <= {"fixed", "auto"}:
+            parser.error("--tunings can only list fixed and auto")
+        quick = args.quick
+        args.sizes = args.sizes or ([1, 16, 64] if quick else [1, 64, 512])
+        args.chunk_sizes = args.chunk_sizes or [64, 256, 1024, 4096]
+        args.concurrency = args.concurrency or ([1, 4] if quick else [1, 4, 16])
+        args.batches = args.batches or ([100] if quick else [100, 1000])
+        args.base_size = args.base_size or (64 if quick else 256)
+        args.repeat = args.repeat or (1 if quick else 3)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "scenario":
+        print(json.dumps(run_scenario(args.scenario)), flush=True)
+        return 0
+    if args.command == "compare":
+        return compare_results(args)
+    return run_benchmarks(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
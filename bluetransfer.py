@@ -0,0 +1,270 @@
+import time
+
+# Taken before anything else is imported, so the reported startup time covers the imports too
+STARTED = time.perf_counter()
+
+import argparse
+import os
+import sys
+import threading
+import model
+from misc import convert_file_size, convert_duration
+
+STATUS_TEXT = {
+    "TRANSFER_REQUEST": "waiting for an answer",
+    "TRANSFER_ACCEPT": "transferring",
+    "TRANSFER_RESUME": "transferring",
+    "TRANSFER_PAUSE": "paused",
+    "TRANSFER_FINISH": "finished",
+    "TRANSFER_CANCEL": "cancelled",
+    "TRANSFER_BROKEN": "broken",
+    "TRANSFER_REJECT": "rejected"
+}
+
+
+class HeadlessPresenter:
+    """Drives the model from the command line, progress is printed instead of shown in the GUI"""
+
+    def __init__(self, accept_dir=None, should_accept=None, quiet=False, **model_options):
+        self.accept_dir = accept_dir
+        self.should_accept = should_accept
+        self.quiet = quiet
+        self.model = model.Model(self, **model_options)
+        self.__condition = threading.Condition()
+        # The inbound transfers that started, in order, and the transfers that ended
+        self.__inbound = []
+        self.__ended = {}
+
+    def __print(self, message):
+        if not self.quiet:
+            print(message, flush=True)
+
+    def __end(self, transfer):
+        with self.__condition:
+            if transfer.transfer_uuid not in self.__ended:
+                self.__ended[transfer.transfer_uuid] = transfer
+                self.__condition.notify_all()
+
+    def wait_for_inbound(self):
+        """Blocks until an inbound transfer started, returns its UUID"""
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__inbound)
+            return self.__inbound[0]
+
+    def wait_for_end(self, uuid):
+        """Blocks until the transfer finished, was cancelled, rejected or broke, returns it"""
+        with self.__condition:
+            self.__condition.wait_for(lambda: uuid in self.__ended)
+            return self.__ended[uuid]
+
+    # Model
+
+    def update_send_request_windows_label(self, label_index, status):
+        if status == "hashcalc": self.__print("Calculating the hash tree...")
+        if status == "sendreq": self.__print("Sending transfer request...")
+
+    def present_incoming_transfer_request(self, transfer):
+        size = "unknown size" if transfer.streamed else convert_file_size(transfer.file_size)
+        description = f"{transfer.file_name} ({size}) from {transfer.ip}"
+        if self.should_accept is None or not self.should_accept(transfer):
+            self.__print(f"Rejected {description}")
+            self.model.reject_transfer(transfer.transfer_uuid)
+            return
+
+        self.__print(f"Accepted {description} into {self.accept_dir}")
+        self.model.accept_transfer(transfer.transfer_uuid, self.accept_dir)
+        with self.__condition:
+            self.__inbound.append(transfer.transfer_uuid)
+            self.__condition.notify_all()
+
+    def present_rejected_transfer(self, transfer):
+        self.__print(f"{transfer.ip} has rejected the transfer of {transfer.file_name}")
+        self.__end(transfer)
+
+    def sync_transfers_to_ui(self, transfers):
+        flags = self.model._Model__control_flags
+        for uuid, transfer in transfers.items():
+            if not transfer.is_outbound and uuid not in self.__inbound:
+                # Reattached, or decided on by the accept policy
+                with self.__condition:
+                    self.__inbound.append(uuid)
+                    self.__condition.notify_all()
+
+            is_verified = transfer.status == flags.TRANSFER_FINISH and transfer.verified is not None
+            is_over = is_verified or transfer.status in (flags.TRANSFER_CANCEL, flags.TRANSFER_BROKEN)
+            if transfer.status == flags.TRANSFER_FINISH and not is_verified:
+                # Finished but not verified yet, printed once it is
+                continue
+
+            status = STATUS_TEXT[transfer.status.name]
+            if is_verified:
+                status += " (verified)" if transfer.verified else " (hash mismatch)"
+            direction = "to" if transfer.is_outbound else "from"
+            progress = f"{convert_file_size(transfer.transferred)}/{convert_file_size(transfer.file_size)}"
+            if not is_over:
+                progress += f" at {convert_file_size(transfer.transfer_speed)}/s"
+                if transfer.eta is not None:
+                    progress += f", {convert_duration(transfer.eta)} left"
+            self.__print(f"{transfer.file_name} {direction} {transfer.ip}: {progress}, {status}")
+
+            if is_over:
+                self.__end(transfer)
+
+    def exception_happened(self, e):
+        print(f"Error: {e}", file=sys.stderr, flush=True)
+
+    def launch(self):
+        self.model.launch()
+
+
+def parse_rate(text):
+    """Converts a rate in MB/s to bytes per second"""
+    rate = float(text)
+    if not rate > 0:
+        raise argparse.ArgumentTypeError("must be a positive number of MB/s")
+    return rate * 1024 * 1024
+
+
+def parse_size(text):
+    """Converts a size in MB to bytes"""
+    size = float(text)
+    if not size > 0:
+        raise argparse.ArgumentTypeError("must be a positive number of MB")
+    return int(size * 1024 * 1024)
+
+
+def parse_retention(text):
+    """Converts a retention in whole seconds"""
+    retention = int(text)
+    if retention < 1:
+        raise argparse.ArgumentTypeError("must be at least 1 second")
+    return retention
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="bluetransfer", description="Sends files over the network. Without a command the GUI is opened.")
+    parser.add_argument("--port", type=int, default=15555, help="port to listen on (default 15555)")
+    parser.add_argument("--peer-port", type=int, default=15555, help="port the peers listen on (default 15555)")
+    parser.add_argument("--state-dir", help="where partial transfers and the hash cache are kept")
+    parser.add_argument("--rate-limit", type=parse_rate, help="global upload limit in MB/s")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this port of localhost, at /metrics and /metrics.json")
+    parser.add_argument("--metrics-json", help="file the metrics are written to as JSON every 5 seconds")
+    parser.add_argument("--accept-policy", help="JSON file of rules that accept or reject transfers without asking "
+                                                "(default accept_policy.json in the state directory)")
+    parser.add_argument("--no-auto-tune", dest="auto_tune", action="store_false", help="send 1 MB chunks over sockets with the system's buffer sizes, "
+                                                                                         "instead of tuning both to the path to every peer")
+    parser.add_argument("--transfer-retention", type=parse_retention, default=600, help="seconds ended transfers are kept in memory (default 600)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print errors")
+    commands = parser.add_subparsers(dest="command")
+
+    commands.add_parser("gui", help="open the GUI (the default)")
+
+    send = commands.add_parser("send", help="send a file or a directory, then exit")
+    send.add_argument("ips", nargs="+", metavar="ip", help="IPv4 address of the receiver, with several the file is read once for all of them")
+    send.add_argument("path", help="file or directory to send")
+    send.add_argument("--streams", type=int, default=1, help="parallel connections (default 1)")
+    send.add_argument("--hash-while-sending", action="store_true", help="don't wait for the hash tree before sending the request, "
+                      "only with a single receiver")
+    send.add_argument("--compress", action="store_true", help="compress the data if the receiver supports it")
+    send.add_argument("--delta", action="store_true", help="if the receiver has an older copy of the file, only send what changed")
+    send.add_argument("--udp", action="store_true", help="send the data over UDP, which copes with loss on long links, if the receiver supports it")
+    send.add_argument("--priority", choices=("low", "normal", "high"), default="normal", help="share of the global upload limit")
+    send.add_argument("--transfer-rate-limit", type=parse_rate, help="upload limit of this transfer in MB/s")
+    send.add_argument("--fanout-buffer", type=parse_size, default=64 * 1024 * 1024, help="MB of the file kept for receivers slower than the fastest one, "
+                      "the ones further behind read it again (default 64)")
+
+    for name, help in (("receive", "accept one transfer, then exit"), ("serve", "accept transfers until interrupted")):
+        command = commands.add_parser(name, help=help)
+        command.add_argument("--dir", default=".", help="directory to receive into (default the current one)")
+        command.add_argument("--from", dest="allowed_ips", action="append", metavar="IP", help="only accept transfers from this IP, can be repeated")
+        command.add_argument("--write-buffer", type=parse_size, default=64 * 1024 * 1024, help="MB of received data waiting to be written (default 64)")
+        command.add_argument("--sync-every", type=parse_size, default=64 * 1024 * 1024, help="MB received between syncs to disk (default 64)")
+        command.add_argument("--drop-cache", action="store_true", help="drop received data from the page cache once it was synced")
+        command.add_argument("--link-duplicates", action="store_true", help="hard link files that were already received instead of copying them, "
+                             "writing to one then changes the other")
+
+    args = parser.parse_args(argv)
+    if args.command == "send" and args.streams < 1:
+        parser.error("--streams must be at least 1")
+    if args.state_dir is not None:
+        os.makedirs(args.state_dir, exist_ok=True)
+    return args
+
+
+def model_options(args, **options):
+    return dict(remote_port=args.peer_port, state_dir=args.state_dir, rate_limit=args.rate_limit,
+                metrics_port=args.metrics_port, metrics_path=args.metrics_json, transfer_retention=args.transfer_retention,
+                accept_policy=args.accept_policy, auto_tune=args.auto_tune, **options)
+
+
+def run_gui():
+    try:
+        import presenter
+    except ImportError as e:
+        print(f"The GUI can't be opened ({e}), the send, receive and serve commands work without it", file=sys.stderr)
+        return 1
+    presenter.Presenter().launch()
+    return 0
+
+
+def run_send(args):
+    # The listening port isn't needed for sending, so a receiver running on the same machine keeps it
+    headless = HeadlessPresenter(quiet=args.quiet, **model_options(args, local_port=0, fanout_buffer=args.fanout_buffer))
+    headless.launch()
+    path = os.path.abspath(args.path)
+    transport = "udp" if args.udp else "tcp"
+    if len(args.ips) == 1:
+        uuid = headless.model.initiate_transfer(args.ips[0], path, 0, args.streams, args.hash_while_sending, args.compress, args.priority, args.transfer_rate_limit, args.delta,
+                                                transport).result()
+        if uuid is None:
+            return 1
+        transfer = headless.wait_for_end(uuid)
+        return 0 if transfer.verified else 1
+
+    uuids = headless.model.initiate_fanout(args.ips, path, 0, args.streams, args.compress, args.priority, args.transfer_rate_limit, args.delta, transport).result()
+    verified = {ip: uuid is not None and headless.wait_for_end(uuid).verified for ip, uuid in uuids.items()}
+    if not args.quiet:
+        for ip, is_verified in verified.items():
+            print(f"{ip}: {'verified' if is_verified else 'failed'}", flush=True)
+    return 0 if all(verified.values()) else 1
+
+
+def run_receive(args, once):
+    accept_dir = os.path.abspath(args.dir)
+    accepted = []
+
+    def should_accept(transfer):
+        if args.allowed_ips is not None and transfer.ip not in args.allowed_ips:
+            return False
+        if once and accepted:
+            return False
+        accepted.append(transfer.transfer_uuid)
+        return True
+
+    headless = HeadlessPresenter(accept_dir, should_accept, args.quiet, **model_options(
+        args, local_port=args.port, write_buffer=args.write_buffer, checkpoint_interval=args.sync_every, drop_cache=args.drop_cache,
+        link_duplicates=args.link_duplicates))
+    headless.launch()
+    if not args.quiet:
+        print(f"Listening on port {args.port}, started in {(time.perf_counter() - STARTED) * 1000:.0f} ms", flush=True)
+
+    if not once:
+        threading.Event().wait()
+    transfer = headless.wait_for_end(headless.wait_for_inbound())
+    return 0 if transfer.verified else 1
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        if args.command is None or args.command == "gui":
+            return run_gui()
+        if args.command == "send":
+            return run_send(args)
+        return run_receive(args, once=args.command == "receive")
+    except KeyboardInterrupt:
+        return 130
+
+
+if __name__ == "__main__":
+    sys.exit(main())
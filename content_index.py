@@ -0,0 +1,96 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from misc import load_json, save_json
+
+
+class ContentIndex:
+    """Remembers the files that were received, by the Merkle root of their content, so the same content isn't received twice"""
+
+    def __init__(self, file_path, max_entries=65536, max_copies=8):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.max_copies = max_copies
+        self.__lock = threading.Lock()
+        self.__entries = None
+
+    def __load(self):
+        if self.__entries is None:
+            # [content, [[path, stat], ...]] pairs, least recently used first
+            self.__entries = OrderedDict(load_json(self.file_path, []))
+
+    def __content(self, file_hash, block_size, file_size):
+        # The root depends on the block size the leaves were hashed with
+        return f"{block_size}:{file_size}:{file_hash}"
+
+    def __save(self):
+        save_json(self.file_path, list(self.__entries.items()))
+
+    def add(self, file_path, file_hash, block_size, file_size):
+        file_stat_key = stat_key(file_path)
+        if file_stat_key is None:
+            return
+        content = self.__content(file_hash, block_size, file_size)
+        file_path = os.path.abspath(file_path)
+        with self.__lock:
+            self.__load()
+            copies = [copy for copy in self.__entries.pop(content, []) if copy[0] != file_path]
+            self.__entries[content] = [[file_path, file_stat_key]] + copies[:self.max_copies - 1]
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+            self.__save()
+
+    def find(self, file_hash, block_size, file_size):
+        """Returns the path and the stat key of a file with the given content, or None if there is none that is still unchanged"""
+        content = self.__content(file_hash, block_size, file_size)
+        with self.__lock:
+            self.__load()
+            copies = self.__entries.get(content)
+            if copies is None:
+                return None
+            unchanged = [[file_path, file_stat_key] for file_path, file_stat_key in copies if stat_key(file_path) == file_stat_key]
+            if unchanged:
+                self.__entries[content] = unchanged
+                self.__entries.move_to_end(content)
+            else:
+                del self.__entries[content]
+            if unchanged != copies:
+                self.__save()
+            return tuple(unchanged[0]) if unchanged else None
+
+
+def stat_key(file_path):
+    """Returns the (device, inode, size, mtime_ns) of a file as a string, or None if it is gone"""
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return None
+    return f"{file_stat.st_dev}:{file_stat.st_ino}:{file_stat.st_size}:{file_stat.st_mtime_ns}"
+
+
+def link_or_copy(source_path, file_path, link=False, source_key=None):
+    """Makes file_path a copy of source_path, or a hard link to it with link, raises ValueError if source_key changed"""
+    if source_key is not None and stat_key(source_path) != source_key:
+        raise ValueError(f"{source_path} changed since it was indexed")
+    if os.path.exists(file_path) and os.path.samefile(source_path, file_path):
+        return
+    temporary_path = file_path + ".bluetransfer-copy"
+    if os.path.lexists(temporary_path):
+        os.remove(temporary_path)
+    try:
+        if link:
+            try:
+                os.link(source_path, temporary_path)
+            except OSError:
+                # Like across file systems, or on ones without hard links
+                link = False
+        if not link:
+            shutil.copyfile(source_path, temporary_path)
+        if source_key is not None and stat_key(source_path) != source_key:
+            raise ValueError(f"{source_path} changed while it was being copied")
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        if os.path.lexists(temporary_path):
+            os.remove(temporary_path)
+        raise
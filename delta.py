@@ -0,0 +1,78 @@
+import mmap
+import zlib
+from hashlib import blake2b
+
+# The modulus of Adler-32, whose checksum can be rolled along a file one byte at a time
+ADLER_MODULUS = 65521
+# Bytes rolled past at most while looking for blocks at every offset, and how many of them are sliced off at once
+ROLL_BUDGET = 16 * 1024 * 1024
+ROLL_CHUNK = 64 * 1024
+
+
+def signature_block_size(file_size):
+    """Returns the block size of the signatures of a file, about the square root of its size like rsync does"""
+    block_size = 4 * 1024
+    while block_size < 1024 * 1024 and block_size * block_size < file_size:
+        block_size *= 2
+    return block_size
+
+
+def strong_checksum(data):
+    return blake2b(data, digest_size=8, person=b"delta").hexdigest()
+
+
+def block_signatures(path, block_size):
+    """Returns the [weak, strong] checksums of every whole block of the file, the last partial block is left out"""
+    signatures = []
+    with open(path, "rb") as f:
+        while len(block := f.read(block_size)) == block_size:
+            signatures.append([zlib.adler32(block), strong_checksum(block)])
+    return signatures
+
+
+def find_copies(path, block_size, signatures, roll_budget=None):
+    """Returns the [offset, basis_offset, length] ranges of the file that the receiver's older copy already has"""
+    blocks = {}
+    for index, (weak, strong) in enumerate(signatures):
+        blocks.setdefault(weak, {}).setdefault(strong, index * block_size)
+
+    copies = []
+    with open(path, "rb") as f:
+        size = f.seek(0, 2)
+        if not blocks or size < block_size:
+            return copies
+        if roll_budget is None:
+            roll_budget = min(size // 8, ROLL_BUDGET)
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset, weak = 0, None
+            while offset + block_size <= size:
+                if weak is None:
+                    weak = zlib.adler32(data[offset:offset + block_size])
+                candidates = blocks.get(weak)
+                basis_offset = candidates.get(strong_checksum(data[offset:offset + block_size])) if candidates else None
+                if basis_offset is not None:
+                    if copies and copies[-1][0] + copies[-1][2] == offset and copies[-1][1] + copies[-1][2] == basis_offset:
+                        copies[-1][2] += block_size
+                    else:
+                        copies.append([offset, basis_offset, block_size])
+                    offset, weak = offset + block_size, None
+                    continue
+
+                if roll_budget <= 0:
+                    offset, weak = offset + block_size, None
+                    continue
+                count = min(ROLL_CHUNK, size - offset - block_size, roll_budget)
+                if count == 0:
+                    break
+
+                # Rolls a byte at a time until the weak checksum is one of a block
+                a, b, rolled = weak & 0xFFFF, weak >> 16, 0
+                for out, new in zip(data[offset:offset + count], data[offset + block_size:offset + block_size + count]):
+                    a = (a - out + new) % ADLER_MODULUS
+                    b = (b + a - 1 - block_size * out) % ADLER_MODULUS
+                    rolled += 1
+                    if (b << 16) | a in blocks:
+                        break
+                offset, weak, roll_budget = offset + rolled, (b << 16) | a, roll_budget - rolled
+    return copies
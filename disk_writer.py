@@ -0,0 +1,137 @@
+import asyncio
+import errno
+import os
+import queue
+import threading
+
+
+def preallocate(file_descriptor, size):
+    """Reserves the blocks of the whole file up front, where the file system can"""
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(file_descriptor, 0, size)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            raise
+
+
+def advise(file_descriptor, offset, length, advice):
+    """Passes a posix_fadvise hint on, where there is posix_fadvise, advice is the name of one of its POSIX_FADV_ constants"""
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(file_descriptor, offset, length, getattr(os, advice))
+
+
+def pwrite_all(file_descriptor, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(file_descriptor, view, offset)
+        view, offset = view[written:], offset + written
+
+
+def copy_range(source_descriptor, source_offset, file_descriptor, offset, length):
+    """Copies bytes from one file into another, inside the kernel where there is copy_file_range"""
+    use_kernel = hasattr(os, "copy_file_range")
+    while length > 0:
+        if use_kernel:
+            try:
+                copied = os.copy_file_range(source_descriptor, file_descriptor, length, source_offset, offset)
+            except OSError as e:
+                # Like files on different file systems with older kernels, or file systems that don't support it
+                if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                    raise
+                use_kernel = False
+                continue
+        else:
+            data = os.pread(source_descriptor, min(length, 1024 * 1024), source_offset)
+            pwrite_all(file_descriptor, data, offset)
+            copied = len(data)
+
+        if copied == 0:
+            raise ValueError("The file being copied from is shorter than expected")
+        source_offset, offset, length = source_offset + copied, offset + copied, length - copied
+
+
+class DiskWriter:
+    """Writes received file data on a thread of its own, in the order it was submitted"""
+
+    def __init__(self, loop, memory_limit=64 * 1024 * 1024):
+        self.memory_limit = memory_limit
+        self.__loop = loop
+        self.__jobs = queue.SimpleQueue()
+        self.__thread = None
+        self.__reserved = 0
+        self.__released = asyncio.Event()
+        # Buffers of finished writes by their size, for reuse
+        self.__free_buffers = {}
+        self.__free_bytes = 0
+
+    async def reserve(self, size):
+        """Waits until size more bytes fit under the memory limit, a single chunk larger than the limit still fits alone"""
+        while self.__reserved and self.__reserved + size > self.memory_limit:
+            self.__released.clear()
+            await self.__released.wait()
+        self.__reserved += size
+
+    def try_reserve(self, size):
+        """Reserves size bytes if they fit under the memory limit right away, returns False otherwise"""
+        if self.__reserved and self.__reserved + size > self.memory_limit:
+            return False
+        self.__reserved += size
+        return True
+
+    def release(self, size):
+        self.__reserved -= size
+        self.__released.set()
+
+    async def take_buffer(self, size):
+        """Reserves size bytes and returns a buffer of exactly that size, to be passed to submit or given back"""
+        await self.reserve(size)
+        free_buffers = self.__free_buffers.get(size)
+        if free_buffers:
+            self.__free_bytes -= size
+            return free_buffers.pop()
+        return bytearray(size)
+
+    def give_back(self, buffer):
+        """Returns a buffer that wasn't submitted, like when receiving into it failed"""
+        self.release(len(buffer))
+        if self.__free_bytes + len(buffer) <= self.memory_limit:
+            self.__free_buffers.setdefault(len(buffer), []).append(buffer)
+            self.__free_bytes += len(buffer)
+
+    def submit(self, function, *args, buffer=None, reserved=0):
+        """Runs function(*args) on the writer thread and returns a future of its result"""
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+        future = self.__loop.create_future()
+        # Jobs like closing a file aren't always waited for, their errors aren't worth a warning then
+        future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self.__jobs.put((function, args, future, buffer, reserved))
+        return future
+
+    def __run(self):
+        while True:
+            function, args, future, buffer, reserved = self.__jobs.get()
+            try:
+                result, exception = function(*args), None
+            except BaseException as e:
+                result, exception = None, e
+            try:
+                self.__loop.call_soon_threadsafe(self.__complete, future, result, exception, buffer, reserved)
+            except RuntimeError:
+                # The event loop was closed
+                return
+
+    def __complete(self, future, result, exception, buffer, reserved):
+        if buffer is not None:
+            self.give_back(buffer)
+        if reserved:
+            self.release(reserved)
+        if future.cancelled():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
@@ -0,0 +1,60 @@
+import os
+import threading
+from collections import OrderedDict
+from misc import load_json, save_json
+
+
+class HashCache:
+    """Remembers the hashes of outbound files between runs, keyed by (device, inode, size, mtime_ns)"""
+
+    def __init__(self, file_path, max_entries=4096):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.__lock = threading.Lock()
+        self.__entries = None
+
+    def __load(self):
+        if self.__entries is None:
+            # [key, hashes] pairs, least recently used first
+            self.__entries = OrderedDict((key, hashes) for key, hashes in load_json(self.file_path, []))
+
+    def __key(self, file_stat):
+        return f"{file_stat.st_dev}:{file_stat.st_ino}:{file_stat.st_size}:{file_stat.st_mtime_ns}"
+
+    def __save(self):
+        save_json(self.file_path, [[key, hashes] for key, hashes in self.__entries.items()])
+
+    def lookup(self, file_path, kind):
+        """Returns the cached hash of the given kind, or None if the file changed or was never hashed"""
+        key = self.__key(os.stat(file_path))
+        with self.__lock:
+            self.__load()
+            hashes = self.__entries.get(key)
+            if hashes is None or kind not in hashes:
+                return None
+            self.__entries.move_to_end(key)
+            return hashes[kind]
+
+    def get(self, file_path, kind, compute):
+        """Returns the hash of the given kind, calling compute(file_path) and caching its result on a miss"""
+        cached = self.lookup(file_path, kind)
+        if cached is not None:
+            return cached
+
+        file_stat = os.stat(file_path)
+        value = compute(file_path)
+
+        key = self.__key(file_stat)
+        if key != self.__key(os.stat(file_path)):
+            # The file was modified while it was being hashed, the hash might not match any version of it
+            return value
+
+        with self.__lock:
+            self.__load()
+            hashes = self.__entries.pop(key, {})
+            hashes[kind] = value
+            self.__entries[key] = hashes
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+            self.__save()
+        return value
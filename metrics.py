@@ -0,0 +1,258 @@
+import asyncio
+import bisect
+import json
+import math
+import time
+from collections import deque
+
+# Upper bounds of the throughput histogram buckets, in bytes per second
+RATE_BUCKETS = (64 * 1024, 1024 ** 2, 10 * 1024 ** 2, 100 * 1024 ** 2, 1024 ** 3, 10 * 1024 ** 3)
+
+
+class RateHistogram:
+    """Counts the throughput samples that fell into every bucket, exported like a Prometheus histogram"""
+
+    def __init__(self):
+        self.counts = [0] * (len(RATE_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, rate):
+        self.counts[bisect.bisect_left(RATE_BUCKETS, rate)] += 1
+        self.sum += rate
+        self.count += 1
+
+    def cumulative_counts(self):
+        """Returns (upper bound, samples at or below it) pairs, the last bound is infinite"""
+        pairs, total = [], 0
+        for bound, count in zip(RATE_BUCKETS + (math.inf,), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def to_json(self):
+        # JSON has no infinity, the last bucket has no upper bound instead
+        return [[bound if bound != math.inf else None, count] for bound, count in self.cumulative_counts()]
+
+
+class Throughput:
+    """Follows the throughput of a growing byte count from samples of it"""
+
+    def __init__(self, time_constant=5, window=10):
+        self.time_constant = time_constant
+        self.window = window
+        self.ewma = None
+        self.histogram = RateHistogram()
+        self.__samples = deque()
+
+    def sample(self, now, total, observe=True):
+        """Records the byte count at now, observe=False leaves the histogram alone, like while paused"""
+        if self.__samples:
+            last_time, last_total = self.__samples[-1]
+            elapsed = now - last_time
+            if elapsed <= 0:
+                return
+            # The count shrinks when bytes are sent again, like corrupted blocks
+            rate = max(0, total - last_total) / elapsed
+            weight = 1 - math.exp(-elapsed / self.time_constant)
+            self.ewma = rate if self.ewma is None else self.ewma + weight * (rate - self.ewma)
+            if observe:
+                self.histogram.observe(rate)
+
+        self.__samples.append((now, total))
+        while now - self.__samples[0][0] > self.window:
+            self.__samples.popleft()
+
+    @property
+    def window_rate(self):
+        if len(self.__samples) < 2:
+            return None
+        (first_time, first_total), (last_time, last_total) = self.__samples[0], self.__samples[-1]
+        return max(0, last_total - first_total) / (last_time - first_time)
+
+
+class TransferMetrics:
+    def __init__(self):
+        self.labels = None
+        self.throughput = Throughput()
+        self.transferred = 0
+        self.file_size = 0
+        self.paused_seconds = 0.0
+        self.paused_since = None
+
+    def paused_for(self, now):
+        """Returns the total time the transfer spent paused, including the pause it is in"""
+        if self.paused_since is None:
+            return self.paused_seconds
+        return self.paused_seconds + now - self.paused_since
+
+    @property
+    def eta(self):
+        """Returns the seconds left at the smoothed rate, or None while the transfer isn't moving"""
+        rate = self.throughput.ewma
+        if self.paused_since is not None or not rate:
+            return None
+        return max(0, self.file_size - self.transferred) / rate
+
+
+class Metrics:
+    """Throughput, ETA and pause metrics of every transfer and of every direction, exported as Prometheus text or JSON"""
+
+    def __init__(self):
+        self.__transfers = {}
+        self.__bytes = {"outbound": 0, "inbound": 0}
+        self.__totals = {"outbound": Throughput(), "inbound": Throughput()}
+        self.__active = {"outbound": False, "inbound": False}
+
+    def __get(self, uuid):
+        if uuid not in self.__transfers:
+            self.__transfers[uuid] = TransferMetrics()
+        return self.__transfers[uuid]
+
+    def sample(self, uuid, now, labels, transferred, file_size, is_paused):
+        """Records the progress of a transfer and returns its metrics, labels are its file, peer and direction"""
+        transfer = self.__get(uuid)
+        transfer.labels = labels
+        transfer.transferred = transferred
+        transfer.file_size = file_size
+        transfer.throughput.sample(now, transferred, observe=not is_paused)
+        if not is_paused:
+            self.__active[labels["direction"]] = True
+        return transfer
+
+    def count_bytes(self, direction, count):
+        """Counts file data as it is sent or written, the totals don't depend on how often transfers are sampled"""
+        self.__bytes[direction] += count
+
+    def sample_totals(self, now):
+        """Records the byte counts of both directions, after every transfer was sampled"""
+        for direction, throughput in self.__totals.items():
+            # Idle periods would swamp the histogram, only the seconds something was moving count
+            throughput.sample(now, self.__bytes[direction], observe=self.__active[direction])
+            self.__active[direction] = False
+
+    def set_paused(self, uuid, is_paused, now):
+        if uuid not in self.__transfers and not is_paused:
+            return
+        transfer = self.__get(uuid)
+        if is_paused and transfer.paused_since is None:
+            transfer.paused_since = now
+        elif not is_paused and transfer.paused_since is not None:
+            transfer.paused_seconds += now - transfer.paused_since
+            transfer.paused_since = None
+
+    def get(self, uuid):
+        return self.__transfers.get(uuid)
+
+    def forget(self, uuid):
+        self.__transfers.pop(uuid, None)
+
+    def to_json(self, now):
+        transfers = {}
+        for uuid, transfer in self.__transfers.items():
+            if transfer.labels is None:
+                continue
+            transfers[str(uuid)] = {
+                **transfer.labels,
+                "transferred": transfer.transferred,
+                "file_size": transfer.file_size,
+                "rate": transfer.throughput.ewma,
+                "window_rate": transfer.throughput.window_rate,
+                "eta": transfer.eta,
+                "paused_seconds": transfer.paused_for(now),
+                "histogram": transfer.throughput.histogram.to_json()
+            }
+
+        totals = {}
+        for direction, throughput in self.__totals.items():
+            totals[direction] = {
+                "bytes": self.__bytes[direction],
+                "rate": throughput.ewma,
+                "window_rate": throughput.window_rate,
+                "histogram": throughput.histogram.to_json()
+            }
+        return {"time": time.time(), "transfers": transfers, "totals": totals}
+
+    def to_prometheus(self, now):
+        """Returns every metric in the Prometheus text exposition format"""
+        lines = []
+
+        def add(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if value is not None:
+                    lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+        def add_histogram(name, help, histograms):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in histograms:
+                for bound, count in histogram.cumulative_counts():
+                    lines.append(f"{name}_bucket{format_labels({**labels, 'le': format_value(bound)})} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(histogram.sum)}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+        transfers = [({"uuid": str(uuid), **transfer.labels}, transfer) for uuid, transfer in self.__transfers.items() if transfer.labels is not None]
+        add("bluetransfer_transfer_bytes", "gauge", "Bytes of the transfer that were transferred", [(labels, transfer.transferred) for labels, transfer in transfers])
+        add("bluetransfer_transfer_size_bytes", "gauge", "Size of the transferred file or batch", [(labels, transfer.file_size) for labels, transfer in transfers])
+        add("bluetransfer_transfer_rate_bytes_per_second", "gauge", "Throughput of the transfer, smoothed with an EWMA", [(labels, transfer.throughput.ewma) for labels, transfer in transfers])
+        add("bluetransfer_transfer_window_rate_bytes_per_second", "gauge", "Average throughput of the transfer over the last 10 seconds", [(labels, transfer.throughput.window_rate) for labels, transfer in transfers])
+        add("bluetransfer_transfer_eta_seconds", "gauge", "Estimated time until the transfer completes", [(labels, transfer.eta) for labels, transfer in transfers])
+        add("bluetransfer_transfer_paused_seconds_total", "counter", "Time the transfer spent paused", [(labels, transfer.paused_for(now)) for labels, transfer in transfers])
+        add_histogram("bluetransfer_transfer_throughput_bytes_per_second", "Throughput samples of the transfer", [(labels, transfer.throughput.histogram) for labels, transfer in transfers])
+
+        directions = [({"direction": direction}, throughput) for direction, throughput in self.__totals.items()]
+        add("bluetransfer_bytes_total", "counter", "Bytes transferred in every direction", [(labels, self.__bytes[labels["direction"]]) for labels, _ in directions])
+        add("bluetransfer_rate_bytes_per_second", "gauge", "Throughput of all transfers, smoothed with an EWMA", [(labels, throughput.ewma) for labels, throughput in directions])
+        add("bluetransfer_window_rate_bytes_per_second", "gauge", "Average throughput of all transfers over the last 10 seconds", [(labels, throughput.window_rate) for labels, throughput in directions])
+        add_histogram("bluetransfer_throughput_bytes_per_second", "Throughput samples of all transfers, while any was moving", [(labels, throughput.histogram) for labels, throughput in directions])
+        return "\n".join(lines) + "\n"
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels.items()) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+async def serve_metrics(metrics, port, clock):
+    """Serves the metrics on localhost, as Prometheus text at /metrics and as JSON at /metrics.json"""
+
+    async def handle_request(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            # The headers don't matter, they are read so that the client isn't reset while still sending them
+            while await asyncio.wait_for(reader.readline(), 10) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.split()
+            path = parts[1].split(b"?")[0] if len(parts) >= 2 else b""
+            if len(parts) >= 2 and parts[0] == b"GET" and path == b"/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", metrics.to_prometheus(clock()).encode("utf-8")
+            elif len(parts) >= 2 and parts[0] == b"GET" and path == b"/metrics.json":
+                status, content_type, body = "200 OK", "application/json", json.dumps(metrics.to_json(clock())).encode("utf-8")
+            else:
+                status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"Not found\n"
+
+            header = f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+            writer.write(header.encode("ascii") + body)
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_request, "127.0.0.1", port)
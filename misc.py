@@ -1,4 +1,19 @@
-from hashlib import sha1
+import bisect
+import json
+import lzma
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashlib import blake2b
+
+try:
+    from compression import zstd
+except ImportError:
+    # Only Python 3.14 and newer ship zstd
+    zstd = None
+
+MERKLE_BLOCK_SIZE = 4 * 1024 * 1024
 
 def convert_file_size(bytes):
     if bytes < 1024:
@@ -27,14 +42,179 @@ def convert_file_size(bytes):
     bytes = bytes / 1024
 
 
-def sha1_chunks(file_path):
-    BUF_SIZE = 65536
-    hashing_algo = sha1()
-    with open(file_path, 'rb') as f:
-        while True:
-            data = f.read(BUF_SIZE)
-            if not data:
-                break
-            hashing_algo.update(data)
-    
-    return hashing_algo.hexdigest()
\ No newline at end of file
+def convert_duration(seconds):
+    seconds = round(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}:{minutes:02}:{seconds:02}"
+    return f"{minutes}:{seconds:02}"
+
+
+def get_state_dir():
+    """Returns the directory where BlueTransfer keeps its state between runs, creating it if needed"""
+    state_dir = os.environ.get("BLUETRANSFER_HOME", os.path.join(os.path.expanduser("~"), ".bluetransfer"))
+    os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+
+def load_json(file_path, default):
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+
+def save_json(file_path, data):
+    """Writes the file next to its destination first and swaps it in, so a crash never leaves it half written"""
+    temporary_path = file_path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, file_path)
+
+
+def leaf_hasher():
+    return blake2b(digest_size=16, person=b"leaf")
+
+
+def walk_files(directory_path):
+    """Returns the [relative_path, size] pairs of every regular file below the directory, in a stable order"""
+    files = []
+    for root, directories, file_names in os.walk(directory_path):
+        directories.sort()
+        for file_name in sorted(file_names):
+            file_path = os.path.join(root, file_name)
+            if os.path.isfile(file_path) and not os.path.islink(file_path):
+                relative_path = os.path.relpath(file_path, directory_path).replace(os.sep, "/")
+                files.append([relative_path, os.path.getsize(file_path)])
+    return files
+
+
+def get_source_size(source):
+    """A source is either a file path, or a list of [path, start, size] files laid out back to back"""
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    return source[-1][1] + source[-1][2] if source else 0
+
+
+def _source_spans(source, offset, length):
+    """Yields the path, offset within that file and length of every file the byte range of the source covers"""
+    index = bisect.bisect_right(source, offset, key=lambda file: file[1]) - 1
+    while length > 0 and index < len(source):
+        path, start, size = source[index]
+        count = min(length, start + size - offset)
+        if count > 0:
+            yield path, offset - start, count
+            offset += count
+            length -= count
+        index += 1
+
+
+def read_span(source, offset, length):
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            return os.pread(f.fileno(), length, offset)
+
+    chunks = []
+    for path, file_offset, count in _source_spans(source, offset, length):
+        file_descriptor = os.open(path, os.O_RDONLY)
+        try:
+            chunk = os.pread(file_descriptor, count, file_offset)
+        finally:
+            os.close(file_descriptor)
+        chunks.append(chunk)
+        if len(chunk) != count:
+            # The file was truncated, the caller notices the short read
+            break
+    return b"".join(chunks)
+
+
+def write_span(source, offset, data):
+    data = memoryview(data)
+    if isinstance(source, str):
+        source = [[source, 0, offset + len(data)]]
+
+    for path, file_offset, count in _source_spans(source, offset, len(data)):
+        file_descriptor = os.open(path, os.O_WRONLY)
+        try:
+            os.pwrite(file_descriptor, data[:count], file_offset)
+        finally:
+            os.close(file_descriptor)
+        data = data[count:]
+
+
+def hash_block(source, index, block_size=MERKLE_BLOCK_SIZE):
+    hashing_algo = leaf_hasher()
+    hashing_algo.update(read_span(source, index * block_size, block_size))
+    return hashing_algo.hexdigest()
+
+
+# hashlib releases the GIL while it hashes large buffers, so threads scale without the cost of worker processes.
+# Shared by every call, its threads are only started once there is something to hash
+_hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="hash")
+
+
+def hash_blocks(source, indices, block_size=MERKLE_BLOCK_SIZE):
+    """Returns the BLAKE2b hashes of the given blocks of the source, many blocks are hashed on every core at once"""
+    indices = list(indices)
+    if len(indices) <= 4:
+        return [hash_block(source, index, block_size) for index in indices]
+
+    return list(_hash_pool.map(partial(hash_block, source, block_size=block_size), indices))
+
+
+def merkle_leaves(source, block_size=MERKLE_BLOCK_SIZE):
+    block_count = -(-get_source_size(source) // block_size)
+    return hash_blocks(source, range(block_count), block_size)
+
+
+def merkle_root(leaves):
+    """Hashes the leaves pairwise up to a single root, an odd node out is carried up to the next level"""
+    level = [bytes.fromhex(leaf) for leaf in leaves]
+    if not level:
+        return leaf_hasher().hexdigest()
+
+    while len(level) > 1:
+        level = [
+            blake2b(b"".join(level[index:index + 2]), digest_size=16, person=b"node").digest() if index + 1 < len(level) else level[index]
+            for index in range(0, len(level), 2)
+        ]
+    return level[0].hex()
+
+
+def get_compression_codecs():
+    """Returns the names of the compression codecs this runtime has, the preferred ones first"""
+    codecs = ["zlib", "lzma"]
+    if zstd is not None:
+        codecs.insert(0, "zstd")
+    return codecs
+
+
+def compress_chunk(codec, data):
+    if codec == "zstd":
+        return zstd.compress(data)
+    if codec == "zlib":
+        return zlib.compress(data, 6)
+    if codec == "lzma":
+        return lzma.compress(data, preset=1)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def decompress_chunk(codec, data, length):
+    """Decompresses a chunk that has to expand to exactly length bytes, it is never expanded any further"""
+    if codec == "zstd":
+        decompressor = zstd.ZstdDecompressor()
+    elif codec == "zlib":
+        decompressor = zlib.decompressobj()
+    elif codec == "lzma":
+        decompressor = lzma.LZMADecompressor()
+    else:
+        raise ValueError(f"Unknown compression codec: {codec}")
+
+    chunk = decompressor.decompress(data, length)
+    if len(chunk) != length:
+        raise ValueError("Compressed chunk didn't expand to its announced length")
+    return chunk
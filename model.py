@@ -1,22 +1,91 @@
+import asyncio
+import bisect
 import threading
 import json
+import math
+import os
 import socket
+import stat
 import struct
-import time
-from os.path import basename, getsize
-from misc import sha1_chunks
+from contextlib import nullcontext
+from functools import partial
+from socket import SHUT_RDWR
+from os.path import basename, getsize, isdir, join, normpath
+from misc import MERKLE_BLOCK_SIZE, leaf_hasher, hash_blocks, merkle_leaves, merkle_root, get_compression_codecs, compress_chunk, decompress_chunk
+from misc import walk_files, read_span, write_span, get_state_dir, load_json, save_json
+from hash_cache import HashCache
+from content_index import ContentIndex, link_or_copy
+from accept_policy import load_accept_policy
+from peer_connection import PeerConnection, TransferDetached
+from rate_limiter import RateLimiter
+from metrics import Metrics, serve_metrics
+from transfer_registry import Transfer, TransferRegistry
+from disk_writer import DiskWriter, preallocate, advise, pwrite_all, copy_range
+from delta import signature_block_size, block_signatures, find_copies
+from udp_transport import DatagramEndpoint, DatagramSender, DatagramReceiver, DatagramTimeout
+from shared_reader import SharedReader
+from path_tuning import PathTuner, configure_socket, measure_rtt
 from enum import Enum
 from uuid import UUID, uuid4
 
 class Model:
-    def __init__(self, presenter, remote_port = 15555, local_port = 15555):
+    def __init__(self, presenter, remote_port = 15555, local_port = 15555, state_dir=None, idle_timeout=60, rate_limit=None, credit_window=16 * 1024 * 1024,
+                 metrics_port=None, metrics_path=None, chunk_size=1024 * 1024, transfer_retention=600,
+                 write_buffer=64 * 1024 * 1024, checkpoint_interval=64 * 1024 * 1024, drop_cache=False, link_duplicates=False,
+                 accept_policy=None, datagram_size=1400, impairment=None, fanout_buffer=64 * 1024 * 1024,
+                 auto_tune=True):
         self.presenter = presenter
         self.remote_port = remote_port
         self.local_port = local_port
-        self.__transfers = {}
+        self.state_dir = state_dir or get_state_dir()
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.idle_timeout = idle_timeout
+        # Bytes a sender may have in flight before the receiver wrote them
+        self.credit_window = credit_window
+        # With auto_tune only until the rate of the path is known
+        self.chunk_size = chunk_size
+        self.checkpoint_interval = checkpoint_interval
+        self.drop_cache = drop_cache
+        self.link_duplicates = link_duplicates
+        self.datagram_size = datagram_size
+        self.fanout_buffer = fanout_buffer
+        self.metrics_port = metrics_port
+        self.metrics_path = metrics_path
+        self.__transfers = TransferRegistry(transfer_retention)
+        # One pooled connection per peer IP
+        self.__connections = {}
+        self.__connect_locks = {}
+        self.__records_path = join(self.state_dir, "partial_transfers.json")
+        self.__partial_transfers = load_json(self.__records_path, {})
+        self.__records_lock = asyncio.Lock()
+        self.__hash_cache = HashCache(join(self.state_dir, "hash_cache.json"))
+        self.__content_index = ContentIndex(join(self.state_dir, "content_index.json"))
+        self.__path_tuner = PathTuner(join(self.state_dir, "paths.json")) if auto_tune else None
+        self.__accept_policy = load_accept_policy(accept_policy or join(self.state_dir, "accept_policy.json"), join(self.state_dir, "accept_log.jsonl"))
+        self.__rate_limiter = RateLimiter()
+        self.__rate_limiter.set_global_rate(rate_limit)
+        self.__metrics = Metrics()
+        self.__tasks = set()
+        self.__transfers_changed = asyncio.Event()
+        self.__loop = asyncio.new_event_loop()
+        self.__disk_writer = DiskWriter(self.__loop, write_buffer)
         self.listener_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.listener_socket.setblocking(True)
+        self.listener_socket.setblocking(False)
+        if os.name == "posix":
+            # Connections are long-lived, so a restarted receiver would wait for TIME_WAIT
+            self.listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.listener_socket.bind(("0.0.0.0", local_port))
+        if self.__path_tuner is not None:
+            self.__path_tuner.tune_listener(self.listener_socket)
+        # UDP file data, on the listener's port if it is free
+        self.__datagrams = DatagramEndpoint(self.__loop, impairment)
+        self.__datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.__datagram_socket.bind(("0.0.0.0", self.listener_socket.getsockname()[1]))
+        except OSError:
+            self.__datagram_socket.bind(("0.0.0.0", 0))
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            self.__datagram_socket.setsockopt(socket.SOL_SOCKET, option, 4 * 1024 * 1024)
 
     class __control_flags(Enum):
         TRANSFER_REQUEST = 1
@@ -28,132 +97,1016 @@ class Model:
         TRANSFER_CANCEL = 7
         TRANSFER_FINISH = 8
         TRANSFER_BROKEN = 9
+        TRANSFER_RANGE = 10
+        TRANSFER_REATTACH = 11
+        TRANSFER_DIGEST = 12
+        TRANSFER_REPAIR = 13
+        TRANSFER_COMPRESSED = 14
+        TRANSFER_CREDIT = 15
+        TRANSFER_COPY = 16
 
-    def __recv_all(self, socket, size):
-        data = b""
-        while len(data) < size:
-            chunk = socket.recv(size - len(data))
-            if not chunk:
+    def __spawn(self, coroutine):
+        """Starts a task on the event loop and keeps a reference to it until it is done"""
+        task = self.__loop.create_task(coroutine)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return task
+
+    def __close_socket(self, socket):
+        """Shuts the socket down, which wakes up every task waiting on it, and closes it once they had the chance to notice"""
+        try:
+            socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.__loop.call_later(1, socket.close)
+
+    def __tune_connection(self, connected_socket, ip, connect_time=None):
+        """Turns Nagle off and sizes the buffers of a new connection by the estimate of the path to the peer"""
+        configure_socket(connected_socket)
+        if self.__path_tuner is None:
+            return
+        if connect_time is not None:
+            self.__path_tuner.path(ip).start_connection(connect_time)
+        self.__path_tuner.tune(connected_socket, ip)
+
+    def __remember_paths(self):
+        """Keeps what was learned about the paths for the connections accepted next, and saves it for the next run"""
+        if self.__path_tuner is not None:
+            self.__path_tuner.tune_listener(self.listener_socket)
+            self.__spawn(self.__save_paths())
+
+    async def __save_paths(self):
+        try:
+            await self.__loop.run_in_executor(None, self.__path_tuner.save)
+        except OSError as e:
+            self.presenter.exception_happened(e)
+
+    async def __connect_to_peer(self, ip, timeout):
+        """Returns the pooled connection to the peer, opening it if there is none yet"""
+        async with self.__connect_locks.setdefault(ip, asyncio.Lock()):
+            connection = self.__connections.get(ip)
+            if connection is not None and not connection.closed:
+                return connection
+
+            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            peer_socket.setblocking(False)
+            try:
+                started = self.__loop.time()
+                await asyncio.wait_for(self.__loop.sock_connect(peer_socket, (ip, self.remote_port)), timeout)
+            except:
+                peer_socket.close()
+                raise
+            self.__tune_connection(peer_socket, ip, self.__loop.time() - started)
+
+            connection = PeerConnection(ip, peer_socket, self.__loop)
+            self.__connections[ip] = connection
+            self.__spawn(self.__handle_incoming_messages(connection, (ip, self.remote_port)))
+            return connection
+
+    def __drop_connection(self, connection):
+        """Closes a connection and forgets it, so the next transfer to its peer opens a new one"""
+        if connection.closed:
+            return
+        connection.closed = True
+        if self.__connections.get(connection.ip) is connection:
+            del self.__connections[connection.ip]
+        self.__close_socket(connection.socket)
+
+    async def __reap_idle_connections(self):
+        """Closes the pooled connections that no transfer used for idle_timeout seconds"""
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, 10))
+            for connection in list(self.__connections.values()):
+                if connection.is_idle(self.idle_timeout):
+                    self.__drop_connection(connection)
+
+    def __attach_to_connection(self, uuid, connection):
+        """Moves a transfer onto a connection, the senders still waiting for a turn on its previous one stop"""
+        transfer = self.__transfers[uuid]
+        if transfer.connection is not None:
+            transfer.send_lock.retire()
+            transfer.connection.remove_transfer(uuid)
+        connection.add_transfer(uuid)
+        transfer.connection = connection
+        transfer.socket = connection.socket
+        transfer.send_lock = connection.turn()
+
+    def __release_connection(self, uuid):
+        """Takes a transfer off its connection, which stays open for the other transfers with the same peer"""
+        connection = self.__transfers[uuid].connection
+        if connection is not None:
+            connection.remove_transfer(uuid)
+
+    def __release_transfer(self, uuid):
+        """Lets go of everything an ended transfer holds, outbound files are closed by their senders once they stop"""
+        transfer = self.__transfers[uuid]
+        if not transfer.is_outbound:
+            self.__close_destination(uuid)
+        if transfer.shared_reader is not None:
+            # Dropped once none of the fan-out's transfers needs them
+            transfer.shared_reader.release()
+            transfer.shared_reader = None
+        self.__remember_paths()
+        self.__close_stripes(uuid)
+        self.__close_datagrams(uuid)
+        self.__release_connection(uuid)
+        self.__rate_limiter.forget(uuid)
+
+    def __run_in_loop(self, coroutine):
+        """Schedules a coroutine on the event loop from any other thread, like the one running the UI"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop)
+
+    async def __recv_into_all(self, socket, view):
+        """Fills the whole memoryview from the socket without any intermediate copies"""
+        received = 0
+        size = len(view)
+        while received < size:
+            count = await self.__loop.sock_recv_into(socket, view[received:])
+            if not count:
                 raise ConnectionError("Socket connection closed before all data was received")
-            data += chunk
-        return data
+            received += count
 
-    def __add_transfer(self, uuid, ip, file_name, file_size, file_hash, is_outbound, socket, file_path=""):
-        transfer = {
-            "transfer_uuid": uuid,
-            "ip": ip,
-            "file_name": file_name,
-            "file_size": file_size,
-            "is_outbound": is_outbound,
-            "transfer_speed": 0,
-            "transferred": 0,
-            "path": file_path,
-            "hash": file_hash,
-            "status": self.__control_flags.TRANSFER_REQUEST,
-            "socket": socket,
-            "pause_condition": threading.Condition(),
-            "file_handle": None,
-            "watched": True
-        }
+    async def __recv_all(self, socket, size, buffer=None):
+        if buffer is None or len(buffer) != size:
+            buffer = bytearray(size)
+        await self.__recv_into_all(socket, memoryview(buffer))
+        return buffer
 
-        self.__transfers[uuid] = transfer
+    def __add_transfer(self, uuid, ip, file_name, file_size, file_hash, is_outbound, connection, file_path="", streams=1):
+        transfer = Transfer(uuid, ip, file_name, file_size, file_hash, is_outbound, self.__control_flags.TRANSFER_REQUEST, file_path, streams)
+        self.__transfers.add(transfer, self.__loop.time())
+        self.__attach_to_connection(uuid, connection)
 
-    def __listen_for_connections(self):
+    async def __listen_for_connections(self):
         self.listener_socket.listen()
         while True:
-            other_socket, addr = self.listener_socket.accept()
-            threading.Thread(target=self.__handle_incoming_messages, args=(other_socket, addr)).start()
+            other_socket, addr = await self.__loop.sock_accept(self.listener_socket)
+            other_socket.setblocking(False)
+            self.__tune_connection(other_socket, addr[0])
+            self.__spawn(self.__handle_incoming_messages(PeerConnection(addr[0], other_socket, self.__loop), addr))
 
-    def __decode_packet(self, socket):
-        """Returns packet_type, transfer_uuid, packet_payload"""
+    async def __decode_packet(self, socket, header_buffer=None):
+        """Returns packet_type, transfer_uuid, packet_payload, or the payload length of a TRANSFER_PACKET left on the socket"""
         # | 1 B packet type | 16 B UUID | 4 B (uint) payload length | = Header 133 BYTES
-        packet = self.__recv_all(socket, 1 + 16 + 4) 
+        packet = await self.__recv_all(socket, 1 + 16 + 4, header_buffer)
         packet_type, transfer_uuid, payload_length = struct.unpack('!B16sI', packet)
         transfer_uuid = UUID(bytes=transfer_uuid)
         packet_type = self.__control_flags(packet_type)
-        packet_payload = self.__recv_all(socket, payload_length)
 
-        if not packet_type == self.__control_flags.TRANSFER_PACKET and payload_length != 0:
+        if packet_type == self.__control_flags.TRANSFER_PACKET:
+            return packet_type, transfer_uuid, payload_length
+
+        packet_payload = await self.__recv_all(socket, payload_length)
+
+        if packet_type != self.__control_flags.TRANSFER_COMPRESSED and payload_length != 0:
             packet_payload = json.loads(packet_payload.decode('utf-8'))
 
         return packet_type, transfer_uuid, packet_payload
 
-    def __create_transfer_control_packet(self, uuid, type):
-        """Returns the transfer control packet for a uuid"""
+    def __create_transfer_control_packet(self, uuid, type, payload=None):
+        """Returns the transfer control packet for a uuid, with an optional JSON payload"""
 
         # | 1 B packet type | 16 B UUID | 4 B (uint) payload length | = Header 133 BYTES
 
-        header = struct.pack("!B16sI", type.value, uuid.bytes, 0)
-        return header
+        if payload is None:
+            return struct.pack("!B16sI", type.value, uuid.bytes, 0)
+
+        data = json.dumps(payload).encode("utf-8")
+        return struct.pack("!B16sI", type.value, uuid.bytes, len(data)) + data
+
+    def __layout_files(self, manifest):
+        """Returns the [relative_path, start, size] files of a batch, laid out back to back in the order of its manifest"""
+        files, start = [], 0
+        for relative_path, size in manifest:
+            files.append([relative_path, start, size])
+            start += size
+        return files
+
+    def __batch_source(self, directory_path, layout):
+        """Returns the source of a batch, the [path, start, size] of its files below directory_path"""
+        return [[join(directory_path, *relative_path.split("/")), start, size] for relative_path, start, size in layout]
+
+    def __is_safe_relative_path(self, relative_path):
+        """Checks that a path sent by a peer stays inside the directory it is received into"""
+        parts = relative_path.split("/")
+        return (relative_path == normpath(relative_path).replace(os.sep, "/") and not os.path.isabs(relative_path)
+                and not os.path.splitdrive(relative_path)[0] and all(part not in ("", ".", "..") for part in parts))
+
+    def __open_destination(self, uuid, file_path, resume=False):
+        """Preallocates the destination file, or the files of a batch, and opens it for the disk writer"""
+        transfer = self.__transfers[uuid]
+        if transfer.files is not None:
+            transfer.source = self.__batch_source(file_path, transfer.files)
+            for path, _, size in transfer.source:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "r+b" if resume and os.path.exists(path) else "w+b") as file_handle:
+                    file_handle.truncate(size)
+                    preallocate(file_handle.fileno(), size)
+            return
+
+        transfer.source = file_path
+        file_handle = open(file_path, "r+b" if resume else "w+b", buffering=0)
+        file_handle.truncate(transfer.file_size)
+        preallocate(file_handle.fileno(), transfer.file_size)
+        advise(file_handle.fileno(), 0, 0, "POSIX_FADV_SEQUENTIAL")
+        transfer.file_handle = file_handle
+
+    def __close_destination(self, uuid, sync=False):
+        """Closes the destination once the submitted writes landed, returns a future of that or None if it was already closed"""
+        transfer = self.__transfers[uuid]
+        if transfer.basis is not None:
+            basis, transfer.basis = transfer.basis, None
+            self.__disk_writer.submit(basis.close)
+        file_handle, transfer.file_handle = transfer.file_handle, None
+        if file_handle is None:
+            return None
+        return self.__disk_writer.submit(self.__sync_and_close, file_handle, sync)
+
+    def __sync_and_close(self, file_handle, sync):
+        try:
+            if sync:
+                os.fsync(file_handle.fileno())
+        finally:
+            file_handle.close()
+
+    def __sync_destination(self, file_descriptor, length):
+        """Makes the received bytes durable, the page cache may drop them afterwards"""
+        os.fsync(file_descriptor)
+        if self.drop_cache:
+            advise(file_descriptor, 0, length, "POSIX_FADV_DONTNEED")
+
+    def __open_basis(self, uuid, file_path):
+        """Opens the older copy of a file at the destination and returns the signatures of its blocks, or None without one"""
+        transfer = self.__transfers[uuid]
+        if not transfer.delta or transfer.files is not None or not os.path.isfile(file_path):
+            return None
+        basis = open(file_path, "rb")
+        block_size = signature_block_size(os.fstat(basis.fileno()).st_size)
+        signatures = block_signatures(file_path, block_size)
+        if not signatures:
+            basis.close()
+            return None
+
+        transfer.basis = basis
+        transfer.replaces = file_path
+        transfer.path = file_path + ".bluetransfer-delta"
+        return {"block_size": block_size, "blocks": signatures}
+
+    async def __receive_file_data(self, connected_socket, uuid, payload_length, byte_range, scratch_buffer):
+        """Receives a TRANSFER_PACKET payload and hands it to the disk writer at the offset of byte_range, which is advanced"""
+        offset = byte_range[0]
+        if offset + payload_length > byte_range[1]:
+            await self.__receive_into_scratch(connected_socket, payload_length, scratch_buffer)
+            raise ValueError("Received more data than the announced byte range")
+
+        buffer = await self.__disk_writer.take_buffer(payload_length)
+        try:
+            await self.__recv_into_all(connected_socket, memoryview(buffer))
+        except BaseException:
+            self.__disk_writer.give_back(buffer)
+            raise
+        byte_range[0] += payload_length
+        self.__write_file_data(uuid, offset, buffer, buffer=buffer)
+
+        # Already buffered data would otherwise be read without suspending
+        await asyncio.sleep(0)
+
+    async def __receive_into_scratch(self, connected_socket, payload_length, scratch_buffer):
+        """Receives a TRANSFER_PACKET payload into the scratch buffer, returns the memoryview of it"""
+        if len(scratch_buffer) < payload_length:
+            scratch_buffer.extend(bytes(payload_length - len(scratch_buffer)))
+        view = memoryview(scratch_buffer)[:payload_length]
+        await self.__recv_into_all(connected_socket, view)
+        return view
+
+    async def __receive_compressed_file_data(self, uuid, payload, byte_range):
+        """Decompresses a TRANSFER_COMPRESSED payload in the executor and hands it to the disk writer"""
+        transfer = self.__transfers[uuid]
+        offset = byte_range[0]
+        (length,) = struct.unpack_from("!I", payload)
+        if offset + length > byte_range[1]:
+            raise ValueError("Received more data than the announced byte range")
+        if transfer.codec is None:
+            raise ValueError("Received a compressed chunk without having negotiated compression")
+
+        await self.__disk_writer.reserve(length)
+        try:
+            chunk = await self.__loop.run_in_executor(None, decompress_chunk, transfer.codec, memoryview(payload)[4:], length)
+        except BaseException:
+            self.__disk_writer.release(length)
+            raise
+        byte_range[0] += length
+        self.__write_file_data(uuid, offset, chunk, reserved=length)
+
+    def __write_file_data(self, uuid, offset, data, buffer=None, reserved=0):
+        """Submits file data to the disk writer, it lands once it was written"""
+        transfer = self.__transfers[uuid]
+        is_stale = self.__is_over(uuid)
+        if is_stale or (transfer.files is None and transfer.file_handle is None):
+            if buffer is not None:
+                self.__disk_writer.give_back(buffer)
+            self.__disk_writer.release(reserved)
+            if is_stale:
+                # The transfer ended meanwhile, dropped like any stale packet
+                return
+            raise ValueError("Received file data after the destination was closed")
+        if transfer.files is not None:
+            # A chunk can span many small files, they are opened and written by the writer
+            written = self.__disk_writer.submit(write_span, transfer.source, offset, data, buffer=buffer, reserved=reserved)
+        else:
+            written = self.__disk_writer.submit(pwrite_all, transfer.file_handle.fileno(), data, offset, buffer=buffer, reserved=reserved)
+        self.__land_when_written(uuid, offset, len(data), written)
+
+    def __copy_from_basis(self, uuid, copies):
+        """Copies the [offset, basis_offset, length] ranges of a TRANSFER_COPY packet from the older copy of the file"""
+        transfer = self.__transfers[uuid]
+        if transfer.basis is None or transfer.file_handle is None:
+            raise ValueError("Received block references without an older copy of the file to copy them from")
+        basis_size = os.fstat(transfer.basis.fileno()).st_size
+        for offset, basis_offset, length in copies:
+            if offset < 0 or basis_offset < 0 or length <= 0 or offset + length > transfer.file_size or basis_offset + length > basis_size:
+                raise ValueError("Block reference is outside of the file")
+            self.__open_hole(transfer.holes, offset, length)
+            end = offset + length
+            while offset < end:
+                count = min(end, (offset // transfer.block_size + 1) * transfer.block_size) - offset
+                written = self.__disk_writer.submit(copy_range, transfer.basis.fileno(), basis_offset, transfer.file_handle.fileno(), offset, count)
+                self.__land_when_written(uuid, offset, count, written, copied=True)
+                offset, basis_offset = offset + count, basis_offset + count
+
+    def __choose_transport(self, uuid, transport, accept_payload):
+        """Receives the file data over UDP if the sender asked for it and the UDP socket is up, otherwise over TCP"""
+        transfer = self.__transfers[uuid]
+        self.__close_datagrams(uuid)
+        transfer.transport = "udp" if transport == "udp" and self.__datagrams.transport is not None else "tcp"
+        accept_payload["transport"] = transfer.transport
+        if transfer.transport == "udp":
+            transfer.datagrams = DatagramReceiver(self.__datagrams, uuid, transfer.ip, transfer.holes, partial(self.__write_datagrams, uuid), self.chunk_size,
+                                                  self.__disk_writer.try_reserve, self.__disk_writer.release)
+            accept_payload["udp_port"] = self.__datagrams.port()
+
+    def __write_datagrams(self, uuid, offset, data):
+        """Submits a run of file data that arrived over UDP to the disk writer, its bytes were already reserved"""
+        try:
+            if self.__is_over(uuid):
+                self.__disk_writer.release(len(data))
+                return
+            self.__open_hole(self.__transfers[uuid].holes, offset, len(data))
+            self.__write_file_data(uuid, offset, data, reserved=len(data))
+        except Exception as e:
+            self.__spawn(self.__handle_exceptions(self.__transfers[uuid].socket, uuid, e))
+
+    def __land_when_written(self, uuid, offset, length, written, copied=False):
+        transfer = self.__transfers[uuid]
+        task = self.__loop.create_task(self.__land_written_data(uuid, offset, length, written, copied))
+        transfer.pending_writes.add(task)
+        task.add_done_callback(transfer.pending_writes.discard)
+
+    async def __land_written_data(self, uuid, offset, length, written, copied):
+        """Accounts for file data once it was written, and finishes the transfer if it was the last of it"""
+        try:
+            await written
+        except Exception as e:
+            if uuid in self.__transfers:
+                await self.__handle_exceptions(self.__transfers[uuid].socket, uuid, e)
+            return
+
+        try:
+            if self.__transfers.get(uuid) is None or self.__transfers[uuid].status == self.__control_flags.TRANSFER_CANCEL:
+                return
+            if await self.__land_file_data(uuid, offset, length, copied):
+                await self.__finish_inbound(uuid)
+        except Exception as e:
+            if uuid in self.__transfers:
+                # The transfer may be resumed then
+                await self.__handle_connection_failure(self.__transfers[uuid].socket, uuid, e)
+
+    async def __land_file_data(self, uuid, offset, payload_length, copied=False):
+        """Accounts for file data that was written at offset, returns True once the whole file was received"""
+        transfer = self.__transfers[uuid]
+        self.__fill_hole(transfer.holes, offset, payload_length)
+        transfer.transferred += payload_length
+        if not copied:
+            self.__metrics.count_bytes("inbound", payload_length)
+            self.__observe_bytes(uuid, payload_length)
+            transfer.uncredited += payload_length
+            if transfer.uncredited >= self.credit_window // 4:
+                await self.__grant_credit(uuid)
+        if transfer.streamed and transfer.leaves is None:
+            transfer.file_size = max(transfer.file_size, offset + payload_length)
+            return False
+        completed_blocks = self.__count_block_bytes(transfer, offset, payload_length)
+        if completed_blocks and transfer.leaves is not None:
+            await self.__repair_blocks(uuid, await self.__verify_blocks(uuid, completed_blocks))
+
+        if transfer.transferred == transfer.file_size and transfer.verifying == 0 and not self.__is_over(uuid):
+            self.__set_status(uuid, self.__control_flags.TRANSFER_FINISH)
+            return True
 
-    def __handle_incoming_messages(self, connected_socket, addr):
+        if transfer.resumable and transfer.transferred - transfer.checkpointed >= self.checkpoint_interval:
+            transfer.checkpointed = transfer.transferred
+            self.__spawn(self.__checkpoint_inbound(uuid))
+        return False
+
+    async def __grant_credit(self, uuid):
+        """Gives the bytes that were written since the last grant back to the sender as credit, unless the transfer is paused"""
+        transfer = self.__transfers[uuid]
+        if transfer.status not in (self.__control_flags.TRANSFER_ACCEPT, self.__control_flags.TRANSFER_RESUME) or transfer.uncredited == 0:
+            return
+        credit_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_CREDIT, {"bytes": transfer.uncredited})
+        transfer.uncredited = 0
+        await self.__send_packet(uuid, credit_packet)
+
+    def __open_hole(self, holes, offset, length):
+        """Splits the missing byte range that contains [offset, offset + length), so that a hole starts at offset"""
+        end = offset + length
+        for index, (hole_start, hole_end) in enumerate(holes):
+            if hole_start <= offset and end <= hole_end:
+                if hole_start < offset:
+                    holes[index:index + 1] = [[hole_start, offset], [offset, hole_end]]
+                return
+        raise ValueError("Announced byte range was already received")
+
+    def __fill_hole(self, holes, offset, length):
+        for index, hole in enumerate(holes):
+            if hole[0] == offset:
+                hole[0] += length
+                if hole[0] == hole[1]:
+                    del holes[index]
+                return
+
+    def __reopen_hole(self, holes, offset, length):
+        # Not merged, connections still advance the holes that start at their offsets
+        bisect.insort(holes, [offset, offset + length])
+
+    def __check_leaves(self, leaves, file_size, block_size):
+        if block_size <= 0 or (leaves is not None and len(leaves) != -(-file_size // block_size)):
+            raise ValueError("The manifest doesn't have a hash for every block of the file")
+
+    def __end_stream(self, transfer, file_size, byte_range):
+        """Fixes the size of a stream once the sender reached its end, the bytes that didn't land yet are its last hole"""
+        # Every chunk went before the digest on the same connection
+        if not isinstance(file_size, int) or file_size != byte_range[0]:
+            raise ValueError("The stream ended at another size than was received")
+        byte_range[1] = file_size
+        transfer.file_size = file_size
+        transfer.holes = [[start, file_size] for start, _ in transfer.holes if start < file_size]
+        transfer.block_received = self.__count_received_blocks(transfer)
+
+    def __block_length(self, transfer, index):
+        return min(transfer.block_size, transfer.file_size - index * transfer.block_size)
+
+    def __count_received_blocks(self, transfer):
+        """Returns how many bytes of every block were received, derived from the missing byte ranges"""
+        block_size = transfer.block_size
+        block_count = -(-transfer.file_size // block_size)
+        counts = [self.__block_length(transfer, index) for index in range(block_count)]
+        for start, end in transfer.holes:
+            while start < end:
+                index = start // block_size
+                missing = min(end, (index + 1) * block_size) - start
+                counts[index] -= missing
+                start += missing
+        return counts
+
+    def __count_block_bytes(self, transfer, offset, length):
+        """Adds received bytes to the blocks they belong to, returns the indices of the blocks they completed"""
+        block_size = transfer.block_size
+        end = offset + length
+        completed_blocks = []
+        while offset < end:
+            index = offset // block_size
+            count = min(end, (index + 1) * block_size) - offset
+            transfer.block_received[index] += count
+            if transfer.block_received[index] == self.__block_length(transfer, index):
+                completed_blocks.append(index)
+            offset += count
+        return completed_blocks
+
+    async def __verify_blocks(self, uuid, indices):
+        """Checks received blocks against the manifest, the corrupted ones are reopened and their byte ranges returned"""
+        transfer = self.__transfers[uuid]
+        transfer.verifying += 1
+        try:
+            block_hashes = await self.__loop.run_in_executor(None, hash_blocks, transfer.source, indices, transfer.block_size)
+        finally:
+            transfer.verifying -= 1
+
+        bad_ranges = []
+        for index, block_hash in zip(indices, block_hashes):
+            if block_hash == transfer.leaves[index]:
+                transfer.verified_blocks.add(index)
+                continue
+
+            transfer.repairs[index] = transfer.repairs.get(index, 0) + 1
+            if transfer.repairs[index] > 3:
+                raise ValueError(f"Block {index} of {transfer.file_name} was still corrupted after 3 retransmissions")
+
+            offset, length = index * transfer.block_size, self.__block_length(transfer, index)
+            self.__reopen_hole(transfer.holes, offset, length)
+            transfer.block_received[index] = 0
+            transfer.verified_blocks.discard(index)
+            transfer.transferred -= length
+            bad_ranges.append((offset, length))
+
+        if bad_ranges and transfer.status == self.__control_flags.TRANSFER_FINISH:
+            self.__set_status(uuid, self.__control_flags.TRANSFER_ACCEPT)
+        return bad_ranges
+
+    async def __verify_received_blocks(self, uuid):
+        """Verifies every completed block that wasn't yet, like the ones completed before the manifest was known"""
+        transfer = self.__transfers[uuid]
+        indices = [index for index, count in enumerate(transfer.block_received)
+                   if count == self.__block_length(transfer, index) and index not in transfer.verified_blocks]
+        return await self.__verify_blocks(uuid, indices)
+
+    async def __repair_blocks(self, uuid, bad_ranges):
+        if bad_ranges and self.__transfers[uuid].streamed:
+            raise ValueError(f"{self.__transfers[uuid].file_name} was corrupted, and it can't be sent again, its source can only be read once")
+        for offset, length in bad_ranges:
+            repair_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_REPAIR, {"offset": offset, "length": length})
+            await self.__send_packet(uuid, repair_packet)
+
+    def __split_holes(self, holes, streams):
+        """Returns one list of (offset, length) ranges per stream, sharing the missing bytes evenly between them"""
+        total = sum(end - start for start, end in holes)
+        if total == 0:
+            return []
+        share = -(-total // streams)
+
+        ranges_per_stream = [[]]
+        remaining_share = share
+        for start, end in holes:
+            while start < end:
+                if remaining_share == 0:
+                    ranges_per_stream.append([])
+                    remaining_share = share
+                length = min(end - start, remaining_share)
+                ranges_per_stream[-1].append((start, length))
+                start += length
+                remaining_share -= length
+        return ranges_per_stream
+
+    async def __checkpoint_inbound(self, uuid):
+        """Makes the received bytes durable and records which byte ranges are still missing, so the transfer can be resumed"""
+        transfer = self.__transfers[uuid]
+        holes = [list(hole) for hole in transfer.holes]
+        file_handle = transfer.file_handle
+
+        async with self.__records_lock:
+            if self.__is_over(uuid) and transfer.status != self.__control_flags.TRANSFER_BROKEN:
+                return
+            if file_handle is not None and not file_handle.closed:
+                # Queued behind the writes of every received byte
+                try:
+                    await self.__disk_writer.submit(self.__sync_destination, file_handle.fileno(), transfer.file_size)
+                except (OSError, ValueError):
+                    if not file_handle.closed:
+                        raise
+
+            self.__partial_transfers[str(uuid)] = {
+                "ip": transfer.ip,
+                "file_name": transfer.file_name,
+                "file_size": transfer.file_size,
+                "hash": transfer.hash,
+                "leaves": transfer.leaves,
+                "block_size": transfer.block_size,
+                "codec": transfer.codec,
+                "files": [[relative_path, size] for relative_path, _, size in transfer.files] if transfer.files is not None else None,
+                "path": transfer.path,
+                "replaces": transfer.replaces,
+                "holes": holes
+            }
+            await self.__loop.run_in_executor(None, save_json, self.__records_path, dict(self.__partial_transfers))
+
+    async def __forget_partial_transfer(self, uuid):
+        async with self.__records_lock:
+            if self.__partial_transfers.pop(str(uuid), None) is not None:
+                await self.__loop.run_in_executor(None, save_json, self.__records_path, dict(self.__partial_transfers))
+
+    async def __break_inbound(self, uuid):
+        """Tears down every connection of an inbound transfer while keeping what was received, so the sender can reattach"""
+        transfer = self.__transfers[uuid]
+        if self.__is_over(uuid):
+            return
+        self.__set_status(uuid, self.__control_flags.TRANSFER_BROKEN)
+        self.__close_stripes(uuid)
+        self.__close_datagrams(uuid)
+        self.__release_connection(uuid)
+        if transfer.path:
+            await self.__checkpoint_inbound(uuid)
+            self.__close_destination(uuid)
+
+    async def __reattach_inbound(self, connection, addr, uuid, request):
+        """Returns the byte ranges the receiver still misses, or None if the transfer can't be resumed"""
+        transfer = self.__transfers.get(uuid)
+        if transfer is None:
+            record = self.__partial_transfers.get(str(uuid))
+            if record is None:
+                return None
+            self.__add_transfer(uuid, record["ip"], record["file_name"], record["file_size"], record["hash"], False, connection, file_path=record["path"])
+            transfer = self.__transfers[uuid]
+            transfer.holes = record["holes"]
+            transfer.leaves = record["leaves"]
+            transfer.block_size = record["block_size"]
+            transfer.codec = record["codec"]
+            transfer.files = self.__layout_files(record["files"]) if record["files"] is not None else None
+            transfer.replaces = record.get("replaces")
+            self.__set_status(uuid, self.__control_flags.TRANSFER_BROKEN)
+
+        if transfer.is_outbound or transfer.streamed or transfer.ip != addr[0]:
+            return None
+        if transfer.file_size != request["file_size"]:
+            return None
+        if transfer.hash is not None and request["hash"] is not None and transfer.hash != request["hash"]:
+            return None
+        old_connection = transfer.connection
+        if transfer.status in (self.__control_flags.TRANSFER_ACCEPT, self.__control_flags.TRANSFER_PAUSE, self.__control_flags.TRANSFER_RESUME):
+            # The sender noticed a failure this side didn't, like a half open connection
+            await self.__break_inbound(uuid)
+        if old_connection is not connection and not old_connection.transfers:
+            # Every transfer on it was reattached elsewhere
+            self.__drop_connection(old_connection)
+        is_unverified = transfer.status == self.__control_flags.TRANSFER_FINISH and transfer.verified is None
+        if transfer.status != self.__control_flags.TRANSFER_BROKEN and not is_unverified:
+            return None
+        if transfer.pending_writes:
+            await asyncio.gather(*transfer.pending_writes, return_exceptions=True)
+
+        if transfer.hash is None:
+            # The sender finished hashing while the connection was down
+            transfer.hash = request["hash"]
+            transfer.leaves = request["leaves"]
+        # Counted anew, chunks of the torn down connections may have been counted twice
+        transfer.block_received = self.__count_received_blocks(transfer)
+
+        self.__attach_to_connection(uuid, connection)
+        transfer.transferred = transfer.file_size - sum(end - start for start, end in transfer.holes)
+        await self.__loop.run_in_executor(None, self.__open_destination, uuid, transfer.path, True)
+        if transfer.leaves is not None:
+            await self.__verify_received_blocks(uuid)
+        transfer.checkpointed = transfer.transferred
+        self.__set_status(uuid, self.__control_flags.TRANSFER_ACCEPT)
+        self.__transfers.watch(uuid)
+        return transfer.holes
+
+    def __attach_stripe(self, connected_socket, addr, uuid):
+        """Registers an extra connection of a striped transfer, returns False if it doesn't belong to one"""
+        transfer = self.__transfers.get(uuid)
+        if transfer is None or transfer.is_outbound or transfer.ip != addr[0]:
+            return False
+        if transfer.status not in (self.__control_flags.TRANSFER_ACCEPT, self.__control_flags.TRANSFER_PAUSE, self.__control_flags.TRANSFER_RESUME):
+            return False
+        transfer.stripe_sockets.append(connected_socket)
+        return True
+
+    def __close_stripes(self, uuid):
+        for stripe_socket in self.__transfers[uuid].stripe_sockets:
+            self.__close_socket(stripe_socket)
+        self.__transfers[uuid].stripe_sockets = []
+
+    def __close_datagrams(self, uuid):
+        transfer = self.__transfers[uuid]
+        if transfer.datagrams is not None:
+            transfer.datagrams.close()
+            transfer.datagrams = None
+
+    def __is_over(self, uuid):
+        return uuid in self.__transfers and self.__transfers[uuid].status in (
+            self.__control_flags.TRANSFER_FINISH,
+            self.__control_flags.TRANSFER_CANCEL,
+            self.__control_flags.TRANSFER_BROKEN,
+            self.__control_flags.TRANSFER_REJECT)
+
+    def __set_status(self, uuid, status):
+        """Changes the status of a transfer and wakes up its senders, so they notice pauses ending and cancellations"""
+        self.__transfers.set_status(uuid, status, self.__loop.time())
+        if status != self.__control_flags.TRANSFER_PAUSE:
+            self.__transfers[uuid].resume_event.set()
+        self.__metrics.set_paused(uuid, status == self.__control_flags.TRANSFER_PAUSE, self.__loop.time())
+        self.__transfers_changed.set()
+
+    def __is_stale_packet(self, packet_type, uuid):
+        """Checks whether a packet belongs to a transfer that already ended, like file data that was in flight when it was cancelled"""
+        transfer = self.__transfers.get(uuid)
+        if packet_type == self.__control_flags.TRANSFER_REQUEST:
+            return transfer is not None
+        if packet_type == self.__control_flags.TRANSFER_REATTACH:
+            return False
+        if transfer is None:
+            return True
+        if packet_type == self.__control_flags.TRANSFER_DIGEST:
+            # A completely received file waits for its digest in the finished status
+            return transfer.status in (self.__control_flags.TRANSFER_CANCEL, self.__control_flags.TRANSFER_BROKEN, self.__control_flags.TRANSFER_REJECT)
+        return self.__is_over(uuid)
+
+    def __notify_reply(self, uuid):
+        """Wakes up the request or the reattach waiting for the reply of the receiver, once that reply was handled"""
+        reply = self.__transfers[uuid].reply if uuid in self.__transfers else None
+        if reply is not None and not reply.done():
+            reply.set_result(self.__transfers[uuid].status)
+
+    async def __handle_incoming_messages(self, connection, addr):
         """A generic function for handling the reception of all types of packets"""
+        connected_socket = connection.socket
+        transfer_uuid = None
+        byte_ranges = {}
+        is_stripe = False
         try:
-            transfer_uuid = None
+            header_buffer = bytearray(1 + 16 + 4)
+            scratch_buffer = bytearray()
             while True:
-                packet_type, transfer_uuid, packet_payload = self.__decode_packet(connected_socket)
-                if packet_type == self.__control_flags.TRANSFER_REQUEST:
-
-                    self.__add_transfer(transfer_uuid, addr[0], packet_payload["file_name"], packet_payload["file_size"], packet_payload["hash"], False, connected_socket)
-
-                    self.presenter.present_incoming_transfer_request(self.__transfers[transfer_uuid])
-                
-                if packet_type == self.__control_flags.TRANSFER_PACKET:
-                    self.__transfers[transfer_uuid]["file_handle"].write(packet_payload)
-                    self.__transfers[transfer_uuid]["transferred"] += len(packet_payload)
-                    
-                    if self.__transfers[transfer_uuid]["transferred"] == self.__transfers[transfer_uuid]["file_size"]:
-                        finish_packet = self.__create_transfer_control_packet(transfer_uuid, self.__control_flags.TRANSFER_FINISH)
-                        connected_socket.send(finish_packet)
-                        self.__transfers[transfer_uuid]["status"] = self.__control_flags.TRANSFER_FINISH
-                        self.__transfers[transfer_uuid]["file_handle"].close()
-                        break
-
-                if packet_type == self.__control_flags.TRANSFER_REJECT:
-                    connected_socket.close()
-                    break
+                packet_type, transfer_uuid, packet_payload = await self.__decode_packet(connected_socket, header_buffer)
+                if self.__is_stale_packet(packet_type, transfer_uuid):
+                    if packet_type == self.__control_flags.TRANSFER_PACKET:
+                        await self.__receive_into_scratch(connected_socket, packet_payload, scratch_buffer)
+                    continue
 
-                if packet_type == self.__control_flags.TRANSFER_PAUSE:
-                    self.__transfers[transfer_uuid]["status"] = self.__control_flags.TRANSFER_PAUSE
+                try:
+                    if packet_type == self.__control_flags.TRANSFER_REQUEST:
+                        files = self.__layout_files(packet_payload["files"]) if packet_payload.get("files") is not None else None
+                        relative_paths = [packet_payload["file_name"]] + [relative_path for relative_path, _, _ in files or []]
+                        if "/" in packet_payload["file_name"] or not all(self.__is_safe_relative_path(relative_path) for relative_path in relative_paths):
+                            raise ValueError("The transfer request names files outside of the directory it would be received into")
+                        is_stream = packet_payload["file_size"] is None
+                        if is_stream and (files is not None or packet_payload["leaves"] is not None):
+                            raise ValueError("A stream of unknown size can't have a manifest yet")
+                        if files is not None and sum(size for _, _, size in files) != packet_payload["file_size"]:
+                            raise ValueError("The sizes in the manifest of the batch don't add up to its size")
+                        if not is_stream:
+                            self.__check_leaves(packet_payload["leaves"], packet_payload["file_size"], packet_payload["block_size"])
 
-                if packet_type == self.__control_flags.TRANSFER_RESUME:
-                    self.__transfers[transfer_uuid]["status"] = self.__control_flags.TRANSFER_RESUME
-                    if self.__transfers[transfer_uuid]["is_outbound"]:
-                        with self.__transfers[transfer_uuid]["pause_condition"]:
-                            self.__transfers[transfer_uuid]["pause_condition"].notify()
+                        if self.__path_tuner is not None and isinstance(packet_payload.get("path"), dict):
+                            # Only the sender measured the path yet
+                            self.__path_tuner.path(addr[0]).observe_peer(packet_payload["path"].get("rtt"), packet_payload["path"].get("rate"))
+                            self.__path_tuner.tune(connected_socket, addr[0])
+                        self.__add_transfer(transfer_uuid, addr[0], packet_payload["file_name"], packet_payload["file_size"] or 0, packet_payload["hash"], False, connection,
+                                            streams=packet_payload.get("streams", 1))
+                        self.__transfers[transfer_uuid].leaves = packet_payload["leaves"]
+                        self.__transfers[transfer_uuid].block_size = packet_payload["block_size"]
+                        self.__transfers[transfer_uuid].codecs = packet_payload.get("codecs", [])
+                        self.__transfers[transfer_uuid].files = files
+                        self.__transfers[transfer_uuid].delta = packet_payload.get("delta", False)
+                        self.__transfers[transfer_uuid].transport = "udp" if packet_payload.get("transport") == "udp" else "tcp"
+                        if is_stream:
+                            # It ends where the sender's digest says, until then it can be any size
+                            self.__transfers[transfer_uuid].streamed = True
+                            self.__transfers[transfer_uuid].holes = [[0, math.inf]]
+                            self.__transfers[transfer_uuid].delta = False
+                            self.__transfers[transfer_uuid].transport = "tcp"
 
-                if packet_type == self.__control_flags.TRANSFER_CANCEL:
-                    self.__transfers[transfer_uuid]["status"] = self.__control_flags.TRANSFER_CANCEL
-                    self.__transfers[transfer_uuid]["file_handle"].close()
-                    self.__transfers[transfer_uuid]["socket"].close()
-                    break
+                        await self.__decide_request(transfer_uuid)
 
-                if packet_type == self.__control_flags.TRANSFER_FINISH:
-                    self.__transfers[transfer_uuid]["status"] = self.__control_flags.TRANSFER_FINISH
-                    self.__transfers[transfer_uuid]["socket"].close()
-                    self.__transfers[transfer_uuid]["file_handle"].close()
-                    break
-                if packet_type == self.__control_flags.TRANSFER_BROKEN:
-                    self.__transfers[transfer_uuid]["status"] = self.__control_flags.TRANSFER_BROKEN
-                    self.__transfers[transfer_uuid]["file_handle"].close()
-                    self.__transfers[transfer_uuid]["socket"].close()
-                    break
+                    if packet_type == self.__control_flags.TRANSFER_RANGE:
+                        if self.__transfers[transfer_uuid].socket is not connected_socket:
+                            if not self.__attach_stripe(connected_socket, addr, transfer_uuid):
+                                self.__close_socket(connected_socket)
+                                return
+                            is_stripe = True
+
+                        offset = packet_payload["offset"]
+                        end = offset + packet_payload["length"]
+                        if offset < 0 or end > self.__transfers[transfer_uuid].file_size:
+                            raise ValueError("Announced byte range is outside of the file")
+                        self.__open_hole(self.__transfers[transfer_uuid].holes, offset, packet_payload["length"])
+                        byte_ranges[transfer_uuid] = [offset, end]
+
+                    if packet_type == self.__control_flags.TRANSFER_REATTACH:
+                        holes = await self.__reattach_inbound(connection, addr, transfer_uuid, packet_payload)
+                        if holes is None:
+                            transfer = self.__transfers.get(transfer_uuid)
+                            is_finished = transfer is not None and transfer.ip == addr[0] and transfer.status == self.__control_flags.TRANSFER_FINISH
+                            reply_type = self.__control_flags.TRANSFER_FINISH if is_finished else self.__control_flags.TRANSFER_REJECT
+                            async with connection.turn():
+                                await self.__loop.sock_sendall(connected_socket, self.__create_transfer_control_packet(transfer_uuid, reply_type))
+                            continue
+
+                        self.__transfers[transfer_uuid].uncredited = 0
+                        accept_payload = {"holes": holes, "credit": self.credit_window}
+                        self.__choose_transport(transfer_uuid, packet_payload.get("transport"), accept_payload)
+                        accept_packet = self.__create_transfer_control_packet(transfer_uuid, self.__control_flags.TRANSFER_ACCEPT, accept_payload)
+                        await self.__send_packet(transfer_uuid, accept_packet)
+                        if not holes:
+                            # The connection broke before the sender's digest arrived
+                            self.__set_status(transfer_uuid, self.__control_flags.TRANSFER_FINISH)
+                            await self.__finish_inbound(transfer_uuid)
+
+                    if packet_type == self.__control_flags.TRANSFER_ACCEPT:
+                        if self.__transfers[transfer_uuid].reply is not None:
+                            self.__start_sending(transfer_uuid, packet_payload or {})
+
+                    if packet_type == self.__control_flags.TRANSFER_PACKET:
+                        if transfer_uuid not in byte_ranges:
+                            byte_ranges[transfer_uuid] = list(self.__transfers[transfer_uuid].holes[0])
+
+                        await self.__receive_file_data(connected_socket, transfer_uuid, packet_payload, byte_ranges[transfer_uuid], scratch_buffer)
+
+                    if packet_type == self.__control_flags.TRANSFER_COMPRESSED:
+                        if transfer_uuid not in byte_ranges:
+                            byte_ranges[transfer_uuid] = list(self.__transfers[transfer_uuid].holes[0])
+
+                        await self.__receive_compressed_file_data(transfer_uuid, packet_payload, byte_ranges[transfer_uuid])
+
+                    if packet_type == self.__control_flags.TRANSFER_COPY:
+                        self.__copy_from_basis(transfer_uuid, packet_payload["copies"])
+
+                    if packet_type == self.__control_flags.TRANSFER_DIGEST:
+                        transfer = self.__transfers[transfer_uuid]
+                        if transfer.streamed and transfer.leaves is None:
+                            self.__end_stream(transfer, packet_payload.get("file_size"), byte_ranges.get(transfer_uuid, [0, math.inf]))
+                        self.__check_leaves(packet_payload["leaves"], transfer.file_size, transfer.block_size)
+                        transfer.hash = packet_payload["hash"]
+                        transfer.leaves = packet_payload["leaves"]
+                        await self.__repair_blocks(transfer_uuid, await self.__verify_received_blocks(transfer_uuid))
+                        is_complete = transfer.transferred == transfer.file_size and transfer.verifying == 0
+                        if is_complete and transfer.verified is None and transfer.status not in (self.__control_flags.TRANSFER_CANCEL, self.__control_flags.TRANSFER_BROKEN):
+                            # The last bytes may have landed during the verification
+                            self.__set_status(transfer_uuid, self.__control_flags.TRANSFER_FINISH)
+                            await self.__finish_inbound(transfer_uuid)
+
+                    if packet_type == self.__control_flags.TRANSFER_REPAIR:
+                        transfer = self.__transfers[transfer_uuid]
+                        if transfer.streamed:
+                            raise ValueError("A corrupted block can't be sent again, the source can only be read once")
+                        # Sent over a connection of its own, so it doesn't interrupt the current byte range
+                        transfer.transferred -= packet_payload["length"]
+                        self.__reopen_hole(transfer.holes, packet_payload["offset"], packet_payload["length"])
+                        self.__spawn(self.__transfer_stripe(transfer_uuid, [(packet_payload["offset"], packet_payload["length"])]))
+
+                    if packet_type == self.__control_flags.TRANSFER_REJECT:
+                        self.__set_status(transfer_uuid, self.__control_flags.TRANSFER_REJECT)
+                        self.__release_transfer(transfer_uuid)
+
+                    if packet_type == self.__control_flags.TRANSFER_PAUSE:
+                        self.__set_status(transfer_uuid, self.__control_flags.TRANSFER_PAUSE)
+
+                    if packet_type == self.__control_flags.TRANSFER_RESUME:
+                        self.__set_status(transfer_uuid, self.__control_flags.TRANSFER_RESUME)
+                        await self.__grant_credit(transfer_uuid)
+
+                    if packet_type == self.__control_flags.TRANSFER_CREDIT:
+                        transfer = self.__transfers[transfer_uuid]
+                        if transfer.credit is not None:
+                            transfer.credit += packet_payload["bytes"]
+                            transfer.resume_event.set()
+
+                    if packet_type == self.__control_flags.TRANSFER_CANCEL:
+                        self.__set_status(transfer_uuid, self.__control_flags.TRANSFER_CANCEL)
+                        self.__release_transfer(transfer_uuid)
+                        await self.__forget_partial_transfer(transfer_uuid)
+
+                    if packet_type == self.__control_flags.TRANSFER_FINISH:
+                        if packet_payload:
+                            self.__transfers[transfer_uuid].verified = packet_payload["verified"]
+                        if packet_payload and packet_payload.get("local"):
+                            # The receiver already had the content
+                            self.__transfers[transfer_uuid].transferred = self.__transfers[transfer_uuid].file_size
+                        self.__set_status(transfer_uuid, self.__control_flags.TRANSFER_FINISH)
+                        self.__release_transfer(transfer_uuid)
+
+                    if packet_type == self.__control_flags.TRANSFER_BROKEN:
+                        self.__set_status(transfer_uuid, self.__control_flags.TRANSFER_BROKEN)
+                        self.__release_transfer(transfer_uuid)
+
+                except Exception as e:
+                    if is_stripe or isinstance(e, OSError):
+                        raise
+                    # Only this transfer failed, the connection keeps being read
+                    if transfer_uuid in self.__transfers:
+                        await self.__handle_exceptions(connected_socket, transfer_uuid, e)
+                    else:
+                        # The request was refused before it became a transfer
+                        self.presenter.exception_happened(e)
+                        async with connection.turn():
+                            await self.__loop.sock_sendall(connected_socket, self.__create_transfer_control_packet(transfer_uuid, self.__control_flags.TRANSFER_BROKEN))
+
+                if packet_type in (self.__control_flags.TRANSFER_ACCEPT, self.__control_flags.TRANSFER_REJECT, self.__control_flags.TRANSFER_FINISH, self.__control_flags.TRANSFER_BROKEN):
+                    self.__notify_reply(transfer_uuid)
 
         except Exception as e:
-            self.__handle_exceptions(connected_socket, transfer_uuid, e)
+            if is_stripe and isinstance(e, ConnectionError):
+                # The sender closes a stripe once it sent its byte ranges
+                self.__close_socket(connected_socket)
+                return
+
+            # The connection itself failed, so every transfer still sharing it did
+            self.__drop_connection(connection)
+            failed_transfers = [transfer_uuid] if is_stripe else list(connection.transfers)
+            if not failed_transfers and not isinstance(e, OSError):
+                self.presenter.exception_happened(e)
+            for uuid in failed_transfers:
+                await self.__handle_connection_failure(connected_socket, uuid, e)
+
+    async def __finish_inbound(self, uuid):
+        """Checks the manifest of a completely received file against its root hash and tells the sender the result"""
+        transfer = self.__transfers[uuid]
+        if transfer.leaves is None:
+            return
+        block_count = -(-transfer.file_size // transfer.block_size)
+        unverified = [index for index in range(block_count) if index not in transfer.verified_blocks]
+        if unverified:
+            # Blocks whose bytes weren't all counted, like around a reattach
+            bad_ranges = await self.__verify_blocks(uuid, unverified)
+            if bad_ranges:
+                await self.__repair_blocks(uuid, bad_ranges)
+                return
+
+        closed = self.__close_destination(uuid, sync=True)
+        if closed is not None:
+            await closed
+        # Only blocks hashed here vouch for the file, the manifest comes from the sender
+        transfer.verified = len(transfer.leaves) == block_count == len(transfer.verified_blocks) and merkle_root(transfer.leaves) == transfer.hash
+        if transfer.replaces is not None:
+            replaces, transfer.replaces = transfer.replaces, None
+            await self.__loop.run_in_executor(None, self.__replace_older_copy, transfer.path, replaces, transfer.verified)
+            if transfer.verified:
+                transfer.path = replaces
+        if transfer.verified and transfer.files is None:
+            await self.__loop.run_in_executor(None, self.__content_index.add, transfer.path, transfer.hash, transfer.block_size, transfer.file_size)
+
+        finish_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_FINISH, {"verified": transfer.verified})
+        await self.__send_packet(uuid, finish_packet)
+        self.__close_stripes(uuid)
+        self.__close_datagrams(uuid)
+        self.__release_connection(uuid)
+        self.__remember_paths()
+        await self.__forget_partial_transfer(uuid)
+
+    def __replace_older_copy(self, file_path, older_path, verified):
+        """Swaps a file rebuilt from an older copy in for it at once, a file that failed verification is deleted instead"""
+        if verified:
+            os.replace(file_path, older_path)
+        else:
+            os.remove(file_path)
+
+    async def __handle_connection_failure(self, connected_socket, uuid, e):
+        """Decides whether a failed connection ends its transfer, or whether the transfer is kept to be resumed"""
+        if isinstance(e, TransferDetached):
+            # A sender from before the transfer was reattached
+            return
+        transfer = self.__transfers.get(uuid)
+        if transfer is None:
+            await self.__handle_exceptions(connected_socket, uuid, e)
+            return
 
-    def __create_file_info_header_packet(self, file_path):
-        """Returns the header, uuid, file_name, file_size, hash"""
-        file_name = basename(file_path)
-        file_size = getsize(file_path)
-        file_hash = sha1_chunks(file_path)
+        is_current = not transfer.reattaching and (connected_socket is transfer.socket or connected_socket in transfer.stripe_sockets)
+        if self.__is_over(uuid) or not is_current:
+            # The transfer ended or moved, this connection was torn down with it
+            if not transfer.is_outbound and self.__is_over(uuid):
+                self.__close_destination(uuid)
+            return
+
+        if isinstance(e, OSError) and transfer.resumable:
+            if transfer.is_outbound:
+                await self.__reattach_outbound(uuid)
+            else:
+                await self.__break_inbound(uuid)
+            return
+
+        await self.__handle_exceptions(connected_socket, uuid, e)
+
+    def __describe_source(self, file_path, pipelined_hash=False, cached_leaves=None):
+        """Returns the file_name, file_size, hash, leaves, files of a file or a directory to send"""
+        file_name = basename(normpath(file_path))
+        files = None
+        if isdir(file_path):
+            # The hash cache works per file, a batch is hashed as one stream
+            files = walk_files(file_path)
+            file_size = sum(size for _, size in files)
+            leaves = None if pipelined_hash else merkle_leaves(self.__batch_source(file_path, self.__layout_files(files)))
+        elif self.__is_stream(file_path):
+            # Like a pipe or a device, its size and hashes are only known once it was read to its end
+            file_size, leaves = None, None
+        else:
+            file_size = getsize(file_path)
+            leaves = cached_leaves
+            if leaves is None and not pipelined_hash:
+                leaves = self.__hash_cache.get(file_path, "merkle", merkle_leaves)
+        file_hash = merkle_root(leaves) if leaves is not None else None
+        return file_name, file_size, file_hash, leaves, files
+
+    def __is_stream(self, file_path):
+        file_mode = os.stat(file_path).st_mode
+        return not stat.S_ISDIR(file_mode) and not stat.S_ISREG(file_mode)
+
+    def __create_file_info_header_packet(self, description, streams=1, compress=False, delta=False, transport="tcp", path=None):
+        """Returns the header and the uuid of a request to send what __describe_source described, path is the estimate of the path to the peer"""
+        file_name, file_size, file_hash, leaves, files = description
 
         # | 1 B packet type | 16 B UUID | 4 B (uint) payload length | = Header 133 BYTES
 
         data = {
             "file_name": file_name,
             "file_size": file_size,
-            "hash": file_hash
+            "hash": file_hash,
+            "leaves": leaves,
+            "block_size": MERKLE_BLOCK_SIZE,
+            "streams": streams,
+            "codecs": get_compression_codecs() if compress else [],
+            "delta": delta and files is None,
+            "transport": transport,
+            "files": files,
+            "path": path
         }
 
         uuid = uuid4()
@@ -161,169 +1114,784 @@ class Model:
         data = json.dumps(data).encode("utf-8")
         header = struct.pack("!B16sI", self.__control_flags.TRANSFER_REQUEST.value, uuid.bytes, len(data)) + data
 
-        return header, uuid, file_name, file_size, file_hash
+        return header, uuid
 
     def __create_transfer_packet_header(self, uuid, payload_length):
         # | 1 B packet type | 16 B UUID | 4 B (uint) payload length | = Header 133 BYTES
 
         header = struct.pack("!B16sI", self.__control_flags.TRANSFER_PACKET.value, uuid.bytes, payload_length)
         return header
-    
-    def __handle_exceptions(self, socket, uuid, e):
+
+    async def __handle_exceptions(self, socket, uuid, e):
         try:
             self.presenter.exception_happened(e)
-            broken_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_BROKEN)
-            socket.send(broken_packet)
+            if uuid in self.__transfers:
+                self.__set_status(uuid, self.__control_flags.TRANSFER_BROKEN)
+                self.__release_transfer(uuid)
+                # The other side reads control packets from the main connection
+                broken_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_BROKEN)
+                await self.__send_packet(uuid, broken_packet)
         except:
-            socket.close()
+            if socket is not None:
+                self.__close_socket(socket)
+
+    async def __send_packet(self, uuid, packet):
+        """Sends a whole packet, so that control packets never interleave with file data"""
+        if self.__transfers[uuid].reattaching:
+            # The status change stays local until the transfer is reattached
+            return
+        async with self.__transfers[uuid].send_lock:
+            await self.__loop.sock_sendall(self.__transfers[uuid].socket, packet)
+
+    def __is_waiting(self, transfer):
+        if transfer.status == self.__control_flags.TRANSFER_PAUSE:
+            return True
+        # The last chunk may overdraw the credit, so a small window can't stall the transfer
+        return transfer.credit is not None and transfer.credit <= 0 and transfer.status not in (self.__control_flags.TRANSFER_CANCEL, self.__control_flags.TRANSFER_BROKEN)
+
+    async def __should_keep_sending(self, uuid):
+        """Waits while the transfer is paused or out of credit, returns False once it was cancelled or broken"""
+        while self.__is_waiting(self.__transfers[uuid]):
+            self.__transfers[uuid].resume_event.clear()
+            await self.__transfers[uuid].resume_event.wait()
+
+        if self.__transfers[uuid].status == self.__control_flags.TRANSFER_CANCEL:
+            return False
+
+        if self.__transfers[uuid].status == self.__control_flags.TRANSFER_BROKEN:
+            return False
+
+        return True
+
+    def __spend_credit(self, uuid, count):
+        transfer = self.__transfers[uuid]
+        if transfer.credit is not None:
+            transfer.credit -= count
+
+    def __chunk_size(self, uuid):
+        """Returns how much file data goes into the next packet of the transfer, by the rate of the path to its peer"""
+        transfer = self.__transfers[uuid]
+        if self.__path_tuner is None or transfer.shared_reader is not None:
+            return self.chunk_size
+        return self.__path_tuner.path(transfer.ip).chunk_size(self.chunk_size)
+
+    def __observe_bytes(self, uuid, count):
+        """Counts sent or received bytes towards the rate of the path to the peer, its connections are tuned anew whenever it was sampled"""
+        if self.__path_tuner is None:
+            return
+        transfer = self.__transfers[uuid]
+        path = self.__path_tuner.path(transfer.ip)
+        if not path.observe_bytes(count, self.__loop.time()):
+            return
+        for connected_socket in (transfer.socket, *transfer.stripe_sockets):
+            if connected_socket is not None:
+                path.observe_rtt(measure_rtt(connected_socket))
+                self.__path_tuner.tune(connected_socket, transfer.ip)
+
+    async def __account_sent(self, uuid, offset, count):
+        """Counts a sent chunk towards the transfer, then yields to the other connections"""
+        self.__spend_credit(uuid, count)
+        self.__fill_hole(self.__transfers[uuid].holes, offset, count)
+        self.__transfers[uuid].transferred += count
+        self.__metrics.count_bytes("outbound", count)
+        self.__observe_bytes(uuid, count)
+        # Sends into a socket buffer with room complete without suspending
+        await asyncio.sleep(0)
+
+    async def __send_file_zero_copy(self, connected_socket, uuid, file, offset, length, send_lock):
+        """Sends every chunk header followed by the chunk itself straight from the page cache with sendfile"""
+        end = offset + length
+
+        while offset < end:
+            if not await self.__should_keep_sending(uuid):
+                break
+
+            count = min(self.__chunk_size(uuid), end - offset)
+            header = self.__create_transfer_packet_header(uuid, count)
+
+            await self.__rate_limiter.acquire(uuid, len(header) + count)
+            async with send_lock:
+                await self.__loop.sock_sendall(connected_socket, header)
+                sent = await self.__loop.sock_sendfile(connected_socket, file, offset, count)
+
+            if sent != count:
+                raise ConnectionError("File was truncated while it was being sent")
+
+            await self.__account_sent(uuid, offset, sent)
+            offset += sent
 
-    def __transfer_file(self, connected_socket, uuid):
+    async def __send_ranges(self, connected_socket, uuid, file, ranges, send_lock):
+        """Announces every byte range on the connection and sends it"""
+        transfer = self.__transfers[uuid]
+        for offset, length in ranges:
+            self.__open_hole(transfer.holes, offset, length)
+            range_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_RANGE, {"offset": offset, "length": length})
+            async with send_lock:
+                await self.__loop.sock_sendall(connected_socket, range_packet)
+            if transfer.codec is not None or transfer.files is not None or transfer.shared_reader is not None:
+                await self.__send_file_compressed(connected_socket, uuid, file, offset, length, send_lock)
+            else:
+                await self.__send_file_zero_copy(connected_socket, uuid, file, offset, length, send_lock)
+
+    def __read_chunk(self, uuid, file, offset, count):
+        """Reads a chunk of the file, or of the files of a batch without one, the transfers of a fan-out share what they read"""
+        shared_reader = self.__transfers[uuid].shared_reader
+        if shared_reader is not None:
+            chunk = shared_reader.read(offset, count)
+        elif file is None:
+            chunk = read_span(self.__transfers[uuid].source, offset, count)
+        else:
+            chunk = os.pread(file.fileno(), count, offset)
+        if len(chunk) != count:
+            raise ConnectionError("File was truncated while it was being sent")
+        return chunk
+
+    def __create_compressed_packet(self, uuid, file, offset, count, try_compressing):
+        """Reads a chunk and returns it as a TRANSFER_COMPRESSED packet, or as a TRANSFER_PACKET if it doesn't compress"""
+        chunk = self.__read_chunk(uuid, file, offset, count)
+
+        if try_compressing and self.__transfers[uuid].codec is not None:
+            compressed_chunk = compress_chunk(self.__transfers[uuid].codec, chunk)
+            # Saving less than an eighth isn't worth decompressing for
+            if len(compressed_chunk) + 4 <= count - count // 8:
+                payload = struct.pack("!I", count) + compressed_chunk
+                return struct.pack("!B16sI", self.__control_flags.TRANSFER_COMPRESSED.value, uuid.bytes, len(payload)) + payload
+
+        return self.__create_transfer_packet_header(uuid, count) + chunk
+
+    async def __send_file_compressed(self, connected_socket, uuid, file, offset, length, send_lock):
+        """Sends every chunk compressed with the negotiated codec, reading the next one while one is being sent"""
+        end = offset + length
+        raw_streak = 0
+
+        count = min(self.__chunk_size(uuid), end - offset)
+        next_packet = self.__loop.run_in_executor(None, self.__create_compressed_packet, uuid, file, offset, count, True)
+        try:
+            while offset < end:
+                if not await self.__should_keep_sending(uuid):
+                    break
+
+                packet = await next_packet
+                raw_streak = raw_streak + 1 if packet[0] == self.__control_flags.TRANSFER_PACKET.value else 0
+                next_count = 0
+                if offset + count < end:
+                    # Incompressible data comes in runs, so it is only probed every 8 chunks
+                    try_compressing = raw_streak == 0 or raw_streak % 8 == 0
+                    next_count = min(self.__chunk_size(uuid), end - offset - count)
+                    next_packet = self.__loop.run_in_executor(None, self.__create_compressed_packet, uuid, file, offset + count, next_count, try_compressing)
+
+                await self.__rate_limiter.acquire(uuid, len(packet))
+                async with send_lock:
+                    await self.__loop.sock_sendall(connected_socket, packet)
+
+                await self.__account_sent(uuid, offset, count)
+                offset += count
+                count = next_count
+        finally:
+            # The chunk read ahead isn't needed anymore
+            if not next_packet.cancel():
+                next_packet.exception()
+
+    async def __send_datagrams(self, uuid, file, holes):
+        """Sends the missing byte ranges over UDP, then waits until every datagram was acknowledged"""
+        transfer = self.__transfers[uuid]
+        sender = transfer.datagrams
+        try:
+            for offset, end in holes:
+                while offset < end:
+                    if not await self.__should_keep_sending(uuid):
+                        return
+
+                    count = min(self.__chunk_size(uuid), end - offset)
+                    chunk = await self.__loop.run_in_executor(None, self.__read_chunk, uuid, file, offset, count)
+                    await self.__rate_limiter.acquire(uuid, count)
+                    await sender.send(offset, chunk)
+
+                    self.__spend_credit(uuid, count)
+                    self.__fill_hole(transfer.holes, offset, count)
+                    offset += count
+                    transfer.transferred += count
+                    self.__metrics.count_bytes("outbound", count)
+                    self.__observe_bytes(uuid, count)
+            await sender.drain()
+        except DatagramTimeout:
+            # The datagrams don't get through, like past a firewall, the transfer is reattached over TCP
+            transfer.transport = "tcp"
+            raise
+        finally:
+            sender.close()
+
+    async def __send_digest(self, uuid, leaves):
+        """Sends the manifest once it is known, for a stream along with its size, which marks its end"""
+        transfer = self.__transfers[uuid]
+        transfer.leaves = leaves
+        transfer.hash = merkle_root(leaves)
+        digest = {"hash": transfer.hash, "leaves": leaves}
+        if transfer.streamed:
+            digest["file_size"] = transfer.file_size
+        await self.__send_packet(uuid, self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_DIGEST, digest))
+
+    def __read_stream(self, file, count, hasher):
+        chunk = file.read1(count)
+        hasher.update(chunk)
+        return chunk
+
+    async def __send_stream(self, connected_socket, uuid, file):
+        """Sends a source that can only be read once, like a pipe, hashing its blocks as they are read, then its digest"""
+        transfer = self.__transfers[uuid]
+        transfer.holes = []
+        leaves, hasher = [], leaf_hasher()
+        while True:
+            # Never past the end of a block, so a chunk is hashed into a single leaf
+            count = min(self.__chunk_size(uuid), transfer.block_size - transfer.file_size % transfer.block_size)
+            chunk = await self.__loop.run_in_executor(None, self.__read_stream, file, count, hasher)
+            if not chunk:
+                break
+            if not await self.__should_keep_sending(uuid):
+                return
+
+            header = self.__create_transfer_packet_header(uuid, len(chunk))
+            await self.__rate_limiter.acquire(uuid, len(header) + len(chunk))
+            async with transfer.send_lock:
+                await self.__loop.sock_sendall(connected_socket, header + chunk)
+            transfer.file_size += len(chunk)
+            if transfer.file_size % transfer.block_size == 0:
+                leaves.append(hasher.hexdigest())
+                hasher = leaf_hasher()
+            await self.__account_sent(uuid, transfer.file_size - len(chunk), len(chunk))
+
+        if transfer.file_size % transfer.block_size:
+            leaves.append(hasher.hexdigest())
+        await self.__send_digest(uuid, leaves)
+
+    async def __hash_while_sending(self, uuid):
+        """Hashes a file while sendfile sends it, both read the same pages of the page cache"""
+        transfer = self.__transfers[uuid]
+        transfer.hashing = True
+        try:
+            if transfer.files is not None:
+                leaves = await self.__loop.run_in_executor(None, merkle_leaves, transfer.source)
+            else:
+                leaves = await self.__loop.run_in_executor(None, self.__hash_cache.get, transfer.path, "merkle", merkle_leaves)
+        except Exception as e:
+            await self.__handle_exceptions(transfer.socket, uuid, e)
+            return
+        finally:
+            transfer.hashing = False
+
+        if not self.__is_over(uuid):
+            try:
+                await self.__send_digest(uuid, leaves)
+            except OSError:
+                # The hash is sent along when the transfer is reattached
+                pass
+
+    async def __transfer_stripe(self, uuid, ranges):
+        """Sends byte ranges of a striped transfer over their own connection"""
+        transfer = self.__transfers[uuid]
+        stripe_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        stripe_socket.setblocking(False)
+        transfer.stripe_sockets.append(stripe_socket)
         try:
-            chunk_size = 1024
-            with self.__transfers[uuid]["file_handle"] as file:
-                while chunk := file.read(chunk_size):
-                    if self.__transfers[uuid]["status"] == self.__control_flags.TRANSFER_CANCEL:
-                        break
-                    
-                    if self.__transfers[uuid]["status"] == self.__control_flags.TRANSFER_BROKEN:
-                        break
-
-                    if self.__transfers[uuid]["status"] == self.__control_flags.TRANSFER_PAUSE:
-                        with self.__transfers[uuid]["pause_condition"]:
-                            self.__transfers[uuid]["pause_condition"].wait()
-
-                    header = self.__create_transfer_packet_header(uuid, len(chunk))
-                    connected_socket.send(header + chunk)
-                    self.__transfers[uuid]["transferred"] += len(chunk)
+            started = self.__loop.time()
+            await self.__loop.sock_connect(stripe_socket, (transfer.ip, self.remote_port))
+            self.__tune_connection(stripe_socket, transfer.ip, self.__loop.time() - started)
+            file = await self.__loop.run_in_executor(None, open, transfer.path, "rb") if transfer.files is None else nullcontext()
+            with stripe_socket, file:
+                await self.__send_ranges(stripe_socket, uuid, file, ranges, asyncio.Lock())
         except Exception as e:
-            self.__handle_exceptions(connected_socket, uuid, e)
+            await self.__handle_connection_failure(stripe_socket, uuid, e)
 
-    def initiate_transfer(self, ip, file_path, label_index):
+    async def __send_copies(self, uuid, signatures):
+        """Tells the receiver which byte ranges it can copy from its older copy of the file, returns the ones it still lacks"""
+        transfer = self.__transfers[uuid]
+        copies = await self.__loop.run_in_executor(None, find_copies, transfer.path, signatures["block_size"], signatures["blocks"])
+        if copies and not self.__is_over(uuid):
+            copy_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_COPY, {"copies": copies})
+            await self.__send_packet(uuid, copy_packet)
+            for offset, _, length in copies:
+                self.__open_hole(transfer.holes, offset, length)
+                self.__fill_hole(transfer.holes, offset, length)
+                transfer.transferred += length
+        return [list(hole) for hole in transfer.holes]
+
+    async def __transfer_file(self, connected_socket, uuid, holes, signatures=None):
+        """Sends the missing byte ranges of the file, spread over as many connections as the transfer has streams"""
+        transfer = self.__transfers[uuid]
+        if transfer.files is None:
+            try:
+                transfer.file_handle = await self.__loop.run_in_executor(None, open, transfer.path, "rb")
+            except OSError as e:
+                # Not a failure of the connection, so the transfer isn't resumed over a new one
+                await self.__handle_exceptions(connected_socket, uuid, e)
+                return
         try:
-            sender_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sender_socket.settimeout(60)
+            with transfer.file_handle or nullcontext() as file:
+                if transfer.streamed:
+                    await self.__send_stream(connected_socket, uuid, file)
+                    return
+                transfer.resumable = True
+                if transfer.leaves is None and not transfer.hashing:
+                    self.__spawn(self.__hash_while_sending(uuid))
+                if signatures is not None:
+                    holes = await self.__send_copies(uuid, signatures)
+                if transfer.datagrams is not None:
+                    # A single flow, its congestion control replaces parallel connections
+                    await self.__send_datagrams(uuid, file, holes)
+                    return
+                ranges_per_stream = self.__split_holes(holes, transfer.streams)
+                for ranges in ranges_per_stream[1:]:
+                    self.__spawn(self.__transfer_stripe(uuid, ranges))
+
+                if ranges_per_stream:
+                    await self.__send_ranges(connected_socket, uuid, file, ranges_per_stream[0], transfer.send_lock)
+        except Exception as e:
+            await self.__handle_connection_failure(connected_socket, uuid, e)
+
+    def __start_sending(self, uuid, accept_payload):
+        """Starts sending the byte ranges the receiver accepted, either the whole file or the ones it missed when reattached"""
+        transfer = self.__transfers[uuid]
+        if "codec" in accept_payload:
+            codec = accept_payload["codec"]
+            if codec is not None and codec not in transfer.codecs:
+                raise ValueError(f"The receiver chose a compression codec that wasn't offered: {codec}")
+            transfer.codec = codec
+
+        signatures = accept_payload.get("signatures")
+        if signatures is not None and not transfer.delta:
+            raise ValueError("The receiver sent block signatures without having been offered a delta transfer")
+
+        transport = accept_payload.get("transport", "tcp")
+        if transport == "udp" and transfer.transport != "udp":
+            raise ValueError("The receiver chose UDP without having been offered it")
+        transfer.transport = transport
+
+        holes = accept_payload.get("holes", [[0, transfer.file_size]])
+        # A receiver without flow control grants no credit
+        transfer.credit = accept_payload.get("credit")
+        transfer.resume_event.set()
+        transfer.reattaching = False
+        transfer.holes = [list(hole) for hole in holes]
+        transfer.transferred = transfer.file_size - sum(end - start for start, end in holes)
+        if transport == "udp":
+            transfer.datagrams = DatagramSender(self.__datagrams, uuid, (transfer.ip, accept_payload["udp_port"]), self.datagram_size)
+
+        if transfer.status == self.__control_flags.TRANSFER_REQUEST:
+            self.__set_status(uuid, self.__control_flags.TRANSFER_ACCEPT)
+        elif transfer.status == self.__control_flags.TRANSFER_PAUSE:
+            # A reattached receiver doesn't know about the pause
+            self.__spawn(self.__send_packet(uuid, self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_PAUSE)))
+        self.__spawn(self.__transfer_file(transfer.socket, uuid, holes, signatures))
+
+    async def __reattach_outbound(self, uuid):
+        """Reconnects a broken outbound transfer and continues it from the byte ranges the receiver still misses"""
+        transfer = self.__transfers[uuid]
+        transfer.reattaching = True
+        transfer.send_lock.retire()
+        self.__release_connection(uuid)
+        self.__close_stripes(uuid)
+        self.__close_datagrams(uuid)
+
+        for delay in (1, 2, 4, 8, 16, 32):
+            await asyncio.sleep(delay)
+            if self.__is_over(uuid):
+                return
+
+            connection = None
+            transfer.reply = self.__loop.create_future()
+            try:
+                connection = await self.__connect_to_peer(transfer.ip, 10)
+                self.__attach_to_connection(uuid, connection)
+                reattach_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_REATTACH, {
+                    "file_name": transfer.file_name,
+                    "file_size": transfer.file_size,
+                    "hash": transfer.hash,
+                    "leaves": transfer.leaves,
+                    "transport": transfer.transport
+                })
+                async with transfer.send_lock:
+                    await self.__loop.sock_sendall(connection.socket, reattach_packet)
+                reply_status = await asyncio.wait_for(transfer.reply, 60)
+            except (OSError, asyncio.TimeoutError):
+                if connection is not None:
+                    # The transfers sharing it are reattached once its reader notices
+                    self.__drop_connection(connection)
+                continue
+            finally:
+                transfer.reply = None
+
+            transfer.reattaching = False
+            if reply_status != self.__control_flags.TRANSFER_REJECT:
+                # An accept already started sending the missing byte ranges
+                return
+            break
+
+        transfer.reattaching = False
+        await self.__handle_exceptions(transfer.socket, uuid, ConnectionError("The connection broke and the transfer could not be resumed"))
+
+    def initiate_transfer(self, ip, file_path, label_index, streams=1, pipelined_hash=False, compress=False, priority="normal", rate_limit=None, delta=False,
+                          transport="tcp"):
+        """Sends a transfer request, the future resolves to the UUID of the transfer once it was answered, or to None"""
+        if transport not in ("tcp", "udp"):
+            raise ValueError(f"The transport must be tcp or udp, not {transport}")
+        return self.__run_in_loop(self.__initiate_transfer(ip, file_path, label_index, streams, pipelined_hash, compress, priority, rate_limit, delta, transport))
+
+    def initiate_fanout(self, ips, file_path, label_index, streams=1, compress=False, priority="normal", rate_limit=None, delta=False, transport="tcp"):
+        """Sends the same file or directory to every peer of ips, the future resolves to their transfer UUIDs by IP"""
+        if transport not in ("tcp", "udp"):
+            raise ValueError(f"The transport must be tcp or udp, not {transport}")
+        # A peer listed twice would receive the file twice, into the same path
+        ips = list(dict.fromkeys(ips))
+        if not ips:
+            raise ValueError("A fan-out needs at least one peer")
+        return self.__run_in_loop(self.__initiate_fanout(ips, file_path, label_index, streams, compress, priority, rate_limit, delta, transport))
+
+    async def __hash_source(self, file_path, label_index, pipelined_hash=False):
+        """Describes the source in the executor, telling the presenter first if it has to be hashed"""
+        cached_leaves = None
+        is_stream = self.__is_stream(file_path)
+        if not is_stream and not isdir(file_path):
+            cached_leaves = await self.__loop.run_in_executor(None, self.__hash_cache.lookup, file_path, "merkle")
+        if cached_leaves is None and not pipelined_hash and not is_stream:
             self.presenter.update_send_request_windows_label(label_index, "hashcalc")
-            header, uuid, file_name, file_size, file_hash = self.__create_file_info_header_packet(file_path)
-            
-            self.__add_transfer(uuid, ip, file_name, file_size, file_hash, True, sender_socket, file_path=file_path)
+        return await self.__loop.run_in_executor(None, self.__describe_source, file_path, pipelined_hash, cached_leaves)
+
+    async def __initiate_fanout(self, ips, file_path, label_index, streams, compress, priority, rate_limit, delta, transport):
+        try:
+            description = await self.__hash_source(file_path, label_index)
+            if description[1] is None:
+                # The transfers would each read a different part of it
+                raise ValueError(f"{file_path} can only be read once, so it can't be sent to several peers")
+        except Exception as e:
+            self.presenter.exception_happened(e)
+            return dict.fromkeys(ips)
+
+        files = description[-1]
+        shared_reader = SharedReader(file_path if files is None else self.__batch_source(file_path, self.__layout_files(files)), self.fanout_buffer)
+        uuids = await asyncio.gather(*(self.__initiate_transfer(ip, file_path, label_index, streams, False, compress, priority, rate_limit, delta, transport,
+                                                                description, shared_reader) for ip in ips))
+        return dict(zip(ips, uuids))
 
+    async def __initiate_transfer(self, ip, file_path, label_index, streams, pipelined_hash, compress, priority, rate_limit, delta, transport,
+                                  description=None, shared_reader=None):
+        """Sends a request for the file, description is what __describe_source returned if it was already hashed"""
+        uuid = None
+        try:
+            if description is None:
+                description = await self.__hash_source(file_path, label_index, pipelined_hash)
+            file_name, file_size, file_hash, leaves, files = description
+            if file_size is None:
+                # Read once from its start to its end, so it goes over a single connection and as it is
+                streams, compress, delta, transport = 1, False, False, "tcp"
             self.presenter.update_send_request_windows_label(label_index, "sendreq")
-            sender_socket.connect((ip, self.remote_port))
-            sender_socket.send(header)
-
-            packet_type, _, _ = self.__decode_packet(sender_socket)
-            
-            if packet_type == self.__control_flags.TRANSFER_REJECT:
-                self.presenter.present_rejected_transfer(self.__transfers[uuid])
-                self.__transfers[uuid]["status"] = self.__control_flags.TRANSFER_REJECT
-                close_socket_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_REJECT)
-                sender_socket.send(close_socket_packet)
-                return
-            else:
-                sender_socket.setblocking(True)
-                self.__transfers[uuid]["status"] = self.__control_flags.TRANSFER_ACCEPT
-                self.__transfers[uuid]["file_handle"] = open(file_path, "rb")
-                threading.Thread(target=self.__transfer_file, args=(sender_socket, uuid), daemon=True).start()
-                threading.Thread(target=self.__handle_incoming_messages, args=(sender_socket, (ip, self.remote_port)), daemon=True).start()
+            connection = await self.__connect_to_peer(ip, 60)
+            # Built once connected, so the path estimate has the round trip of the new connection
+            path = self.__path_tuner.describe(ip) if self.__path_tuner is not None else None
+            header, uuid = await self.__loop.run_in_executor(None, self.__create_file_info_header_packet, description, streams, compress, delta, transport, path)
+            self.__add_transfer(uuid, ip, file_name, file_size or 0, file_hash, True, connection, file_path=file_path, streams=streams)
+            transfer = self.__transfers[uuid]
+            transfer.streamed = file_size is None
+            transfer.leaves = leaves
+            transfer.codecs = get_compression_codecs() if compress else []
+            transfer.delta = delta and files is None
+            transfer.transport = transport
+            if shared_reader is not None:
+                transfer.shared_reader = shared_reader
+                shared_reader.acquire()
+            await self.__set_transfer_priority(uuid, priority)
+            await self.__set_transfer_rate_limit(uuid, rate_limit)
+            if files is not None:
+                transfer.files = self.__layout_files(files)
+                transfer.source = self.__batch_source(file_path, transfer.files)
+
+            transfer.reply = self.__loop.create_future()
+            try:
+                await self.__send_packet(uuid, header)
+                # An accept already started sending the file
+                reply_status = await asyncio.wait_for(transfer.reply, 60)
+            finally:
+                transfer.reply = None
+
+            if reply_status == self.__control_flags.TRANSFER_REJECT:
+                self.presenter.present_rejected_transfer(transfer)
+            return uuid
         except Exception as e:
-            self.__handle_exceptions(self.__transfers[uuid]["socket"], uuid, e)
+            await self.__handle_exceptions(None, uuid, e)
+
+    async def __decide_request(self, uuid):
+        """Accepts or rejects a request by the first rule of the accept policy that matches it, or asks the presenter"""
+        transfer = self.__transfers[uuid]
+        rule = self.__accept_policy.match(transfer.ip, transfer.file_name, None if transfer.streamed else transfer.file_size)
+        if rule is None:
+            await self.__log_decision(uuid, "ask")
+            self.presenter.present_incoming_transfer_request(transfer)
+        elif rule.action == "accept":
+            # Spawned, so the connection keeps being read meanwhile
+            self.__spawn(self.__accept_transfer(uuid, rule.directory, rule))
+        else:
+            await self.__reject_transfer(uuid, rule)
+
+    async def __log_decision(self, uuid, decision, rule=None, **details):
+        transfer = self.__transfers[uuid]
+        await self.__loop.run_in_executor(None, partial(
+            self.__accept_policy.log, decision, uuid=str(uuid), ip=transfer.ip, file_name=transfer.file_name,
+            file_size=None if transfer.streamed else transfer.file_size,
+            file_count=len(transfer.files) if transfer.files is not None else None, rule=rule.name if rule is not None else None, **details))
 
     def accept_transfer(self, uuid, dir_path):
+        return self.__run_in_loop(self.__accept_transfer(uuid, dir_path))
+
+    async def __accept_transfer(self, uuid, dir_path, rule=None):
+        """Accepts a request into dir_path, rule is the accept policy's rule that accepted it, None if the presenter did"""
         try:
-            accept_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_ACCEPT)
+            await self.__log_decision(uuid, "accept", rule, directory=dir_path)
+            # The sender lists its codecs from the most to the least preferred one
+            supported_codecs = get_compression_codecs()
+            codec = next((codec for codec in self.__transfers[uuid].codecs if codec in supported_codecs), None)
+            self.__transfers[uuid].codec = codec
+            accept_payload = {"codec": codec, "credit": self.credit_window}
+
+            file_path = dir_path + "/" + self.__transfers[uuid].file_name
+            self.__transfers[uuid].path = file_path
+            local_copy = await self.__find_local_copy(uuid)
+            if local_copy is not None and await self.__accept_local_copy(uuid, *local_copy):
+                return
 
-            self.__transfers[uuid]["status"] = self.__control_flags.TRANSFER_ACCEPT
+            signatures = await self.__loop.run_in_executor(None, self.__open_basis, uuid, file_path)
+            if signatures is not None:
+                accept_payload["signatures"] = signatures
+            await self.__loop.run_in_executor(None, self.__open_destination, uuid, self.__transfers[uuid].path)
+            self.__choose_transport(uuid, self.__transfers[uuid].transport, accept_payload)
+            accept_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_ACCEPT, accept_payload)
 
-            file_path = dir_path + "/" + self.__transfers[uuid]["file_name"]
-            self.__transfers[uuid]["path"] = file_path
-            self.__transfers[uuid]["file_handle"] = open(file_path, "wb")
+            # A stream can't be read again, and its blocks are only counted once its end is known
+            self.__transfers[uuid].resumable = not self.__transfers[uuid].streamed
+            if not self.__transfers[uuid].streamed:
+                self.__transfers[uuid].block_received = self.__count_received_blocks(self.__transfers[uuid])
+            self.__set_status(uuid, self.__control_flags.TRANSFER_ACCEPT)
+            await self.__send_packet(uuid, accept_packet)
 
-            self.__transfers[uuid]["socket"].send(accept_packet)
+            if self.__transfers[uuid].file_size == 0 and not self.__transfers[uuid].streamed:
+                # No file data will arrive, like for a batch of empty files
+                self.__set_status(uuid, self.__control_flags.TRANSFER_FINISH)
+                await self.__finish_inbound(uuid)
         except Exception as e:
-            self.__handle_exceptions(self.__transfers[uuid]["socket"], uuid, e)
+            await self.__handle_exceptions(self.__transfers[uuid].socket, uuid, e)
+
+    async def __find_local_copy(self, uuid):
+        """Returns the path and the stat key of a file this side received before with the same content as the request, or None"""
+        transfer = self.__transfers[uuid]
+        if transfer.files is not None or transfer.hash is None:
+            # Batches aren't indexed, and pipelined requests don't know their content yet
+            return None
+        return await self.__loop.run_in_executor(None, self.__content_index.find, transfer.hash, transfer.block_size, transfer.file_size)
+
+    async def __accept_local_copy(self, uuid, local_path, local_key):
+        """Copies the content from the local file instead of receiving it, returns False if it couldn't be copied"""
+        transfer = self.__transfers[uuid]
+        try:
+            await self.__loop.run_in_executor(None, link_or_copy, local_path, transfer.path, self.link_duplicates, local_key)
+        except (OSError, ValueError):
+            return False
+
+        transfer.holes = []
+        transfer.transferred = transfer.file_size
+        transfer.verified = True
+        self.__set_status(uuid, self.__control_flags.TRANSFER_FINISH)
+        finish_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_FINISH, {"verified": True, "local": True})
+        await self.__send_packet(uuid, finish_packet)
+        self.__release_connection(uuid)
+        await self.__loop.run_in_executor(None, self.__content_index.add, transfer.path, transfer.hash, transfer.block_size, transfer.file_size)
+        return True
 
     def reject_transfer(self, uuid):
+        return self.__run_in_loop(self.__reject_transfer(uuid))
+
+    async def __reject_transfer(self, uuid, rule=None):
         try:
+            await self.__log_decision(uuid, "reject", rule)
             reject_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_REJECT)
-            self.__transfers[uuid]["status"] = self.__control_flags.TRANSFER_REJECT
-            self.__transfers[uuid]["socket"].send(reject_packet)
+            self.__set_status(uuid, self.__control_flags.TRANSFER_REJECT)
+            await self.__send_packet(uuid, reject_packet)
+            self.__release_connection(uuid)
         except Exception as e:
-            self.__handle_exceptions(self.__transfers[uuid]["socket"], uuid, e)
+            await self.__handle_exceptions(self.__transfers[uuid].socket, uuid, e)
 
     def cancel_transfer(self, uuid):
+        return self.__run_in_loop(self.__cancel_transfer(uuid))
+
+    async def __cancel_transfer(self, uuid):
         try:
             cancel_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_CANCEL)
-            self.__transfers[uuid]["status"] = self.__control_flags.TRANSFER_CANCEL
-            self.__transfers[uuid]["socket"].send(cancel_packet)
+            self.__set_status(uuid, self.__control_flags.TRANSFER_CANCEL)
+            if not self.__transfers[uuid].is_outbound:
+                await self.__forget_partial_transfer(uuid)
+            await self.__send_packet(uuid, cancel_packet)
+            self.__release_transfer(uuid)
         except Exception as e:
-            self.__handle_exceptions(self.__transfers[uuid]["socket"], uuid, e)
+            await self.__handle_exceptions(self.__transfers[uuid].socket, uuid, e)
 
     def toggle_transfer_pause(self, uuid):
+        return self.__run_in_loop(self.__toggle_transfer_pause(uuid))
+
+    async def __toggle_transfer_pause(self, uuid):
         try:
-            if self.__transfers[uuid]["status"] == self.__control_flags.TRANSFER_ACCEPT or self.__transfers[uuid]["status"] == self.__control_flags.TRANSFER_RESUME:
-                self.__transfers[uuid]["status"] = self.__control_flags.TRANSFER_PAUSE
+            if self.__transfers[uuid].status == self.__control_flags.TRANSFER_ACCEPT or self.__transfers[uuid].status == self.__control_flags.TRANSFER_RESUME:
+                self.__set_status(uuid, self.__control_flags.TRANSFER_PAUSE)
                 pause_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_PAUSE)
-                self.__transfers[uuid]["socket"].send(pause_packet)
+                await self.__send_packet(uuid, pause_packet)
             else:
-                self.__transfers[uuid]["status"] = self.__control_flags.TRANSFER_RESUME
+                self.__set_status(uuid, self.__control_flags.TRANSFER_RESUME)
                 resume_packet = self.__create_transfer_control_packet(uuid, self.__control_flags.TRANSFER_RESUME)
-                self.__transfers[uuid]["socket"].send(resume_packet)
-                if self.__transfers[uuid]["is_outbound"]:
-                    with self.__transfers[uuid]["pause_condition"]:
-                        self.__transfers[uuid]["pause_condition"].notify()
+                await self.__send_packet(uuid, resume_packet)
+                if not self.__transfers[uuid].is_outbound:
+                    await self.__grant_credit(uuid)
         except Exception as e:
-            self.__handle_exceptions(self.__transfers[uuid]["socket"], uuid, e)
-
-    def __get_active_transfers(self):
-        watched_transfers = {
-            key: value
-            for key, value in self.__transfers.items()
-            if value["status"] != self.__control_flags.TRANSFER_REQUEST and
-            value["status"] != self.__control_flags.TRANSFER_REJECT and
-            value["watched"]
-        }
-        return watched_transfers
+            await self.__handle_exceptions(self.__transfers[uuid].socket, uuid, e)
 
-    def __get_transferred_amounts(self):
-        active_transfers = self.__get_active_transfers()
-        amounts = {
-            key: value["transferred"]
-            for key, value in active_transfers.items()
-        }
-        return amounts
+    def set_rate_limit(self, rate):
+        """Caps the combined upload rate of every transfer at rate bytes per second, None lifts the cap"""
+        return self.__run_in_loop(self.__set_rate_limit(rate))
+
+    async def __set_rate_limit(self, rate):
+        self.__rate_limiter.set_global_rate(rate)
+
+    def set_transfer_rate_limit(self, uuid, rate):
+        """Caps the upload rate of a single transfer at rate bytes per second, None lifts the cap"""
+        return self.__run_in_loop(self.__set_transfer_rate_limit(uuid, rate))
+
+    async def __set_transfer_rate_limit(self, uuid, rate):
+        self.__rate_limiter.set_rate(uuid, rate)
+        self.__transfers[uuid].rate_limit = rate
+
+    def set_transfer_priority(self, uuid, priority):
+        """Sets how much of the global rate limit a transfer gets while the limit is the bottleneck, one of low, normal and high"""
+        return self.__run_in_loop(self.__set_transfer_priority(uuid, priority))
+
+    async def __set_transfer_priority(self, uuid, priority):
+        self.__rate_limiter.set_priority(uuid, priority)
+        self.__transfers[uuid].priority = priority
+
+    def __update_file_progress(self, transfer):
+        """Counts the complete files of a batch and reports the progress of the first one that isn't complete"""
+        holes = transfer.holes
+        hole_index = 0
+        files_done, current_file = 0, None
+        for relative_path, start, size in transfer.files:
+            end = start + size
+            while hole_index < len(holes) and holes[hole_index][1] <= start:
+                hole_index += 1
+
+            missing = 0
+            index = hole_index
+            while index < len(holes) and holes[index][0] < end:
+                missing += min(end, holes[index][1]) - max(start, holes[index][0])
+                index += 1
 
-    def update_transfer_info(self):
+            if missing == 0:
+                files_done += 1
+            elif current_file is None:
+                current_file = [relative_path, size - missing, size]
+
+        transfer.files_done = files_done
+        transfer.current_file = current_file
+
+    def __ui_snapshot(self, transfer):
+        """Returns everything the presenter shows of a transfer, to tell whether it changed since it was last shown"""
+        return (transfer.status, transfer.verified, transfer.hash, transfer.transferred, transfer.transfer_speed, transfer.eta,
+                transfer.files_done, transfer.current_file, transfer.priority, transfer.rate_limit)
+
+    async def update_transfer_info(self):
+        """Hands the transfers whose progress or status changed to the presenter, as a single batch"""
         interval = 1
+        measured_at = self.__loop.time()
+        shown = {}
+        while True:
+            now = self.__loop.time()
+            is_measuring = now - measured_at >= interval
+
+            changed = {}
+            for transfer in self.__transfers.watched():
+                uuid = transfer.transfer_uuid
+                if transfer.status == self.__control_flags.TRANSFER_REQUEST:
+                    continue
+                if transfer.status == self.__control_flags.TRANSFER_REJECT:
+                    # Never shown, the presenter was told about the rejection on its own
+                    self.__transfers.unwatch(uuid)
+                    continue
+
+                if self.__is_over(uuid):
+                    transfer.transfer_speed, transfer.eta = 0, None
+                    self.__metrics.forget(uuid)
+                elif is_measuring:
+                    if transfer.files is not None:
+                        self.__update_file_progress(transfer)
+                    labels = {"file": transfer.file_name, "peer": transfer.ip, "direction": "outbound" if transfer.is_outbound else "inbound"}
+                    is_paused = transfer.status == self.__control_flags.TRANSFER_PAUSE
+                    transfer_metrics = self.__metrics.sample(uuid, now, labels, transfer.transferred, transfer.file_size, is_paused)
+                    transfer.transfer_speed = transfer_metrics.throughput.ewma or 0
+                    transfer.eta = transfer_metrics.eta
+
+                is_unverified = transfer.status == self.__control_flags.TRANSFER_FINISH and transfer.verified is None
+                is_watched = not self.__is_over(uuid) or is_unverified
+                if not is_watched:
+                    # Shown one last time, a broken transfer is watched again once reattached
+                    self.__transfers.unwatch(uuid)
+
+                snapshot = self.__ui_snapshot(transfer)
+                if shown.get(uuid) != snapshot:
+                    changed[uuid] = transfer
+                    shown[uuid] = snapshot
+                if not is_watched:
+                    del shown[uuid]
 
-        old_query = self.__get_transferred_amounts()
+            if is_measuring:
+                self.__metrics.sample_totals(now)
+                measured_at = now
+            if changed:
+                self.presenter.sync_transfers_to_ui(changed)
+
+            self.__transfers_changed.clear()
+            try:
+                await asyncio.wait_for(self.__transfers_changed.wait(), measured_at + interval - self.__loop.time())
+                await asyncio.sleep(0.05)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __export_metrics(self):
+        """Serves the metrics to scrapers on localhost and dumps them as JSON every 5 seconds, if either was asked for"""
+        try:
+            if self.metrics_port is not None:
+                self.__metrics_server = await serve_metrics(self.__metrics, self.metrics_port, self.__loop.time)
+            while self.metrics_path is not None:
+                await asyncio.sleep(5)
+                await self.__loop.run_in_executor(None, save_json, self.metrics_path, self.__metrics.to_json(self.__loop.time()))
+        except OSError as e:
+            self.presenter.exception_happened(e)
+
+    async def __evict_ended_transfers(self):
+        """Forgets the transfers that ended a while ago, so a node that runs for long doesn't accumulate them"""
         while True:
-            new_query = self.__get_transferred_amounts()
-
-            active_transfers = self.__get_active_transfers()
-            to_show = {}
-
-            for uuid, transfer in active_transfers.items():
-                to_show[uuid] = self.__transfers[uuid]
-                if(old_query.get(uuid)):
-                    data_difference = new_query[uuid] - old_query[uuid]
-                    speed = data_difference / interval
-                    self.__transfers[uuid]["transfer_speed"] = speed
-                    
-                    if transfer["status"] == self.__control_flags.TRANSFER_FINISH:
-                        self.__transfers[uuid]["watched"] = False
-                        self.__transfers[uuid]["transfer_speed"] = 0
-
-            old_query = new_query
-
-            self.presenter.sync_transfers_to_ui(to_show)
-            time.sleep(interval)
-        
+            # A retention of 0 would otherwise never yield the loop
+            await asyncio.sleep(max(1, min(60, self.__transfers.retention)))
+            for transfer in self.__transfers.evict(self.__loop.time()):
+                self.__metrics.forget(transfer.transfer_uuid)
+                self.__rate_limiter.forget(transfer.transfer_uuid)
+
     def check_for_active_transfers(self):
-        for key, value in self.__transfers.items():
-            if value["status"] == self.__control_flags.TRANSFER_ACCEPT or value["status"] == self.__control_flags.TRANSFER_PAUSE or value["status"] == self.__control_flags.TRANSFER_RESUME:
-                return True
-        return False
+        """Checks whether any transfer is active or paused, safe to call from any thread"""
+        return self.__transfers.has_running()
+
+    def __run_event_loop(self):
+        """Runs every connection of the model on a single event loop, blocking disk and hash work goes to its executor"""
+        asyncio.set_event_loop(self.__loop)
+        self.__spawn(self.__loop.create_datagram_endpoint(lambda: self.__datagrams, sock=self.__datagram_socket))
+        self.__spawn(self.__listen_for_connections())
+        self.__spawn(self.__reap_idle_connections())
+        self.__spawn(self.update_transfer_info())
+        self.__spawn(self.__export_metrics())
+        self.__spawn(self.__evict_ended_transfers())
+        self.__loop.run_forever()
 
     def launch(self):
-        threading.Thread(target=self.__listen_for_connections, daemon=True).start()
-        threading.Thread(target=self.update_transfer_info, daemon=True).start()
\ No newline at end of file
+        threading.Thread(target=self.__run_event_loop, daemon=True).start()
@@ -0,0 +1,191 @@
+import socket
+import struct
+import sys
+import threading
+from collections import OrderedDict
+from metrics import Throughput
+from misc import MERKLE_BLOCK_SIZE, load_json, save_json
+
+# A chunk is what the path sends in about FRAME_TIME, a power of two between these
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = MERKLE_BLOCK_SIZE
+FRAME_TIME = 0.01
+# Socket buffers hold twice the bandwidth-delay product
+MAX_BUFFER_SIZE = 64 * 1024 * 1024
+MIN_UNSENT = 128 * 1024
+UNSENT_TIME = 0.02
+# How often the rate is sampled, and after how long a path is idle
+RATE_INTERVAL = 0.1
+IDLE_TIME = 1
+
+
+def _read_limit(file_path, index=0):
+    try:
+        with open(file_path, "r") as f:
+            return int(f.read().split()[index])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+if sys.platform.startswith("linux"):
+    # What autotuning grows the buffers of a socket up to, and what setting them can reach at most
+    AUTOTUNED = {socket.SO_SNDBUF: _read_limit("/proc/sys/net/ipv4/tcp_wmem", 2), socket.SO_RCVBUF: _read_limit("/proc/sys/net/ipv4/tcp_rmem", 2)}
+    SETTABLE = {socket.SO_SNDBUF: _read_limit("/proc/sys/net/core/wmem_max"), socket.SO_RCVBUF: _read_limit("/proc/sys/net/core/rmem_max")}
+else:
+    AUTOTUNED, SETTABLE = {}, {}
+
+
+def configure_socket(connected_socket):
+    """Turns Nagle's algorithm off, a control packet shouldn't wait for the acknowledgement of the data before it"""
+    try:
+        connected_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+def raise_buffer(connected_socket, option, size):
+    """Grows the SO_SNDBUF or SO_RCVBUF buffer of the socket to size, unless autotuning would grow it further"""
+    settable = SETTABLE.get(option)
+    effective = 2 * min(size, settable) if settable else size
+    autotuned = AUTOTUNED.get(option)
+    try:
+        if (autotuned is not None and effective <= autotuned) or effective <= connected_socket.getsockopt(socket.SOL_SOCKET, option):
+            return
+        connected_socket.setsockopt(socket.SOL_SOCKET, option, size)
+    except OSError:
+        pass
+
+
+def limit_unsent(connected_socket, size):
+    """Keeps the data the socket didn't send yet below size, so packets written after it don't wait behind all of it"""
+    if not hasattr(socket, "TCP_NOTSENT_LOWAT"):
+        return
+    try:
+        connected_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, size)
+    except OSError:
+        pass
+
+
+def measure_rtt(connected_socket):
+    """Returns the round-trip time the kernel measured for the connection in seconds, None where it doesn't tell"""
+    if not sys.platform.startswith("linux") or not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        info = connected_socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except OSError:
+        return None
+    # tcpi_rtt in microseconds, after 8 one byte fields and 15 four byte ones of struct tcp_info
+    if len(info) < 72:
+        return None
+    rtt = struct.unpack_from("=I", info, 68)[0]
+    return rtt / 1000000 if rtt else None
+
+
+class PathEstimate:
+    """What is known about the path to a peer, the lowest round-trip time and the rate data moves at"""
+
+    def __init__(self, rtt=None, rate=None):
+        self.rtt = rtt
+        self.rate = rate
+        self.__throughput = None
+        self.__sent = 0
+        self.__sampled_at = None
+
+    def start_connection(self, rtt):
+        """Takes the time a new connection took to open as the round-trip time, the path may have changed since the last one"""
+        self.rtt = rtt
+
+    def observe_rtt(self, rtt):
+        # The lowest one, queueing behind the data sent doesn't make the path longer
+        if rtt is not None:
+            self.rtt = rtt if self.rtt is None else min(self.rtt, rtt)
+
+    def observe_peer(self, rtt, rate):
+        """Takes the estimate the peer sent, a receiver has no rate of its own before data arrived"""
+        if isinstance(rtt, (int, float)) and rtt > 0:
+            self.observe_rtt(rtt)
+        if isinstance(rate, (int, float)) and rate > 0:
+            self.rate = rate
+
+    def observe_bytes(self, count, now):
+        """Counts bytes that were sent or received, returns True when the rate was sampled anew"""
+        self.__sent += count
+        if self.__sampled_at is not None and now - self.__sampled_at < RATE_INTERVAL:
+            return False
+        if self.__sampled_at is None or now - self.__sampled_at > IDLE_TIME:
+            # Measured from scratch, the time nothing was sent says nothing about the rate
+            self.__throughput = Throughput(time_constant=1)
+        self.__throughput.sample(now, self.__sent, observe=False)
+        self.__sampled_at = now
+        if self.__throughput.ewma is None:
+            return False
+        self.rate = self.__throughput.ewma
+        return True
+
+    def chunk_size(self, default):
+        if not self.rate:
+            return default
+        size = int(self.rate * FRAME_TIME)
+        return min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, 1 << max(0, size.bit_length() - 1)))
+
+    def buffer_size(self):
+        """Twice the bandwidth-delay product, None while it isn't known"""
+        if not self.rate or self.rtt is None:
+            return None
+        return min(MAX_BUFFER_SIZE, int(2 * self.rate * self.rtt))
+
+    def unsent_size(self):
+        if not self.rate:
+            return None
+        return max(MIN_UNSENT, int(self.rate * UNSENT_TIME))
+
+
+class PathTuner:
+    """Keeps an estimate of the path to every peer, tunes the connections to it by that and remembers it between runs"""
+
+    def __init__(self, file_path, max_peers=1024):
+        self.file_path = file_path
+        self.max_peers = max_peers
+        self.__lock = threading.Lock()
+        # Saves don't write over each other
+        self.__save_lock = threading.Lock()
+        # [ip, {"rtt": seconds, "rate": bytes per second}] pairs, least recently used first
+        self.__paths = OrderedDict((ip, PathEstimate(record.get("rtt"), record.get("rate"))) for ip, record in load_json(file_path, []))
+
+    def path(self, ip):
+        with self.__lock:
+            path = self.__paths.pop(ip, None) or PathEstimate()
+            self.__paths[ip] = path
+            while len(self.__paths) > self.max_peers:
+                self.__paths.popitem(last=False)
+            return path
+
+    def describe(self, ip):
+        """Returns the estimate of the path to the peer as it is saved and sent to the peer, {"rtt": seconds, "rate": bytes per second}"""
+        path = self.path(ip)
+        return {"rtt": path.rtt, "rate": path.rate}
+
+    def tune(self, connected_socket, ip):
+        """Sizes the buffers of a connection to the peer and the data it may keep unsent by the estimate of its path"""
+        path = self.path(ip)
+        buffer_size = path.buffer_size()
+        if buffer_size is not None:
+            raise_buffer(connected_socket, socket.SO_SNDBUF, buffer_size)
+            raise_buffer(connected_socket, socket.SO_RCVBUF, buffer_size)
+        unsent_size = path.unsent_size()
+        if unsent_size is not None:
+            limit_unsent(connected_socket, unsent_size)
+
+    def tune_listener(self, listener_socket):
+        """Sizes the receive buffer of the listening socket for the longest fattest path that is known"""
+        with self.__lock:
+            sizes = [path.buffer_size() for path in self.__paths.values()]
+        sizes = [size for size in sizes if size is not None]
+        if sizes:
+            raise_buffer(listener_socket, socket.SO_RCVBUF, max(sizes))
+
+    def save(self):
+        with self.__lock:
+            records = [[ip, {"rtt": path.rtt, "rate": path.rate}] for ip, path in self.__paths.items() if path.rtt is not None or path.rate]
+        with self.__save_lock:
+            save_json(self.file_path, records)
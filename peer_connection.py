@@ -0,0 +1,99 @@
+import asyncio
+from collections import OrderedDict, deque
+
+
+class TransferDetached(Exception):
+    """Raised to the senders of a transfer that was moved to another connection while they were waiting for their turn"""
+
+
+class Turn:
+    """A transfer's place in the round robin of a connection, entered for every packet the transfer sends on it"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.retired = False
+
+    def retire(self):
+        """Makes the senders still waiting for this turn, and the ones that come later, raise TransferDetached"""
+        self.retired = True
+        self.connection._retire(self)
+
+    async def __aenter__(self):
+        if self.retired:
+            raise TransferDetached("The transfer was moved to another connection")
+        await self.connection._acquire(self)
+
+    async def __aexit__(self, *exc_info):
+        self.connection._release()
+
+
+class PeerConnection:
+    """A long-lived connection to a peer, shared by every transfer between the two"""
+
+    def __init__(self, ip, connected_socket, loop):
+        self.ip = ip
+        self.socket = connected_socket
+        self.transfers = set()
+        self.closed = False
+        self.last_used = loop.time()
+        self.__loop = loop
+        self.__is_sending = False
+        # The turns waiting to send, in round-robin order, each with the futures of its waiting senders
+        self.__waiting = OrderedDict()
+
+    def turn(self):
+        return Turn(self)
+
+    def add_transfer(self, uuid):
+        self.transfers.add(uuid)
+
+    def remove_transfer(self, uuid):
+        self.transfers.discard(uuid)
+        self.last_used = self.__loop.time()
+
+    def is_idle(self, timeout):
+        return not self.transfers and not self.__is_sending and self.__loop.time() - self.last_used >= timeout
+
+    async def _acquire(self, turn):
+        if not self.__is_sending and not self.__waiting:
+            self.__is_sending = True
+            return
+
+        future = self.__loop.create_future()
+        self.__waiting.setdefault(turn, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The connection was handed over right before the cancellation, so it is passed on
+                self._release()
+            else:
+                self.__forget(turn, future)
+            raise
+
+    def _release(self):
+        self.last_used = self.__loop.time()
+        while self.__waiting:
+            turn, futures = next(iter(self.__waiting.items()))
+            future = futures.popleft()
+            if futures:
+                # The transfer waits again, behind every other transfer that wants to send
+                self.__waiting.move_to_end(turn)
+            else:
+                del self.__waiting[turn]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.__is_sending = False
+
+    def _retire(self, turn):
+        for future in self.__waiting.pop(turn, ()):
+            if not future.done():
+                future.set_exception(TransferDetached("The transfer was moved to another connection"))
+
+    def __forget(self, turn, future):
+        futures = self.__waiting.get(turn)
+        if futures is not None and future in futures:
+            futures.remove(future)
+            if not futures:
+                del self.__waiting[turn]
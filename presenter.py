@@ -1,6 +1,5 @@
 import model
 import view
-import threading
 from os.path import basename
 
 
@@ -17,8 +16,11 @@ class Presenter:
     def reject_inbound_transfer(self, uuid):
         self.model.reject_transfer(uuid)
     
-    def send_transfer_request(self, destination_ip, file_path, label_index):
-        threading.Thread(target=self.model.initiate_transfer, args=(destination_ip, file_path, label_index)).start()
+    def send_transfer_request(self, destination_ip, file_path, label_index, streams=1, pipelined_hash=False, compress=False, priority="normal", rate_limit=None, delta=False, transport="tcp"):
+        self.model.initiate_transfer(destination_ip, file_path, label_index, streams, pipelined_hash, compress, priority, rate_limit, delta, transport)
+
+    def send_fanout_request(self, destination_ips, file_path, label_index, streams=1, compress=False, priority="normal", rate_limit=None, delta=False, transport="tcp"):
+        self.model.initiate_fanout(destination_ips, file_path, label_index, streams, compress, priority, rate_limit, delta, transport)
 
     def toggle_pause_transfer(self, uuid):
         self.model.toggle_transfer_pause(uuid)
@@ -26,6 +28,15 @@ class Presenter:
     def cancel_transfer(self, uuid):
         self.model.cancel_transfer(uuid)
 
+    def set_rate_limit(self, rate):
+        self.model.set_rate_limit(rate)
+
+    def set_transfer_rate_limit(self, uuid, rate):
+        self.model.set_transfer_rate_limit(uuid, rate)
+
+    def set_transfer_priority(self, uuid, priority):
+        self.model.set_transfer_priority(uuid, priority)
+
     def check_for_active_transfers(self):
         return self.model.check_for_active_transfers()
 
@@ -33,26 +44,32 @@ class Presenter:
 
     def update_send_request_windows_label(self, label_index, status):
         text = ""
-        if status == "hashcalc": text = "Calculating SHA-1 hash..."
+        if status == "hashcalc": text = "Calculating the hash tree..."
         if status == "sendreq": text = "Sending transfer request..."
-        self.view.update_status_label(label_index, text)
+        self.view.call_on_tk_thread(self.view.update_status_label, label_index, text)
 
     def present_incoming_transfer_request(self, transfer):
         info = {
-            "transfer_uuid": transfer["transfer_uuid"],
-            "ip": transfer["ip"],
-            "file_name": transfer["file_name"],
-            "file_size": transfer["file_size"],
-            "hash": transfer["hash"]
+            "transfer_uuid": transfer.transfer_uuid,
+            "ip": transfer.ip,
+            "file_name": transfer.file_name,
+            "file_size": None if transfer.streamed else transfer.file_size,
+            "file_count": len(transfer.files) if transfer.files is not None else None,
+            "hash": self.__convert_hash_to_string(transfer.hash)
         }
 
-        self.view.create_transfer_request_popup(info)
+        self.view.call_on_tk_thread(self.view.create_transfer_request_popup, info)
 
     def present_rejected_transfer(self, transfer):
-        message = f"{transfer["ip"]} has rejected your transfer for {basename(transfer["path"])}"
-        self.view.create_generic_popup(message)
+        message = f"{transfer.ip} has rejected your transfer for {basename(transfer.path)}"
+        self.view.call_on_tk_thread(self.view.create_generic_popup, message)
+
+    def __convert_hash_to_string(self, file_hash):
+        if file_hash is None:
+            return "computed while sending..."
+        return file_hash
 
-    def __convert_control_flags_to_string(self, control_flag):
+    def __convert_control_flags_to_string(self, control_flag, verified=None):
         
         if control_flag == self.model._Model__control_flags.TRANSFER_ACCEPT.TRANSFER_ACCEPT:
             return "Transfer accepted"
@@ -63,33 +80,45 @@ class Presenter:
         if control_flag == self.model._Model__control_flags.TRANSFER_CANCEL.TRANSFER_CANCEL:
             return "Transfer cancelled"
         if control_flag == self.model._Model__control_flags.TRANSFER_CANCEL.TRANSFER_FINISH:
-            return "Transfer finished"
+            if verified is None:
+                return "Transfer finished"
+            return "Transfer finished (verified)" if verified else "Transfer finished (hash mismatch)"
+        if control_flag == self.model._Model__control_flags.TRANSFER_BROKEN:
+            return "Transfer broken"
 
     def sync_transfers_to_ui(self, transfers):
- 
+        """Hands the transfers that changed to the view as one batch, it draws them on its own thread"""
+        infos = []
         for uuid, transfer in transfers.items():
-            info = {
-                "transfer_uuid": transfer["transfer_uuid"],
-                "ip": transfer["ip"],
-                "file_name": transfer["file_name"],
-                "file_size": transfer["file_size"],
-                "hash": transfer["hash"],
-                "is_outbound": transfer["is_outbound"],
-                "transfer_speed": transfer["transfer_speed"],
-                "transferred": transfer["transferred"],
-                "status": self.__convert_control_flags_to_string(transfer["status"]),
-                "display_X": transfer["status"] == self.model._Model__control_flags.TRANSFER_BROKEN or
-                    transfer["status"] == self.model._Model__control_flags.TRANSFER_FINISH or
-                    transfer["status"] == self.model._Model__control_flags.TRANSFER_CANCEL 
-            }
-            self.view.sync_transferring_frame_to_ui(info)
+            infos.append({
+                "transfer_uuid": transfer.transfer_uuid,
+                "ip": transfer.ip,
+                "file_name": transfer.file_name,
+                "file_size": transfer.file_size,
+                "hash": self.__convert_hash_to_string(transfer.hash),
+                "is_outbound": transfer.is_outbound,
+                "transfer_speed": transfer.transfer_speed,
+                "eta": transfer.eta,
+                "transferred": transfer.transferred,
+                "file_count": len(transfer.files) if transfer.files is not None else None,
+                "files_done": transfer.files_done,
+                "current_file": transfer.current_file,
+                "priority": transfer.priority,
+                "rate_limit": transfer.rate_limit,
+                "status": self.__convert_control_flags_to_string(transfer.status, transfer.verified),
+                "display_X": transfer.status == self.model._Model__control_flags.TRANSFER_BROKEN or
+                    transfer.status == self.model._Model__control_flags.TRANSFER_FINISH or
+                    transfer.status == self.model._Model__control_flags.TRANSFER_CANCEL 
+            })
+        self.view.queue_transfer_updates(infos)
 
     def exception_happened(self, e):
-        self.view.create_generic_popup(e, "An exception occured")
+        self.view.call_on_tk_thread(self.view.create_generic_popup, e, "An exception occured")
 
     def launch(self):
         self.model.launch()
         self.view.launch()
 
-BlueTransfer = Presenter()
-BlueTransfer.launch()
\ No newline at end of file
+if __name__ == "__main__":
+    BlueTransfer = Presenter()
+    BlueTransfer.launch()
\ No newline at end of file
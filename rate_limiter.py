@@ -0,0 +1,119 @@
+import asyncio
+import heapq
+import time
+from itertools import count
+
+# How much of the global cap each priority gets while the cap is the bottleneck, relative to the others
+PRIORITY_WEIGHTS = {"low": 1, "normal": 4, "high": 16}
+
+
+class TokenBucket:
+    """Lets rate bytes per second through, with bursts of up to a tenth of a second worth of them"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.__tokens = rate / 10
+        self.__updated = time.monotonic()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.rate / 10, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def set_rate(self, rate):
+        self.__refill()
+        self.rate = rate
+        self.__tokens = min(self.__tokens, rate / 10)
+
+    def take(self, amount):
+        self.__refill()
+        self.__tokens -= amount
+
+    def delay(self):
+        """Returns how long until the bucket isn't overdrawn anymore"""
+        self.__refill()
+        return max(0.0, -self.__tokens / self.rate)
+
+
+class RateLimiter:
+    """Shapes the outbound bandwidth with a global token bucket shared by priority, and optional ones per transfer"""
+
+    def __init__(self):
+        self.__global_bucket = None
+        self.__buckets = {}
+        self.__weights = {}
+        # Weighted fair queueing state, the virtual finish time of the last chunk of every transfer
+        self.__finish_tags = {}
+        self.__virtual_time = 0.0
+        self.__queue = []
+        self.__sequence = count()
+        self.__dispatcher = None
+
+    def __check_rate(self, rate):
+        if rate is not None and not rate > 0:
+            raise ValueError(f"A rate limit must be a positive number of bytes per second, not {rate}")
+
+    def set_global_rate(self, rate):
+        """Caps the combined rate of every transfer at rate bytes per second, None lifts the cap"""
+        self.__check_rate(rate)
+        if rate is None:
+            self.__global_bucket = None
+        elif self.__global_bucket is None:
+            self.__global_bucket = TokenBucket(rate)
+        else:
+            self.__global_bucket.set_rate(rate)
+
+    def set_rate(self, key, rate):
+        """Caps the rate of a single transfer at rate bytes per second, None lifts the cap"""
+        self.__check_rate(rate)
+        if rate is None:
+            self.__buckets.pop(key, None)
+        elif key not in self.__buckets:
+            self.__buckets[key] = TokenBucket(rate)
+        else:
+            self.__buckets[key].set_rate(rate)
+
+    def set_priority(self, key, priority):
+        if priority not in PRIORITY_WEIGHTS:
+            raise ValueError(f"Unknown priority {priority}, it must be one of {', '.join(PRIORITY_WEIGHTS)}")
+        self.__weights[key] = PRIORITY_WEIGHTS[priority]
+
+    def forget(self, key):
+        self.__buckets.pop(key, None)
+        self.__weights.pop(key, None)
+        self.__finish_tags.pop(key, None)
+
+    async def acquire(self, key, amount):
+        """Waits until amount bytes of the transfer may be sent, without any limits it returns right away"""
+        bucket = self.__buckets.get(key)
+        if bucket is not None:
+            bucket.take(amount)
+            await self.__wait_for_tokens(lambda: self.__buckets.get(key))
+
+        if self.__global_bucket is not None:
+            weight = self.__weights.get(key, PRIORITY_WEIGHTS["normal"])
+            finish_tag = max(self.__virtual_time, self.__finish_tags.get(key, 0.0)) + amount / weight
+            self.__finish_tags[key] = finish_tag
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.__queue, (finish_tag, next(self.__sequence), future, amount))
+            if self.__dispatcher is None or self.__dispatcher.done():
+                self.__dispatcher = asyncio.get_running_loop().create_task(self.__dispatch())
+            await future
+
+    async def __wait_for_tokens(self, get_bucket):
+        # Looked up again after every nap, so a changed limit takes effect
+        while (bucket := get_bucket()) is not None and (delay := bucket.delay()) > 0:
+            await asyncio.sleep(min(delay, 0.1))
+
+    async def __dispatch(self):
+        """Lets the queued chunks through the global bucket, the one with the earliest virtual finish time first"""
+        while self.__queue:
+            await self.__wait_for_tokens(lambda: self.__global_bucket)
+            finish_tag, _, future, amount = heapq.heappop(self.__queue)
+            if future.done():
+                # Its sender was cancelled
+                continue
+            self.__virtual_time = finish_tag
+            if self.__global_bucket is not None:
+                self.__global_bucket.take(amount)
+            future.set_result(None)
@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+from misc import read_span
+
+
+class SharedReader:
+    """Reads a file once for the transfers of a fan-out, keeping up to memory_limit bytes of chunks for the slower ones"""
+
+    def __init__(self, source, memory_limit=64 * 1024 * 1024):
+        self.source = source
+        self.memory_limit = memory_limit
+        # Bytes read from the disk, and bytes handed out from memory instead
+        self.read_bytes = 0
+        self.shared_bytes = 0
+        self.__lock = threading.Lock()
+        # By (offset, count), in the order they were read, the chunk or an event that is set once it was read
+        self.__chunks = OrderedDict()
+        self.__size = 0
+        # Every chunk before it was dropped once, so who asks for one is lagging behind
+        self.__dropped_until = 0
+        self.__users = 0
+
+    def acquire(self):
+        with self.__lock:
+            self.__users += 1
+
+    def release(self):
+        with self.__lock:
+            self.__users -= 1
+            if self.__users == 0:
+                self.__chunks.clear()
+                self.__size = 0
+
+    def __drop_oldest(self):
+        for key in list(self.__chunks):
+            if self.__size <= self.memory_limit:
+                break
+            chunk = self.__chunks[key]
+            if isinstance(chunk, threading.Event):
+                # Still being read
+                continue
+            del self.__chunks[key]
+            self.__size -= len(chunk)
+            self.__dropped_until = max(self.__dropped_until, key[0] + key[1])
+
+    def read(self, offset, count):
+        """Returns count bytes of the source from offset on, fewer if it was truncated"""
+        key = (offset, count)
+        while True:
+            with self.__lock:
+                chunk = self.__chunks.get(key)
+                if chunk is None:
+                    is_lagging = offset < self.__dropped_until
+                    if not is_lagging:
+                        reading = self.__chunks[key] = threading.Event()
+                    break
+                if not isinstance(chunk, threading.Event):
+                    self.shared_bytes += len(chunk)
+                    return chunk
+            # Another transfer is reading it, if that read fails this one reads it itself
+            chunk.wait()
+
+        try:
+            chunk = read_span(self.source, offset, count)
+        except BaseException:
+            if not is_lagging:
+                with self.__lock:
+                    self.__chunks.pop(key, None)
+                reading.set()
+            raise
+
+        with self.__lock:
+            self.read_bytes += len(chunk)
+            # Unless every transfer released the reader while it was being read
+            if not is_lagging and self.__chunks.get(key) is reading:
+                self.__chunks[key] = chunk
+                self.__size += len(chunk)
+                self.__drop_oldest()
+        if not is_lagging:
+            reading.set()
+        return chunk
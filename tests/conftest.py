@@ -0,0 +1,66 @@
+import hashlib
+import os
+import sys
+import threading
+from os.path import dirname, join
+
+import pytest
+
+sys.path.insert(0, dirname(dirname(__file__)))
+
+from bluetransfer import HeadlessPresenter
+
+
+class RecordingPresenter(HeadlessPresenter):
+    """Keeps the inbound transfers it was asked about, so a test can reach into them while they run, and the errors"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = {}
+        self.errors = []
+
+    def present_incoming_transfer_request(self, transfer):
+        self.requests[transfer.transfer_uuid] = transfer
+        super().present_incoming_transfer_request(transfer)
+
+    def exception_happened(self, e):
+        self.errors.append(e)
+        super().exception_happened(e)
+
+
+def wait(function, *args, timeout=60):
+    """Calls a blocking function in a thread, fails the test if it didn't return within the timeout"""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(function(*args)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert result, f"{function.__name__} didn't return within {timeout} seconds"
+    return result[0]
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def make_file(path, size):
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    return path
+
+
+@pytest.fixture
+def loopback(tmp_path):
+    """Returns a function that launches a sender and a receiver on 127.0.0.1, with their own ports and state"""
+    def launch(sender_options=None, receiver_options=None):
+        accept_dir = tmp_path / "received"
+        accept_dir.mkdir(exist_ok=True)
+        receiver = RecordingPresenter(str(accept_dir), should_accept=lambda transfer: True, quiet=True, local_port=0,
+                                      state_dir=join(tmp_path, "receiver"), **(receiver_options or {}))
+        receiver_port = receiver.model.listener_socket.getsockname()[1]
+        sender = RecordingPresenter(quiet=True, remote_port=receiver_port, local_port=0, state_dir=join(tmp_path, "sender"),
+                                    **(sender_options or {}))
+        receiver.launch()
+        sender.launch()
+        return sender, receiver
+    return launch
@@ -0,0 +1,17 @@
+import pytest
+
+from conftest import file_digest, make_file, wait
+
+
+@pytest.mark.parametrize("streams, transport", [(1, "tcp"), (3, "tcp"), (1, "udp")])
+def test_credit_window_smaller_than_a_chunk(loopback, tmp_path, streams, transport):
+    # The sender may only ever have part of a chunk in flight, and still gets to send all of it
+    sender, receiver = loopback(receiver_options={"credit_window": 100 * 1024})
+    source = make_file(tmp_path / "source.bin", 8 * 1024 * 1024 + 99)
+    uuid = sender.model.initiate_transfer("127.0.0.1", str(source), 0, streams, transport=transport).result(timeout=60)
+
+    received = wait(receiver.wait_for_end, uuid)
+    sent = wait(sender.wait_for_end, uuid)
+    assert received.verified and sent.verified
+    assert sent.transferred == received.transferred == received.file_size
+    assert file_digest(tmp_path / "received" / "source.bin") == file_digest(source)
@@ -0,0 +1,64 @@
+import os
+
+from conftest import make_file
+from delta import block_signatures, find_copies
+
+BLOCK_SIZE = 1024
+
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def test_unchanged_file_is_one_copy(tmp_path):
+    basis = str(make_file(tmp_path / "basis.bin", 16 * BLOCK_SIZE + 100))
+    signatures = block_signatures(basis, BLOCK_SIZE)
+    assert len(signatures) == 16
+    assert find_copies(basis, BLOCK_SIZE, signatures) == [[0, 0, 16 * BLOCK_SIZE]]
+
+
+def test_changed_block_is_left_out(tmp_path):
+    data = bytearray(os.urandom(8 * BLOCK_SIZE))
+    basis = write(tmp_path / "basis.bin", data)
+    data[3 * BLOCK_SIZE + 10] ^= 0xFF
+    changed = write(tmp_path / "changed.bin", data)
+
+    copies = find_copies(changed, BLOCK_SIZE, block_signatures(basis, BLOCK_SIZE))
+    assert copies == [[0, 0, 3 * BLOCK_SIZE], [4 * BLOCK_SIZE, 4 * BLOCK_SIZE, 4 * BLOCK_SIZE]]
+
+
+def test_inserted_bytes_are_rolled_past(tmp_path):
+    data = os.urandom(8 * BLOCK_SIZE)
+    basis = write(tmp_path / "basis.bin", data)
+    changed = write(tmp_path / "changed.bin", data[:2 * BLOCK_SIZE] + b"inserted" + data[2 * BLOCK_SIZE:])
+
+    copies = find_copies(changed, BLOCK_SIZE, block_signatures(basis, BLOCK_SIZE), roll_budget=BLOCK_SIZE)
+    assert copies == [[0, 0, 2 * BLOCK_SIZE], [2 * BLOCK_SIZE + 8, 2 * BLOCK_SIZE, 6 * BLOCK_SIZE]]
+
+
+def test_rolling_stops_at_the_budget(tmp_path):
+    data = os.urandom(8 * BLOCK_SIZE)
+    basis = write(tmp_path / "basis.bin", data)
+    changed = write(tmp_path / "changed.bin", os.urandom(100) + data)
+
+    copies = find_copies(changed, BLOCK_SIZE, block_signatures(basis, BLOCK_SIZE), roll_budget=50)
+    assert copies == []
+
+
+def test_moved_and_repeated_blocks(tmp_path):
+    blocks = [os.urandom(BLOCK_SIZE) for _ in range(4)]
+    basis = write(tmp_path / "basis.bin", b"".join(blocks))
+    changed = write(tmp_path / "changed.bin", blocks[2] + blocks[3] + blocks[0] + blocks[0])
+
+    copies = find_copies(changed, BLOCK_SIZE, block_signatures(basis, BLOCK_SIZE))
+    assert copies == [[0, 2 * BLOCK_SIZE, 2 * BLOCK_SIZE], [2 * BLOCK_SIZE, 0, BLOCK_SIZE], [3 * BLOCK_SIZE, 0, BLOCK_SIZE]]
+
+
+def test_nothing_to_copy_from(tmp_path):
+    changed = str(make_file(tmp_path / "changed.bin", 4 * BLOCK_SIZE))
+    small = str(make_file(tmp_path / "small.bin", BLOCK_SIZE - 1))
+    signatures = block_signatures(changed, BLOCK_SIZE)
+    assert find_copies(changed, BLOCK_SIZE, []) == []
+    assert find_copies(small, BLOCK_SIZE, signatures) == []
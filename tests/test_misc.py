@@ -0,0 +1,62 @@
+from hashlib import blake2b
+
+from conftest import make_file
+from misc import hash_block, hash_blocks, leaf_hasher, merkle_leaves, merkle_root
+
+
+def node(left, right):
+    return blake2b(bytes.fromhex(left) + bytes.fromhex(right), digest_size=16, person=b"node").hexdigest()
+
+
+def leaf(data):
+    hashing_algo = leaf_hasher()
+    hashing_algo.update(data)
+    return hashing_algo.hexdigest()
+
+
+def test_hash_blocks_matches_hashing_each_block(tmp_path):
+    source = make_file(tmp_path / "source.bin", 10 * 1000 + 7)
+    with open(source, "rb") as f:
+        data = f.read()
+
+    # Past a few blocks they are hashed on the pool, in the order they were asked for
+    indices = [9, 0, 3, 10, 1, 5]
+    expected = [leaf(data[index * 1000:(index + 1) * 1000]) for index in indices]
+    assert hash_blocks(str(source), indices, 1000) == expected
+    assert hash_blocks(str(source), indices[:2], 1000) == expected[:2]
+    assert [hash_block(str(source), index, 1000) for index in indices] == expected
+
+
+def test_hash_blocks_of_files_laid_out_back_to_back(tmp_path):
+    first = make_file(tmp_path / "first.bin", 1500)
+    second = make_file(tmp_path / "second.bin", 700)
+    with open(first, "rb") as f, open(second, "rb") as g:
+        data = f.read() + g.read()
+
+    source = [[str(first), 0, 1500], [str(second), 1500, 700]]
+    assert merkle_leaves(source, 1000) == [leaf(data[:1000]), leaf(data[1000:2000]), leaf(data[2000:])]
+
+
+def test_merkle_leaves_of_an_empty_file(tmp_path):
+    source = make_file(tmp_path / "empty.bin", 0)
+    assert merkle_leaves(str(source), 1000) == []
+    assert merkle_root([]) == leaf(b"")
+
+
+def test_merkle_root():
+    leaves = [leaf(bytes([index])) for index in range(5)]
+    assert merkle_root(leaves[:1]) == leaves[0]
+    assert merkle_root(leaves[:2]) == node(leaves[0], leaves[1])
+    # An odd node out is carried up as it is
+    assert merkle_root(leaves[:3]) == node(node(leaves[0], leaves[1]), leaves[2])
+    assert merkle_root(leaves) == node(node(node(leaves[0], leaves[1]), node(leaves[2], leaves[3])), leaves[4])
+
+
+def test_merkle_root_depends_on_every_leaf():
+    leaves = [leaf(bytes([index])) for index in range(6)]
+    root = merkle_root(leaves)
+    for index in range(len(leaves)):
+        changed = list(leaves)
+        changed[index] = leaf(b"changed")
+        assert merkle_root(changed) != root
+    assert merkle_root(list(reversed(leaves))) != root
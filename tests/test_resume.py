@@ -0,0 +1,33 @@
+import socket
+import time
+
+import pytest
+
+from conftest import file_digest, make_file, wait
+
+SIZE = 24 * 1024 * 1024 + 4321
+
+
+@pytest.mark.parametrize("streams, transport", [(1, "tcp"), (3, "tcp"), (1, "udp")])
+def test_broken_connection_is_resumed(loopback, tmp_path, streams, transport):
+    sender, receiver = loopback({"rate_limit": 16 * 1024 * 1024})
+    source = make_file(tmp_path / "source.bin", SIZE)
+    uuid = sender.model.initiate_transfer("127.0.0.1", str(source), 0, streams, transport=transport).result(timeout=60)
+
+    transfer = receiver.requests[uuid]
+    deadline = time.monotonic() + 30
+    while transfer.transferred < SIZE // 4:
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+    transfer.socket.shutdown(socket.SHUT_RDWR)
+
+    received = wait(receiver.wait_for_end, uuid)
+    sent = wait(sender.wait_for_end, uuid)
+    assert received.verified and sent.verified
+    assert file_digest(tmp_path / "received" / "source.bin") == file_digest(source)
+
+    # Bytes that arrived before the break and again after it are only counted once
+    block_count = -(-SIZE // received.block_size)
+    assert received.verified_blocks == set(range(block_count))
+    assert received.block_received == [received.block_size] * (block_count - 1) + [SIZE - (block_count - 1) * received.block_size]
+    assert received.holes == []
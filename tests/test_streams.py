@@ -0,0 +1,41 @@
+import os
+import threading
+
+import pytest
+
+from conftest import wait
+from misc import MERKLE_BLOCK_SIZE
+
+
+@pytest.mark.parametrize("size", [0, MERKLE_BLOCK_SIZE, 2 * MERKLE_BLOCK_SIZE + 12345])
+def test_pipe_is_sent_as_a_stream(loopback, tmp_path, size):
+    sender, receiver = loopback()
+    pipe = tmp_path / "pipe"
+    os.mkfifo(pipe)
+    data = os.urandom(size)
+
+    def write():
+        with open(pipe, "wb") as f:
+            for offset in range(0, size, 100000):
+                f.write(data[offset:offset + 100000])
+    threading.Thread(target=write, daemon=True).start()
+
+    # Asked for, but a stream can only be read once and in order
+    uuid = sender.model.initiate_transfer("127.0.0.1", str(pipe), 0, 3, compress=True, transport="udp").result(timeout=60)
+    assert receiver.requests[uuid].streamed
+
+    received = wait(receiver.wait_for_end, uuid)
+    sent = wait(sender.wait_for_end, uuid)
+    assert received.verified and sent.verified
+    assert received.file_size == sent.file_size == size
+    with open(tmp_path / "received" / "pipe", "rb") as f:
+        assert f.read() == data
+
+
+def test_stream_is_not_fanned_out(loopback, tmp_path):
+    sender, _ = loopback()
+    pipe = tmp_path / "pipe"
+    os.mkfifo(pipe)
+    uuids = sender.model.initiate_fanout(["127.0.0.1", "127.0.0.2"], str(pipe), 0).result(timeout=60)
+    assert uuids == {"127.0.0.1": None, "127.0.0.2": None}
+    assert [type(e) for e in sender.errors] == [ValueError]
@@ -0,0 +1,176 @@
+import asyncio
+import uuid as uuid_module
+
+import pytest
+
+import udp_transport
+from conftest import file_digest, make_file, wait
+from udp_transport import ACK, ACK_HEADER, ACK_RANGE, DATA, DATA_HEADER, DatagramReceiver, DatagramSender, Impairment
+
+PEER = ("127.0.0.1", 40000)
+
+
+class Link:
+    """Stands in for a DatagramEndpoint, what is sent reaches the other end of the link on the next loop iteration"""
+
+    def __init__(self, loop, drop=None):
+        self.loop = loop
+        self.drop = drop
+        self.peer = None
+        self.channel = None
+        self.sent = []
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def open(self, uuid, channel):
+        self.channel = channel
+
+    def close(self, uuid, channel):
+        if self.channel is channel:
+            self.channel = None
+
+    def send(self, data, addr):
+        self.sent.append(bytes(data))
+        if self.peer is not None and not (self.drop and self.drop(data)):
+            self.loop.call_soon(self.peer.receive, bytes(data))
+
+    def receive(self, data):
+        if self.channel is not None:
+            self.channel.datagram_received(data, PEER)
+
+
+def decode_ack(data):
+    """Returns the largest sequence number of an acknowledgement and its ranges, most recent first"""
+    kind, _, largest, _, count = ACK_HEADER.unpack_from(data)
+    assert kind == ACK
+    return largest, [ACK_RANGE.unpack_from(data, ACK_HEADER.size + index * ACK_RANGE.size) for index in range(count)]
+
+
+def datagram(uuid, sequence, offset, payload):
+    return DATA_HEADER.pack(DATA, uuid.bytes, sequence, offset) + payload
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def make_receiver(link, uuid, missing, reserve=lambda count: True):
+    delivered = {}
+    receiver = DatagramReceiver(link, uuid, PEER[0], missing, lambda offset, run: delivered.__setitem__(offset, bytes(run)),
+                                1024 * 1024, reserve, lambda count: None)
+    return receiver, delivered
+
+
+def test_ack_ranges(loop):
+    link = Link(loop)
+    uuid = uuid_module.uuid4()
+    receiver, _ = make_receiver(link, uuid, [[0, 100 * 10]])
+    for sequence in (0, 1, 2, 4, 5, 8):
+        receiver.datagram_received(datagram(uuid, sequence, sequence * 10, bytes(10)), PEER)
+
+    # Every gap is acknowledged at once
+    largest, ranges = decode_ack(link.sent[-1])
+    assert largest == 8
+    assert ranges == [(8, 8), (4, 5), (0, 2)]
+
+    # A datagram that was overtaken closes its gap
+    receiver.datagram_received(datagram(uuid, 3, 30, bytes(10)), PEER)
+    largest, ranges = decode_ack(link.sent[-1])
+    assert largest == 8
+    assert ranges == [(8, 8), (0, 5)]
+    receiver.close()
+
+
+def test_ack_ranges_are_bounded(loop):
+    link = Link(loop)
+    uuid = uuid_module.uuid4()
+    receiver, _ = make_receiver(link, uuid, [[0, 10 * 200]])
+    for sequence in range(0, 200, 2):
+        receiver.datagram_received(datagram(uuid, sequence, sequence * 10, bytes(10)), PEER)
+
+    largest, ranges = decode_ack(link.sent[-1])
+    assert largest == 198
+    assert len(ranges) == udp_transport.MAX_ACK_RANGES
+    assert ranges[0] == (198, 198)
+    assert ranges[-1] == (198 - 2 * (udp_transport.MAX_ACK_RANGES - 1),) * 2
+    receiver.close()
+
+
+def test_datagrams_over_a_full_write_buffer_are_dropped_unacknowledged(loop):
+    link = Link(loop)
+    uuid = uuid_module.uuid4()
+    reserved = []
+    receiver, delivered = make_receiver(link, uuid, [[0, 100]], reserve=lambda count: bool(reserved))
+    receiver.datagram_received(datagram(uuid, 0, 0, bytes(10)), PEER)
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert link.sent == [] and delivered == {}
+
+    reserved.append(10)
+    receiver.datagram_received(datagram(uuid, 1, 0, bytes(10)), PEER)
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert decode_ack(link.sent[-1]) == (1, [(1, 1)])
+    assert delivered == {0: bytes(10)}
+    receiver.close()
+
+
+def test_lost_datagrams_are_sent_again(loop):
+    uuid = uuid_module.uuid4()
+    dropped = set()
+
+    def drop(data):
+        # Datagrams sent again get new numbers, so only the first tries of these are lost
+        sequence = DATA_HEADER.unpack_from(data)[2]
+        if data[0] == DATA and sequence in (5, 20):
+            dropped.add(sequence)
+            return True
+        return False
+
+    sending_link, receiving_link = Link(loop, drop), Link(loop)
+    sending_link.peer, receiving_link.peer = receiving_link, sending_link
+    data = bytes(range(256)) * 40
+    receiver, delivered = make_receiver(receiving_link, uuid, [[0, len(data)]])
+    sender = DatagramSender(sending_link, uuid, PEER, 100)
+
+    async def send():
+        await sender.send(0, data)
+        await sender.drain()
+        await asyncio.sleep(0.01)
+
+    loop.run_until_complete(send())
+    sender.close()
+    receiver.close()
+    assert dropped == {5, 20}
+    received = bytearray(len(data))
+    for offset, run in delivered.items():
+        received[offset:offset + len(run)] = run
+    assert received == data
+    assert sum(len(run) for run in delivered.values()) == len(data)
+
+
+def test_transfer_over_a_lossy_link(loopback, tmp_path):
+    sender, receiver = loopback({"impairment": Impairment(loss=0.01, delay=0.005, seed=1)},
+                                {"impairment": Impairment(loss=0.01, delay=0.005, seed=2)})
+    source = make_file(tmp_path / "source.bin", 8 * 1024 * 1024 + 123)
+    uuid = sender.model.initiate_transfer("127.0.0.1", str(source), 0, transport="udp").result(timeout=60)
+
+    received = wait(receiver.wait_for_end, uuid)
+    sent = wait(sender.wait_for_end, uuid)
+    assert received.verified and sent.verified
+    assert sent.transport == "udp"
+    assert file_digest(tmp_path / "received" / "source.bin") == file_digest(source)
+
+
+def test_falls_back_to_tcp_once_nothing_is_acknowledged(loopback, tmp_path, monkeypatch):
+    monkeypatch.setattr(udp_transport, "MAX_TIMEOUTS", 2)
+    sender, receiver = loopback({"impairment": Impairment(loss=0.999, seed=1)})
+    source = make_file(tmp_path / "source.bin", 2 * 1024 * 1024)
+    uuid = sender.model.initiate_transfer("127.0.0.1", str(source), 0, transport="udp").result(timeout=60)
+
+    received = wait(receiver.wait_for_end, uuid)
+    sent = wait(sender.wait_for_end, uuid)
+    assert received.verified and sent.verified
+    assert sent.transport == "tcp"
+    assert file_digest(tmp_path / "received" / "source.bin") == file_digest(source)
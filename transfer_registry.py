@@ -0,0 +1,182 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from misc import MERKLE_BLOCK_SIZE
+
+
+class Transfer:
+    """Everything the model keeps about a transfer in either direction, with slots instead of a dictionary per transfer"""
+
+    __slots__ = (
+        "transfer_uuid", "ip", "file_name", "file_size", "is_outbound", "path", "hash", "status",
+        # Progress, as shown
+        "transfer_speed", "eta", "transferred", "files_done", "current_file",
+        # Connections and flow control
+        "connection", "socket", "send_lock", "reply", "resume_event", "credit", "uncredited", "streams", "stripe_sockets",
+        "priority", "rate_limit", "transport", "datagrams",
+        # The byte ranges still missing, and the state of resuming them
+        "holes", "checkpointed", "resumable", "reattaching",
+        # Hashes and their verification
+        "hashing", "leaves", "block_size", "block_received", "verifying", "verified_blocks", "repairs", "verified",
+        "codecs", "codec",
+        # The file, or the files of a batch, and their handles
+        "files", "source", "file_handle", "pending_writes", "shared_reader", "streamed",
+        # Sending only what the receiver's older copy of the file lacks
+        "delta", "basis", "replaces"
+    )
+
+    def __init__(self, transfer_uuid, ip, file_name, file_size, file_hash, is_outbound, status, path="", streams=1):
+        self.transfer_uuid = transfer_uuid
+        self.ip = ip
+        self.file_name = file_name
+        self.file_size = file_size
+        self.is_outbound = is_outbound
+        self.path = path
+        self.hash = file_hash
+        self.status = status
+        self.transfer_speed = 0
+        self.eta = None
+        self.transferred = 0
+        self.files_done = 0
+        self.current_file = None
+        self.connection = None
+        self.socket = None
+        self.send_lock = None
+        self.reply = None
+        self.resume_event = asyncio.Event()
+        self.credit = None
+        self.uncredited = 0
+        self.streams = streams
+        self.stripe_sockets = []
+        self.priority = "normal"
+        self.rate_limit = None
+        self.transport = "tcp"
+        self.datagrams = None
+        self.holes = [[0, file_size]]
+        self.checkpointed = 0
+        self.resumable = False
+        self.reattaching = False
+        self.hashing = False
+        self.leaves = None
+        self.block_size = MERKLE_BLOCK_SIZE
+        self.block_received = None
+        self.verifying = 0
+        # The blocks this side hashed and found to match the manifest
+        self.verified_blocks = set()
+        self.repairs = {}
+        self.verified = None
+        self.codecs = []
+        self.codec = None
+        self.files = None
+        self.source = path or None
+        self.file_handle = None
+        self.pending_writes = set()
+        self.shared_reader = None
+        # A pipe or a device, read once to its end, its size is what was sent so far until then
+        self.streamed = False
+        self.delta = False
+        self.basis = None
+        self.replaces = None
+
+
+class TransferRegistry:
+    """The transfers of a model by UUID, indexed by their status"""
+
+    ACTIVE = ("TRANSFER_ACCEPT", "TRANSFER_RESUME")
+    PAUSED = ("TRANSFER_PAUSE",)
+    ENDED = ("TRANSFER_FINISH", "TRANSFER_CANCEL", "TRANSFER_BROKEN", "TRANSFER_REJECT")
+
+    def __init__(self, retention=600):
+        self.retention = retention
+        self.__transfers = {}
+        self.__active = set()
+        self.__paused = set()
+        self.__ended = OrderedDict()
+        # The transfers the presenter still gets told about
+        self.__watched = set()
+        self.__lock = threading.RLock()
+
+    def __getitem__(self, uuid):
+        return self.__transfers[uuid]
+
+    def __contains__(self, uuid):
+        return uuid in self.__transfers
+
+    def __len__(self):
+        return len(self.__transfers)
+
+    def get(self, uuid, default=None):
+        return self.__transfers.get(uuid, default)
+
+    def add(self, transfer, now):
+        with self.__lock:
+            self.__transfers[transfer.transfer_uuid] = transfer
+            self.__watched.add(transfer.transfer_uuid)
+            self.__index(transfer, now)
+
+    def set_status(self, uuid, status, now):
+        with self.__lock:
+            transfer = self.__transfers[uuid]
+            transfer.status = status
+            self.__index(transfer, now)
+
+    def __index(self, transfer, now):
+        uuid, name = transfer.transfer_uuid, transfer.status.name
+        for index, names in ((self.__active, self.ACTIVE), (self.__paused, self.PAUSED)):
+            if name in names:
+                index.add(uuid)
+            else:
+                index.discard(uuid)
+
+        if name not in self.ENDED:
+            self.__ended.pop(uuid, None)
+        elif uuid not in self.__ended:
+            self.__ended[uuid] = now
+
+    def watch(self, uuid):
+        with self.__lock:
+            self.__watched.add(uuid)
+
+    def unwatch(self, uuid):
+        with self.__lock:
+            self.__watched.discard(uuid)
+
+    def watched(self):
+        """Returns the transfers the presenter still gets told about, in no particular order"""
+        with self.__lock:
+            return [self.__transfers[uuid] for uuid in self.__watched]
+
+    def active(self):
+        with self.__lock:
+            return [self.__transfers[uuid] for uuid in self.__active]
+
+    def paused(self):
+        with self.__lock:
+            return [self.__transfers[uuid] for uuid in self.__paused]
+
+    def ended(self):
+        with self.__lock:
+            return [self.__transfers[uuid] for uuid in self.__ended]
+
+    def has_running(self):
+        """Checks whether any transfer is active or paused"""
+        with self.__lock:
+            return bool(self.__active or self.__paused)
+
+    def evict(self, now):
+        """Removes the transfers that ended retention seconds ago and returns them"""
+        evicted = []
+        with self.__lock:
+            while self.__ended:
+                uuid, ended_at = next(iter(self.__ended.items()))
+                if now - ended_at < self.retention:
+                    break
+                transfer = self.__transfers[uuid]
+                if (transfer.status.name == "TRANSFER_FINISH" and transfer.verified is None) or uuid in self.__watched:
+                    self.__ended.move_to_end(uuid)
+                    self.__ended[uuid] = now
+                    continue
+                del self.__ended[uuid]
+                del self.__transfers[uuid]
+                evicted.append(transfer)
+        return evicted
@@ -0,0 +1,521 @@
+import asyncio
+import bisect
+import math
+import random
+import struct
+from collections import deque
+from peer_connection import TransferDetached
+
+# | 1 B kind | 16 B UUID | 8 B sequence number | 8 B offset in the file | payload |
+DATA_HEADER = struct.Struct("!B16sQQ")
+# | 1 B kind | 16 B UUID | 8 B largest sequence number | 4 B (uint) microseconds it was held back | 1 B range count |, then the ranges
+ACK_HEADER = struct.Struct("!B16sQIB")
+# | 8 B first sequence number | 8 B last sequence number |, the most recent range first
+ACK_RANGE = struct.Struct("!QQ")
+DATA = 1
+ACK = 2
+
+# The received sequence number ranges an acknowledgement repeats, so a few lost acknowledgements don't matter
+MAX_ACK_RANGES = 32
+# Datagrams that are acknowledged together, and how long an acknowledgement waits for more of them
+ACK_EVERY = 8
+ACK_DELAY = 0.002
+# A datagram is taken for lost once one sent this many datagrams later was acknowledged, or once it is 9/8 RTT overdue
+REORDER_THRESHOLD = 3
+# Timeouts in a row without any acknowledgement until the receiver is given up on, about a minute with the backoff
+MAX_TIMEOUTS = 8
+INITIAL_RTO = 0.2
+MIN_RTO = 0.02
+# Datagrams sent back to back before yielding, and how early a paced one may go
+BURST = 16
+PACING_TICK = 0.001
+# Windows in datagrams, ALPHA of them are kept queued along the path
+INITIAL_WINDOW = 16
+MIN_WINDOW = 4
+ALPHA = 64
+GAMMA = 0.5
+
+
+class DatagramTimeout(ConnectionError):
+    """Raised to the sender once the receiver didn't acknowledge any datagram for MAX_TIMEOUTS timeouts in a row"""
+
+
+class Impairment:
+    """Drops a share of the datagrams that are sent and delays the others, to try the transport out on loopback"""
+
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, rate=None, queue=0.05, seed=None):
+        if not 0 <= loss < 1:
+            raise ValueError(f"The loss must be a share between 0 and 1, not {loss}")
+        if delay < 0 or jitter < 0:
+            raise ValueError("The delay and the jitter can't be negative")
+        if rate is not None and not rate > 0:
+            raise ValueError(f"The rate of the bottleneck must be a positive number of bytes per second, not {rate}")
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.rate = rate
+        self.queue = queue
+        self.__random = random.Random(seed)
+        self.__free_at = 0.0
+
+    def send(self, loop, transport, data, addr):
+        now = loop.time()
+        delay = self.delay + self.__random.uniform(0, self.jitter) if self.jitter else self.delay
+        if self.rate is not None:
+            self.__free_at = max(self.__free_at, now)
+            if self.__free_at - now > self.queue:
+                return
+            self.__free_at += len(data) / self.rate
+            delay += self.__free_at - now
+        if self.__random.random() < self.loss:
+            return
+        if delay > 0:
+            loop.call_later(delay, self.__send_later, transport, data, addr)
+        else:
+            transport.sendto(data, addr)
+
+    def __send_later(self, transport, data, addr):
+        if not transport.is_closing():
+            transport.sendto(data, addr)
+
+
+class DatagramEndpoint(asyncio.DatagramProtocol):
+    """The model's UDP socket, shared by every transfer whose file data goes over UDP, in either direction"""
+
+    def __init__(self, loop, impairment=None):
+        self.loop = loop
+        self.impairment = impairment
+        self.transport = None
+        # Cleared while the socket's send buffer is full, the senders wait for it instead of dropping datagrams themselves
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.__channels = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def error_received(self, exc):
+        # Like an ICMP port unreachable from a peer that went away, its senders notice by their timeouts
+        pass
+
+    def datagram_received(self, data, addr):
+        channel = self.__channels.get(data[1:17])
+        if channel is not None and len(data) >= 17:
+            channel.datagram_received(data, addr)
+
+    def open(self, uuid, channel):
+        self.__channels[uuid.bytes] = channel
+
+    def close(self, uuid, channel):
+        if self.__channels.get(uuid.bytes) is channel:
+            del self.__channels[uuid.bytes]
+
+    def port(self):
+        return self.transport.get_extra_info("sockname")[1]
+
+    def send(self, data, addr):
+        if self.transport is None:
+            return
+        if self.impairment is not None:
+            self.impairment.send(self.loop, self.transport, data, addr)
+        else:
+            self.transport.sendto(data, addr)
+
+
+class CongestionController:
+    """Delay-based congestion control after FAST TCP, windows are in bytes, times in seconds"""
+
+    def __init__(self, datagram_size):
+        self.datagram_size = datagram_size
+        self.window = INITIAL_WINDOW * datagram_size
+        self.slow_start = True
+        self.srtt = None
+        self.rttvar = None
+        self.base_rtt = None
+        self.__reduced_at = -math.inf
+
+    def queued(self):
+        """Returns the bytes of the window that are estimated to wait in queues instead of being on the wire"""
+        if self.srtt is None:
+            return 0
+        return self.window * (1 - self.base_rtt / self.srtt)
+
+    def on_rtt_sample(self, rtt):
+        self.base_rtt = rtt if self.base_rtt is None else min(self.base_rtt, rtt)
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+
+    def on_ack(self, acked):
+        if self.srtt is None:
+            return
+        alpha = ALPHA * self.datagram_size
+        if self.slow_start:
+            # Doubles the window every RTT, until the queue it builds up reaches its target
+            if self.queued() < alpha:
+                self.window += acked
+                return
+            self.slow_start = False
+        target = self.base_rtt / self.srtt * self.window + alpha
+        self.window += min(acked, GAMMA * acked / self.window * (target - self.window))
+        self.window = max(self.window, MIN_WINDOW * self.datagram_size)
+
+    def on_loss(self, sent_at, now):
+        """Shrinks the window for a datagram that was sent at sent_at and lost, at most once per RTT"""
+        if sent_at <= self.__reduced_at or self.queued() < ALPHA * self.datagram_size / 2:
+            return
+        self.window = max(self.window * 0.7, MIN_WINDOW * self.datagram_size)
+        self.slow_start = False
+        self.__reduced_at = now
+
+    def on_timeout(self):
+        self.window = max(self.window / 2, MIN_WINDOW * self.datagram_size)
+        self.slow_start = False
+
+    def rto(self):
+        if self.srtt is None:
+            return INITIAL_RTO
+        return max(self.srtt + 4 * self.rttvar + ACK_DELAY, MIN_RTO)
+
+    def pacing_rate(self):
+        """Returns the bytes per second datagrams are spread out at, None before the first RTT sample"""
+        if self.srtt is None or self.srtt == 0:
+            return None
+        return self.window / self.srtt * (2 if self.slow_start else 1.25)
+
+
+class DatagramSender:
+    """Sends the file data of a transfer as numbered datagrams, paced by its congestion controller"""
+
+    def __init__(self, endpoint, uuid, addr, datagram_size):
+        self.__endpoint = endpoint
+        self.__uuid = uuid
+        self.__addr = addr
+        self.__datagram_size = datagram_size
+        self.__loop = endpoint.loop
+        self.controller = CongestionController(datagram_size)
+        self.__next_sequence = 0
+        # Unacknowledged datagrams as [offset, payload, sent_at] by sequence number
+        self.__in_flight = {}
+        self.__bytes_in_flight = 0
+        self.__largest_acked = -1
+        # The (offset, payload) of the datagrams that were lost, they are sent again before any new ones
+        self.__lost = deque()
+        self.__next_send_at = 0.0
+        self.__burst = 0
+        self.__timer = None
+        self.__timeouts = 0
+        self.__wakeup = asyncio.Event()
+        self.__error = None
+        self.closed = False
+        endpoint.open(uuid, self)
+
+    def close(self):
+        """Stops the sender, the coroutines still sending raise TransferDetached"""
+        self.closed = True
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        self.__endpoint.close(self.__uuid, self)
+        self.__wakeup.set()
+
+    async def send(self, offset, data):
+        """Sends data, the bytes of the file at offset, returns once each of its datagrams was sent at least once"""
+        view = memoryview(data)
+        position = 0
+        while position < len(view):
+            await self.__wait_for_window()
+            if self.__lost:
+                self.__send_lost()
+                continue
+            length = min(self.__datagram_size, len(view) - position)
+            self.__send(offset + position, view[position:position + length])
+            position += length
+
+    async def drain(self):
+        """Returns once every datagram was acknowledged, the lost ones are sent again until they are"""
+        while self.__in_flight or self.__lost:
+            if self.__lost:
+                await self.__wait_for_window()
+                if self.__lost:
+                    self.__send_lost()
+            else:
+                await self.__wait()
+        self.__check()
+
+    def __check(self):
+        if self.__error is not None:
+            raise self.__error
+        if self.closed:
+            raise TransferDetached("The transfer stopped sending over UDP")
+
+    async def __wait(self):
+        """Waits for an acknowledgement or a timeout"""
+        self.__wakeup.clear()
+        await self.__wakeup.wait()
+        self.__check()
+
+    async def __wait_for_window(self):
+        """Waits until the window has room for another datagram and its pacing lets it go"""
+        while True:
+            self.__check()
+            if not self.__endpoint.writable.is_set():
+                await self.__endpoint.writable.wait()
+                continue
+            if self.__in_flight and self.__bytes_in_flight + self.__datagram_size > self.controller.window:
+                await self.__wait()
+                continue
+            now = self.__loop.time()
+            if self.__next_send_at > now + PACING_TICK:
+                self.__burst = 0
+                await asyncio.sleep(self.__next_send_at - now)
+                continue
+            if self.__burst >= BURST:
+                # Lets the acknowledgements in, sending into a socket buffer with room never suspends
+                self.__burst = 0
+                await asyncio.sleep(0)
+                continue
+            return
+
+    def __send(self, offset, payload):
+        sequence = self.__next_sequence
+        self.__next_sequence += 1
+        now = self.__loop.time()
+        self.__endpoint.send(DATA_HEADER.pack(DATA, self.__uuid.bytes, sequence, offset) + payload, self.__addr)
+        self.__in_flight[sequence] = [offset, payload, now]
+        self.__bytes_in_flight += len(payload)
+        self.__burst += 1
+
+        rate = self.controller.pacing_rate()
+        if rate is not None:
+            # Time the sender was idle isn't banked for a burst later on, beyond a tick
+            self.__next_send_at = max(self.__next_send_at, now - PACING_TICK) + len(payload) / rate
+        if self.__timer is None:
+            self.__arm_timer()
+
+    def __send_lost(self):
+        self.__send(*self.__lost.popleft())
+
+    def __arm_timer(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+        self.__timer = self.__loop.call_later(self.controller.rto() * 2 ** self.__timeouts, self.__on_timeout)
+
+    def __on_timeout(self):
+        """Takes every datagram in flight for lost, once nothing was acknowledged for a whole RTO"""
+        self.__timer = None
+        if not self.__in_flight:
+            return
+        self.__timeouts += 1
+        if self.__timeouts > MAX_TIMEOUTS:
+            self.__error = DatagramTimeout("The receiver stopped acknowledging the datagrams")
+        else:
+            self.__lost.extend((offset, payload) for offset, payload, _ in self.__in_flight.values())
+            self.__in_flight.clear()
+            self.__bytes_in_flight = 0
+            self.controller.on_timeout()
+        self.__wakeup.set()
+
+    def datagram_received(self, data, addr):
+        """Handles an acknowledgement, the acknowledged datagrams leave the window and the ones it skipped may be lost"""
+        if data[0] != ACK or len(data) < ACK_HEADER.size:
+            return
+        _, _, largest, ack_delay, count = ACK_HEADER.unpack_from(data)
+        if len(data) < ACK_HEADER.size + count * ACK_RANGE.size:
+            return
+        ranges = sorted(ACK_RANGE.unpack_from(data, ACK_HEADER.size + index * ACK_RANGE.size) for index in range(count))
+        now = self.__loop.time()
+
+        controller = self.controller
+        if largest > self.__largest_acked:
+            record = self.__in_flight.get(largest)
+            if record is not None:
+                rtt = now - record[2]
+                # The time the acknowledgement was held back isn't part of the path
+                if controller.base_rtt is None or rtt - ack_delay / 1e6 >= controller.base_rtt:
+                    rtt -= ack_delay / 1e6
+                controller.on_rtt_sample(max(rtt, 1e-6))
+            self.__largest_acked = largest
+
+        # Only the datagrams below the largest acknowledged one are looked at, the ones still in flight below
+        # the previous largest one are the few that were skipped
+        loss_delay = max(9 / 8 * controller.srtt, PACING_TICK) if controller.srtt is not None else math.inf
+        acked, lost = [], []
+        index = 0
+        for sequence, (_, _, sent_at) in self.__in_flight.items():
+            if sequence > self.__largest_acked:
+                break
+            while index < len(ranges) and ranges[index][1] < sequence:
+                index += 1
+            if index < len(ranges) and ranges[index][0] <= sequence:
+                acked.append(sequence)
+            elif self.__largest_acked - sequence >= REORDER_THRESHOLD or now - sent_at > loss_delay:
+                lost.append(sequence)
+
+        acked_bytes = 0
+        for sequence in acked:
+            acked_bytes += len(self.__in_flight.pop(sequence)[1])
+        for sequence in lost:
+            offset, payload, sent_at = self.__in_flight.pop(sequence)
+            self.__bytes_in_flight -= len(payload)
+            self.__lost.append((offset, payload))
+            controller.on_loss(sent_at, now)
+        self.__bytes_in_flight -= acked_bytes
+
+        if acked_bytes:
+            controller.on_ack(acked_bytes)
+            self.__timeouts = 0
+            if self.__in_flight:
+                self.__arm_timer()
+            elif self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+        if acked or lost:
+            self.__wakeup.set()
+
+
+class DatagramReceiver:
+    """Receives the numbered datagrams of a transfer, acknowledges them and delivers the missing bytes in runs"""
+
+    def __init__(self, endpoint, uuid, ip, missing, deliver, run_size, reserve, release):
+        self.__endpoint = endpoint
+        self.__uuid = uuid
+        self.__ip = ip
+        self.__loop = endpoint.loop
+        self.__missing = [list(hole) for hole in missing]
+        self.__deliver = deliver
+        self.__run_size = run_size
+        # Take and give back the bytes of the runs, which are delivered along with them
+        self.__reserve = reserve
+        self.__release = release
+        self.__run_offset = None
+        self.__run = None
+        # The received sequence number ranges as [first, last], in order, only the most recent ones are kept
+        self.__ranges = []
+        self.__largest_at = None
+        self.__unacknowledged = 0
+        self.__addr = None
+        self.__timer = None
+        endpoint.open(uuid, self)
+
+    def close(self):
+        """Stops receiving, the run that wasn't delivered yet is dropped, its bytes are still missing"""
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        self.__endpoint.close(self.__uuid, self)
+        if self.__run is not None:
+            self.__release(len(self.__run))
+        self.__run_offset = self.__run = None
+
+    def datagram_received(self, data, addr):
+        if data[0] != DATA or addr[0] != self.__ip or len(data) <= DATA_HEADER.size:
+            return
+        _, _, sequence, offset = DATA_HEADER.unpack_from(data)
+        length = len(data) - DATA_HEADER.size
+        is_missing = self.__is_missing(offset, length)
+        if is_missing and not self.__reserve(length):
+            # The writer is behind, so the datagram is dropped unacknowledged and the sender backs off
+            return
+        self.__addr = addr
+        is_in_order = self.__record(sequence)
+
+        if is_missing:
+            self.__take_missing(offset, length)
+            payload = memoryview(data)[DATA_HEADER.size:]
+            if self.__run is not None and offset == self.__run_offset + len(self.__run):
+                self.__run += payload
+            else:
+                self.__flush()
+                self.__run_offset, self.__run = offset, bytearray(payload)
+            if len(self.__run) >= self.__run_size:
+                self.__flush()
+
+        # A gap means a lost or overtaken datagram, the sender is told at once
+        self.__unacknowledged += 1
+        if self.__unacknowledged >= ACK_EVERY or not is_in_order:
+            self.__acknowledge()
+        if self.__timer is None:
+            self.__timer = self.__loop.call_later(ACK_DELAY, self.__on_timer)
+
+    def __on_timer(self):
+        self.__timer = None
+        if self.__unacknowledged:
+            self.__acknowledge()
+        self.__flush()
+
+    def __flush(self):
+        if self.__run is not None:
+            offset, run = self.__run_offset, self.__run
+            self.__run_offset = self.__run = None
+            self.__deliver(offset, run)
+
+    def __is_missing(self, offset, length):
+        index = bisect.bisect_right(self.__missing, [offset, math.inf]) - 1
+        return index >= 0 and offset + length <= self.__missing[index][1]
+
+    def __take_missing(self, offset, length):
+        """Removes [offset, offset + length) from the missing byte ranges, which it has to be part of"""
+        missing = self.__missing
+        end = offset + length
+        index = bisect.bisect_right(missing, [offset, math.inf]) - 1
+        start, missing_end = missing[index]
+        if start == offset and end == missing_end:
+            del missing[index]
+        elif start == offset:
+            missing[index][0] = end
+        elif end == missing_end:
+            missing[index][1] = offset
+        else:
+            missing[index][1] = offset
+            missing.insert(index + 1, [end, missing_end])
+
+    def __record(self, sequence):
+        """Adds a sequence number to the received ranges, returns True if it directly follows the largest one"""
+        ranges = self.__ranges
+        if ranges and sequence == ranges[-1][1] + 1:
+            ranges[-1][1] = sequence
+            self.__largest_at = self.__loop.time()
+            return True
+        if not ranges or sequence > ranges[-1][1]:
+            ranges.append([sequence, sequence])
+            self.__largest_at = self.__loop.time()
+            if len(ranges) > 2 * MAX_ACK_RANGES:
+                del ranges[:-MAX_ACK_RANGES]
+            return False
+
+        # Overtaken by later datagrams, or a duplicate
+        index = bisect.bisect_right(ranges, [sequence, math.inf]) - 1
+        if index >= 0 and sequence <= ranges[index][1]:
+            return False
+        joins_previous = index >= 0 and ranges[index][1] + 1 == sequence
+        joins_next = ranges[index + 1][0] - 1 == sequence
+        if joins_previous and joins_next:
+            ranges[index][1] = ranges[index + 1][1]
+            del ranges[index + 1]
+        elif joins_previous:
+            ranges[index][1] = sequence
+        elif joins_next:
+            ranges[index + 1][0] = sequence
+        else:
+            ranges.insert(index + 1, [sequence, sequence])
+        return False
+
+    def __acknowledge(self):
+        recent = self.__ranges[-MAX_ACK_RANGES:]
+        delay = min(int((self.__loop.time() - self.__largest_at) * 1e6), 0xFFFFFFFF)
+        ack = ACK_HEADER.pack(ACK, self.__uuid.bytes, recent[-1][1], delay, len(recent))
+        ack += b"".join(ACK_RANGE.pack(first, last) for first, last in reversed(recent))
+        self.__endpoint.send(ack, self.__addr)
+        self.__unacknowledged = 0
@@ -1,10 +1,152 @@
 import customtkinter
+import sys
+import threading
 from tkinter import filedialog
-from misc import convert_file_size
+from misc import convert_file_size, convert_duration
 
 customtkinter.set_appearance_mode("dark")
 customtkinter.set_default_color_theme("dark-blue")
 
+class TransferList:
+    """A scrollable list of transfers that only has widgets for the rows that fit in it"""
+
+    def __init__(self, master, view, row_height):
+        self.view = view
+        self.row_height = row_height
+        self.frame = customtkinter.CTkFrame(master)
+        self.frame.grid_rowconfigure(0, weight=1)
+        self.frame.grid_columnconfigure(0, weight=1)
+
+        self.__body = customtkinter.CTkFrame(self.frame, fg_color="transparent")
+        self.__body.grid(row=0, column=0, sticky="nsew")
+        self.__body.bind("<Configure>", lambda event: self.__render())
+        self.__bind_mouse_wheel(self.__body)
+
+        self.__scrollbar = customtkinter.CTkScrollbar(self.frame, command=self.__scroll)
+        self.__scrollbar.grid(row=0, column=1, sticky="ns")
+
+        self.__infos = {}
+        # The UUIDs of the listed transfers, in the order they first showed up, and the ones closed with X
+        self.__order = []
+        self.__removed = set()
+        self.__first = 0
+        self.__rows = []
+
+    def update(self, infos):
+        """Takes the latest info dictionaries of changed transfers, only the visible rows are redrawn"""
+        for info in infos:
+            transfer_uuid = info["transfer_uuid"]
+            if transfer_uuid in self.__removed:
+                continue
+            if transfer_uuid not in self.__infos:
+                self.__order.append(transfer_uuid)
+            self.__infos[transfer_uuid] = info
+        self.__render()
+
+    def __remove(self, transfer_uuid):
+        self.__removed.add(transfer_uuid)
+        self.__order.remove(transfer_uuid)
+        del self.__infos[transfer_uuid]
+        self.__render()
+
+    def __fitting_count(self):
+        """Returns how many whole rows fit, one more row is drawn to fill the rest of the list"""
+        return max(1, self.__body.winfo_height() // self.row_height)
+
+    def __scroll(self, action, amount, unit=None):
+        """Handles the scrollbar like a yview command, moveto a fraction or scroll by rows"""
+        if action == "moveto":
+            first = round(float(amount) * len(self.__order))
+        else:
+            first = self.__first + int(amount)
+        self.__first = max(0, min(first, len(self.__order) - self.__fitting_count()))
+        self.__render()
+
+    def __bind_mouse_wheel(self, widget):
+        if sys.platform.startswith("linux"):
+            widget.bind("<Button-4>", lambda event: self.__scroll("scroll", -1))
+            widget.bind("<Button-5>", lambda event: self.__scroll("scroll", 1))
+        else:
+            widget.bind("<MouseWheel>", lambda event: self.__scroll("scroll", -1 if event.delta > 0 else 1))
+
+    def __create_row(self):
+        frame = customtkinter.CTkFrame(self.__body, height=self.row_height - 10)
+        frame.grid_propagate(False)
+        frame.grid_columnconfigure(0, weight=1)
+
+        row = {"frame": frame, "transfer_uuid": None}
+        row["label"] = customtkinter.CTkLabel(frame, text="", anchor="w", justify="left", wraplength=380)
+        row["label"].grid(row=0, column=0, columnspan=2, padx=5, pady=5, sticky="w")
+
+        # The buttons act on whichever transfer the row shows at the moment
+        row["pause"] = customtkinter.CTkButton(frame, text="Pause", width=50, command=lambda: self.view.presenter.toggle_pause_transfer(row["transfer_uuid"]))
+        row["cancel"] = customtkinter.CTkButton(frame, text="Cancel", width=50, command=lambda: self.view.presenter.cancel_transfer(row["transfer_uuid"]))
+        row["x"] = customtkinter.CTkButton(frame, text="X", width=50, command=lambda: self.__remove(row["transfer_uuid"]))
+
+        def handle_priority_menu(priority):
+            self.view.presenter.set_transfer_priority(row["transfer_uuid"], priority)
+
+        def handle_rate_limit_entry(event):
+            rate = self.view.parse_rate_limit(row["rate_limit"].get())
+            if rate is not False:
+                self.view.presenter.set_transfer_rate_limit(row["transfer_uuid"], rate)
+
+        row["priority"] = customtkinter.CTkOptionMenu(frame, values=["low", "normal", "high"], width=100, command=handle_priority_menu)
+        row["rate_limit"] = customtkinter.CTkEntry(frame, placeholder_text="Limit (MB/s)", width=100)
+        row["rate_limit"].bind("<Return>", handle_rate_limit_entry)
+
+        for widget in (frame, row["label"]):
+            self.__bind_mouse_wheel(widget)
+        return row
+
+    def __show_row(self, row, info):
+        is_rebound = row["transfer_uuid"] != info["transfer_uuid"]
+        row["transfer_uuid"] = info["transfer_uuid"]
+        row["label"].configure(text=self.view.describe_transfer(info))
+
+        if info["display_X"]:
+            for widget in (row["pause"], row["cancel"], row["priority"], row["rate_limit"]):
+                widget.grid_remove()
+            row["x"].grid(row=1, column=1, padx=5, pady=5, sticky="w")
+            return
+
+        row["x"].grid_remove()
+        row["pause"].grid(row=1, column=0, padx=5, pady=5, sticky="e")
+        row["cancel"].grid(row=1, column=1, padx=5, pady=5, sticky="w")
+        if info["is_outbound"]:
+            row["priority"].set(info["priority"])
+            row["priority"].grid(row=2, column=0, padx=5, pady=5, sticky="e")
+            if is_rebound:
+                # The limit being typed in is kept while the same transfer is refreshed
+                row["rate_limit"].delete(0, "end")
+                if info["rate_limit"] is not None:
+                    row["rate_limit"].insert(0, f"{info['rate_limit'] / 1024 / 1024:g}")
+            row["rate_limit"].grid(row=2, column=1, padx=5, pady=5, sticky="w")
+
+    def __render(self):
+        fitting_count = self.__fitting_count()
+        visible_count = fitting_count + 1
+        self.__first = max(0, min(self.__first, len(self.__order) - fitting_count))
+        while len(self.__rows) < visible_count:
+            row = self.__create_row()
+            row["frame"].pack(fill="x", pady=5)
+            self.__rows.append(row)
+
+        for index, row in enumerate(self.__rows):
+            position = self.__first + index
+            if index < visible_count and position < len(self.__order):
+                self.__show_row(row, self.__infos[self.__order[position]])
+                row["frame"].pack(fill="x", pady=5)
+            else:
+                row["transfer_uuid"] = None
+                row["frame"].pack_forget()
+
+        if self.__order:
+            self.__scrollbar.set(self.__first / len(self.__order), min(1, (self.__first + fitting_count) / len(self.__order)))
+        else:
+            self.__scrollbar.set(0, 1)
+
+
 class TransferApp:
     def __init__(self, presenter):
         self.presenter = presenter
@@ -12,8 +154,11 @@ class TransferApp:
         self.root.geometry("900x500")
         self.root.title("BlueTransfer")
 
-        self.transfer_frames = {}
         self.sending_windows_status_labels = []
+        # Filled from the model's thread, drained on the Tk thread
+        self.__pending_updates = {}
+        self.__pending_calls = []
+        self.__pending_lock = threading.Lock()
 
         # Configure main grid
         self.root.grid_rowconfigure(0, weight=1)
@@ -34,11 +179,25 @@ class TransferApp:
         sending_label = customtkinter.CTkLabel(self.sending_frame, text="SENDING", font=("Arial", 18, "bold"))
         sending_label.grid(row=0, column=0, sticky="w", pady=(10, 5), padx=(10, 0))
 
+        rate_limit_frame = customtkinter.CTkFrame(self.sending_frame, fg_color="transparent")
+        rate_limit_frame.grid(row=0, column=1, sticky="e", pady=(10, 5))
+
+        rate_limit_entry = customtkinter.CTkEntry(rate_limit_frame, placeholder_text="Upload limit (MB/s)", width=140)
+        rate_limit_entry.pack(side="left", padx=5)
+
+        def handle_rate_limit_button():
+            rate = self.parse_rate_limit(rate_limit_entry.get())
+            if rate is not False:
+                self.presenter.set_rate_limit(rate)
+
+        rate_limit_button = customtkinter.CTkButton(rate_limit_frame, text="Set", width=50, command=handle_rate_limit_button)
+        rate_limit_button.pack(side="left")
+
         self.add_send_button = customtkinter.CTkButton(self.sending_frame, text="Send new file...", command=self.__create_file_sender_window)
         self.add_send_button.grid(row=0, column=2, sticky="e", padx=10, pady=(10, 5))
 
-        self.sending_list = customtkinter.CTkScrollableFrame(self.sending_frame, width=350)
-        self.sending_list.grid(row=1, column=0, columnspan=3, sticky="nsew", pady=10, padx=10)
+        self.sending_list = TransferList(self.sending_frame, self, 240)
+        self.sending_list.frame.grid(row=1, column=0, columnspan=3, sticky="nsew", pady=10, padx=10)
 
         # Receiving Section
         self.receiving_frame = customtkinter.CTkFrame(self.main_frame)
@@ -49,8 +208,9 @@ class TransferApp:
         receiving_label = customtkinter.CTkLabel(self.receiving_frame, text="RECEIVING", font=("Arial", 18, "bold"))
         receiving_label.grid(row=0, column=0, sticky="w", pady=(10, 5), padx=(10, 0))
 
-        self.receiving_list = customtkinter.CTkScrollableFrame(self.receiving_frame, width=350)
-        self.receiving_list.grid(row=1, column=0, sticky="nsew", pady=10, padx=10)
+        self.receiving_list = TransferList(self.receiving_frame, self, 200)
+        self.receiving_list.frame.grid(row=1, column=0, sticky="nsew", pady=10, padx=10)
+        self.root.after(100, self.__apply_transfer_updates)
 
         def on_closing():
             active_transfers = self.presenter.check_for_active_transfers()
@@ -115,7 +275,7 @@ class TransferApp:
         return response["value"]
 
     def create_transfer_request_popup(self, info):
-        '''info dictionary: transfer_uuid, ip, file_name, file_size, hash'''
+        '''info dictionary: transfer_uuid, ip, file_name, file_size, file_count, hash'''
         popup = customtkinter.CTkToplevel()
         popup.title("File Transfer Request")
         popup.geometry("400x320")
@@ -125,10 +285,13 @@ class TransferApp:
         transfer_uuid = info["transfer_uuid"]
         ip = info["ip"]
         file_name = info["file_name"]
-        file_size = convert_file_size(info["file_size"])
+        file_size = convert_file_size(info["file_size"]) if info["file_size"] is not None else "unknown"
         hash = info["hash"]
 
-        message = f"{ip} sent you a transfer request!\nFile: {file_name}\nSize: {file_size}\nSHA-1: {hash}"
+        if info["file_count"] is None:
+            message = f"{ip} sent you a transfer request!\nFile: {file_name}\nSize: {file_size}\nHash tree root: {hash}"
+        else:
+            message = f"{ip} sent you a transfer request!\nFolder: {file_name} ({info['file_count']} files)\nSize: {file_size}\nHash tree root: {hash}"
 
         message_label = customtkinter.CTkLabel(popup, text=message, wraplength=380, anchor="w", justify="left")
         message_label.pack(pady=20)
@@ -151,10 +314,23 @@ class TransferApp:
 
         popup.protocol("WM_DELETE_WINDOW", on_reject)
 
+    def parse_rate_limit(self, text):
+        """Converts a rate limit in MB/s to bytes per second, an empty one lifts the limit and an invalid one returns False"""
+        if not text.strip():
+            return None
+        try:
+            rate = float(text)
+        except ValueError:
+            rate = 0
+        if not rate > 0:
+            self.create_generic_popup("The upload limit must be a positive number of MB/s, or empty for no limit!")
+            return False
+        return rate * 1024 * 1024
+
     def __create_file_sender_window(self):
         file_sender_window = customtkinter.CTkToplevel(self.root)
         file_sender_window.title("Initiate Transfer")
-        file_sender_window.geometry("400x320")
+        file_sender_window.geometry("400x570")
         file_sender_window.geometry(f"+{self.root.winfo_rootx() + 100}+{self.root.winfo_rooty() - 10}")
         file_sender_window.after(10, lambda: file_sender_window.focus_force())
 
@@ -171,15 +347,57 @@ class TransferApp:
                 file_label.configure(text=f"{path}")
                 file_path = path
 
-        browse_button = customtkinter.CTkButton(file_sender_window, text="Browse File", command=browse_file)
-        browse_button.pack(pady=10, padx=10)
+        def browse_folder():
+            nonlocal file_path
+            path = filedialog.askdirectory()
+            file_sender_window.focus_force()
+            if path:
+                file_label.configure(text=f"{path}")
+                file_path = path
+
+        browse_buttons_frame = customtkinter.CTkFrame(file_sender_window, fg_color="transparent")
+        browse_buttons_frame.pack(pady=10, padx=10)
+
+        browse_button = customtkinter.CTkButton(browse_buttons_frame, text="Browse File", command=browse_file)
+        browse_button.pack(side="left", padx=5)
 
-        ip_label = customtkinter.CTkLabel(file_sender_window, text="Enter Receiver's IP:")
+        browse_folder_button = customtkinter.CTkButton(browse_buttons_frame, text="Browse Folder", command=browse_folder)
+        browse_folder_button.pack(side="left", padx=5)
+
+        ip_label = customtkinter.CTkLabel(file_sender_window, text="Enter Receiver's IP (several separated by commas):")
         ip_label.pack(pady=10, padx=10)
 
         ip_entry = customtkinter.CTkEntry(file_sender_window, placeholder_text="ipv4")
         ip_entry.pack(pady=10, padx=10)
 
+        streams_entry = customtkinter.CTkEntry(file_sender_window, placeholder_text="Parallel connections (1)")
+        streams_entry.pack(pady=10, padx=10)
+
+        pipelined_hash_checkbox = customtkinter.CTkCheckBox(file_sender_window, text="Hash while sending")
+        pipelined_hash_checkbox.pack(pady=10, padx=10)
+
+        compress_checkbox = customtkinter.CTkCheckBox(file_sender_window, text="Compress")
+        compress_checkbox.pack(pady=10, padx=10)
+
+        delta_checkbox = customtkinter.CTkCheckBox(file_sender_window, text="Only send changes to an older copy")
+        delta_checkbox.pack(pady=10, padx=10)
+
+        udp_checkbox = customtkinter.CTkCheckBox(file_sender_window, text="Send over UDP (long lossy links)")
+        udp_checkbox.pack(pady=10, padx=10)
+
+        priority_frame = customtkinter.CTkFrame(file_sender_window, fg_color="transparent")
+        priority_frame.pack(pady=10, padx=10)
+
+        priority_label = customtkinter.CTkLabel(priority_frame, text="Priority:")
+        priority_label.pack(side="left", padx=5)
+
+        priority_menu = customtkinter.CTkOptionMenu(priority_frame, values=["low", "normal", "high"], width=100)
+        priority_menu.set("normal")
+        priority_menu.pack(side="left", padx=5)
+
+        rate_limit_entry = customtkinter.CTkEntry(file_sender_window, placeholder_text="Upload limit (MB/s)")
+        rate_limit_entry.pack(pady=10, padx=10)
+
         status_label = customtkinter.CTkLabel(file_sender_window, text="", wraplength=380, anchor="n", justify="left")
         status_label.pack(pady=10, padx=10, fill="x")
         
@@ -187,10 +405,23 @@ class TransferApp:
         index = len(self.sending_windows_status_labels) - 1
 
         def send_transfer_request():
-            if not file_path or not ip_entry.get():
+            ips = [ip.strip() for ip in ip_entry.get().split(",") if ip.strip()]
+            if not file_path or not ips:
                 self.create_generic_popup("Please select a file and enter a valid IP address!")
                 return
-            self.presenter.send_transfer_request(ip_entry.get(), file_path, index)
+            streams = streams_entry.get() or "1"
+            if not streams.isdigit() or int(streams) < 1:
+                self.create_generic_popup("The number of parallel connections must be a positive whole number!")
+                return
+            rate_limit = self.parse_rate_limit(rate_limit_entry.get())
+            if rate_limit is False:
+                return
+            transport = "udp" if udp_checkbox.get() else "tcp"
+            if len(ips) > 1:
+                # The file is read once for all of them, it is hashed before the requests are sent
+                self.presenter.send_fanout_request(ips, file_path, index, int(streams), bool(compress_checkbox.get()), priority_menu.get(), rate_limit, bool(delta_checkbox.get()), transport)
+                return
+            self.presenter.send_transfer_request(ips[0], file_path, index, int(streams), bool(pipelined_hash_checkbox.get()), bool(compress_checkbox.get()), priority_menu.get(), rate_limit, bool(delta_checkbox.get()), transport)
 
         request_button = customtkinter.CTkButton(file_sender_window, text="Transfer", command=send_transfer_request)
         request_button.pack(pady=10, padx=10)
@@ -199,82 +430,60 @@ class TransferApp:
         if self.sending_windows_status_labels[label_index]:
             self.sending_windows_status_labels[label_index].configure(text=text)
             
-    def sync_transferring_frame_to_ui(self, info):
-        '''info dictionary: transfer_uuid, ip, hash, file_name, file_size, transfer_speed, transferred, is_outbound, status'''
-
-        transfer_uuid = info["transfer_uuid"]
-        ip = info["ip"]
-        hash = info["hash"]
-        file_name = info["file_name"]
-        file_size = info["file_size"]
-        transfer_speed = info["transfer_speed"]
-        transferred = info["transferred"]
-        is_outbound = info["is_outbound"]
-        status = info["status"]
-        display_X = info["display_X"]
-
-        info_text = f"{file_name}\n"
-        if is_outbound:
-            info_text += f"To: {ip}\n"
-        else:
-            info_text += f"From: {ip}\n"
-
-        info_text += f"{convert_file_size(transferred)}/{convert_file_size(file_size)}\nSpeed: {convert_file_size(transfer_speed)}/s\nSha-1: {hash}\nStatus: {status}"
-
-        if not self.transfer_frames.get(transfer_uuid):
-            frame = None
-            if is_outbound:
-                frame = customtkinter.CTkFrame(self.sending_list)
-            else:
-                frame = customtkinter.CTkFrame(self.receiving_list)
-
-            frame.pack(fill="x", pady=5)
-
-            frame.grid_columnconfigure(0, weight=1)
-
-            info_label = customtkinter.CTkLabel(
-                frame, text=info_text, anchor="w", justify="left", wraplength=380
-            )
-            info_label.grid(row=0, column=0, columnspan=2, padx=5, pady=5, sticky="w")
-
-            self.transfer_frames[transfer_uuid] = {
-                "frame": frame,
-                "label": info_label,
-                "removed": False
-            }
-
-            def handle_pause_button():
-                self.presenter.toggle_pause_transfer(transfer_uuid)
-
-            def handle_cancel_button():
-                self.presenter.cancel_transfer(transfer_uuid)
-
-            pause_button = customtkinter.CTkButton(frame, text="Pause", width=50, command=handle_pause_button)
-            pause_button.grid(row=1, column=0, padx=5, pady=5, sticky="e")
-
-            cancel_button = customtkinter.CTkButton(frame, text="Cancel", width=50, command=handle_cancel_button)
-            cancel_button.grid(row=1, column=1, padx=5, pady=5, sticky="w")
+    def queue_transfer_updates(self, infos):
+        '''Called from the model's thread with the info dictionaries of the transfers that changed, they are drawn
+        by the Tk thread within a tenth of a second. A transfer that changes again before that is only drawn once
+
+        info dictionary: transfer_uuid, ip, hash, file_name, file_size, transfer_speed, eta, transferred, is_outbound, status,
+        display_X, file_count, files_done, current_file, priority, rate_limit'''
+        with self.__pending_lock:
+            for info in infos:
+                self.__pending_updates[info["transfer_uuid"]] = info
+
+    def call_on_tk_thread(self, function, *args):
+        '''Called from the model's thread, function is called on the Tk thread along with the next batch of transfer updates'''
+        with self.__pending_lock:
+            self.__pending_calls.append((function, args))
+
+    def __apply_transfer_updates(self):
+        try:
+            with self.__pending_lock:
+                infos, self.__pending_updates = self.__pending_updates, {}
+                calls, self.__pending_calls = self.__pending_calls, []
+
+            # A failing update or call doesn't keep the rest of the batch from being made
+            if infos:
+                try:
+                    self.sending_list.update([info for info in infos.values() if info["is_outbound"]])
+                    self.receiving_list.update([info for info in infos.values() if not info["is_outbound"]])
+                except Exception:
+                    self.root.report_callback_exception(*sys.exc_info())
+            for function, args in calls:
+                try:
+                    function(*args)
+                except Exception:
+                    self.root.report_callback_exception(*sys.exc_info())
+        finally:
+            self.root.after(100, self.__apply_transfer_updates)
+
+    def describe_transfer(self, info):
+        info_text = f"{info['file_name']}\n"
+        if info["is_outbound"]:
+            info_text += f"To: {info['ip']}\n"
         else:
-            if self.transfer_frames[transfer_uuid]["removed"] == False:
-                info_label = self.transfer_frames[transfer_uuid]["label"]
-                info_label.configure(text=info_text)
-
-        if display_X:
-            frame = self.transfer_frames[transfer_uuid]["frame"]
-            
-            for widget in frame.grid_slaves(row=1):
-                widget.grid_forget()
-
-            def handle_x_button():
-                self.transfer_frames[transfer_uuid]["frame"].pack_forget()
-                self.transfer_frames[transfer_uuid]["removed"] = True
-
-            x_button = customtkinter.CTkButton(frame, text="X", width=50, command=handle_x_button)
-            x_button.grid(row=1, column=1, padx=5, pady=5, sticky="w" )
-
-    def delete_transferring_frame_ui(self, transfer_uuid):
-        self.transfer_frames[transfer_uuid]["frame"].destroy()
-        del self.transfer_frames[transfer_uuid]
+            info_text += f"From: {info['ip']}\n"
+
+        if info["file_count"] is not None:
+            info_text += f"Files: {info['files_done']}/{info['file_count']}\n"
+            if info["current_file"] is not None:
+                current_path, current_transferred, current_size = info["current_file"]
+                info_text += f"Current: {current_path} ({convert_file_size(current_transferred)}/{convert_file_size(current_size)})\n"
+
+        info_text += f"{convert_file_size(info['transferred'])}/{convert_file_size(info['file_size'])}\nSpeed: {convert_file_size(info['transfer_speed'])}/s"
+        if info["eta"] is not None:
+            info_text += f", {convert_duration(info['eta'])} left"
+        info_text += f"\nHash tree root: {info['hash']}\nStatus: {info['status']}"
+        return info_text
 
     def launch(self):
         self.root.mainloop()
\ No newline at end of file